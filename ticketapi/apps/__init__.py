@@ -1,11 +1,49 @@
 from flask import Flask
+from ticketapi.data import SETTINGS
 from ticketapi.data.logger import logger
+from ticketapi.data.logger import set_log_file
 
 __version__ = '0.1.0'
-__all__ = ['app']
+__all__ = ['create_app']
 
-# Setup our package level flask application
-app = Flask(__name__)
 
-# Add our log handler for flask to handle our logs
-app.logger.addHandler(logger.handlers[0])
+def create_app(settings=None, blueprints=None, database=True):
+    """
+    Create the flask application. Importing ticketapi.apps does not read the settings, open the log file or connect to
+    the database, this is done here (or on first use) so that each WSGI worker, CLI tool and benchmark only sets up
+    what it needs. Benchmarks and tools may pass their own settings to run the API in-process.
+
+    :param settings: optional dictionary of settings used instead of the settings file (see Settings.configure)
+    :param blueprints: list of blueprints to register, defaults to the API's routes. CLI tools that only use the
+        database pass an empty list
+    :param database: if False, the database is not bound to the app and the datalayer is not imported
+    :return: Flask application
+    """
+    if settings is not None:
+        SETTINGS.configure(settings)
+    if SETTINGS.get('log_file'):
+        set_log_file(SETTINGS.get('log_file'))
+
+    app = Flask(__name__)
+
+    # Add our log handler for flask to handle our logs
+    app.logger.addHandler(logger.handlers[0])
+
+    # Bind the database to the app and map the models from the schema snapshot named by the settings, the engine
+    # is created by the first query
+    if database:
+        from ticketapi.datalayer.models import configure_app
+        configure_app(app)
+
+    if blueprints is None:
+        from ticketapi.apps.ticketapi import api
+        blueprints = [api]
+    for blueprint in blueprints:
+        app.register_blueprint(blueprint)
+
+    # Load every region's phone number metadata now instead of during the first request that needs it
+    if SETTINGS.get('preload_phone_metadata', False):
+        from ticketapi.data.fields import preload_phone_metadata
+        logger.info('Loaded phone number metadata for {count} regions'.format(count=preload_phone_metadata()))
+
+    return app
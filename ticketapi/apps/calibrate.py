@@ -0,0 +1,112 @@
+import argparse
+import os
+import resource
+import time
+import scrypt
+from ticketapi.data.crypto import CryptoConsts
+
+
+def measure(n, r, p, rounds):
+    """
+    Measure how long scrypt takes with the given cost parameters
+
+    :param n: scrypt CPU/memory cost
+    :param r: scrypt block size
+    :param p: scrypt parallelization
+    :param rounds: number of hashes to time
+    :return: tuple (median seconds per hash, peak resident memory of this process in MB)
+    """
+    salt = os.urandom(CryptoConsts.SALT_BYTES)
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        scrypt.hash('calibration-password', salt, N=n, r=r, p=p, buflen=CryptoConsts.HASH_BYTES)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return timings[len(timings) // 2], peak_mb
+
+
+if __name__ == '__main__':
+    # Create our argument parser
+    parser = argparse.ArgumentParser(
+        description=' '.join([
+            'Tool to measure scrypt hashing latency and memory on this host and recommend the cost parameters',
+            'that fit within a login latency budget. The recommended values go in settings.json as scrypt_n,',
+            'scrypt_r and scrypt_p, existing passwords are rehashed with them the next time they log in.'
+        ])
+    )
+
+    # Add arguments to be parsed
+    parser.add_argument(
+        '--budget-ms', '-b',
+        dest='budget_ms',
+        metavar='250',
+        type=float,
+        default=250.0,
+        help='maximum number of milliseconds a single password hash may take'
+    )
+    parser.add_argument(
+        '--max-memory-mb', '-m',
+        dest='max_memory_mb',
+        metavar='64',
+        type=float,
+        default=64.0,
+        help='maximum number of megabytes a single hash may use, remember every crypto worker may hash at once'
+    )
+    parser.add_argument(
+        '-r',
+        metavar='8',
+        type=int,
+        default=CryptoConsts.DEFAULT_R,
+        help='scrypt block size to calibrate with'
+    )
+    parser.add_argument(
+        '-p',
+        metavar='1',
+        type=int,
+        default=CryptoConsts.DEFAULT_P,
+        help='scrypt parallelization to calibrate with'
+    )
+    parser.add_argument(
+        '--rounds',
+        metavar='3',
+        type=int,
+        default=3,
+        help='number of hashes to time per setting, the median is used'
+    )
+
+    args = parser.parse_args()
+
+    try:
+        recommended = None
+        print('{n:>10} {ms:>10} {mem:>12} {peak:>12}'.format(n='N', ms='ms/hash', mem='scrypt MB', peak='peak RSS MB'))
+
+        for exponent in range(10, 25):
+            n = 1 << exponent
+
+            # scrypt needs 128 * r * N bytes, do not even try settings that cannot fit
+            memory_mb = 128.0 * args.r * n / (1024 * 1024)
+            if memory_mb > args.max_memory_mb:
+                break
+
+            seconds, peak_mb = measure(n, args.r, args.p, args.rounds)
+            print('{n:>10} {ms:>10.1f} {mem:>12.1f} {peak:>12.1f}'.format(
+                n=n, ms=seconds * 1000, mem=memory_mb, peak=peak_mb
+            ))
+
+            if seconds * 1000 > args.budget_ms:
+                break
+            recommended = n
+
+        if recommended is None:
+            print('No setting fits within {ms}ms, consider a faster host or a larger budget'.format(ms=args.budget_ms))
+            exit(1)
+
+        print('Recommended settings:')
+        print('  "scrypt_n": {n},'.format(n=recommended))
+        print('  "scrypt_r": {r},'.format(r=args.r))
+        print('  "scrypt_p": {p}'.format(p=args.p))
+    except KeyboardInterrupt as e:
+        print('Exiting on user command')
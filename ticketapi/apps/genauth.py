@@ -1,7 +1,63 @@
 import argparse
+import csv
 import getpass
+import json
 import re
 from ticketapi.datalayer.procedures import add_auth
+from ticketapi.datalayer.procedures import add_auths
+from ticketapi.apps import create_app
+
+
+def read_batch(filename):
+    """
+    Read the rows to add from a CSV file with a companyName,companyID,password header or from
+    a JSONL file with one object containing those keys per line
+
+    :param filename: path of the file to read, files ending in .jsonl or .json are read as JSONL
+    :return: list of row dictionaries
+    """
+    with open(filename, 'r', newline='') as batch_file:
+        if filename.endswith(('.jsonl', '.json')):
+            return [json.loads(line) for line in batch_file if line.strip()]
+        return list(csv.DictReader(batch_file))
+
+
+def run_batch(args):
+    """
+    Add every company in the batch file and print a result for each row
+
+    :param args: parsed command line arguments
+    """
+    rows = read_batch(args.batch)
+    print('Adding {count} companies from "{batch}"'.format(count=len(rows), batch=args.batch))
+
+    cont = 'y' if args.yes else input('Continue (y/n)? ')
+    if not re.match(r'y(es)?', cont, re.IGNORECASE):
+        print('User said no')
+        return
+
+    results = add_auths(rows, chunk_size=args.chunk_size, workers=args.workers)
+
+    report = None
+    if args.report:
+        report = open(args.report, 'w', newline='')
+        writer = csv.writer(report)
+        writer.writerow(['companyID', 'success', 'reason'])
+
+    added = 0
+    for company_id, success, reason in results:
+        added += success
+        print('{status} "{company_id}": {reason}'.format(
+            status='ADDED ' if success else 'FAILED',
+            company_id=company_id,
+            reason=reason
+        ))
+        if report is not None:
+            writer.writerow([company_id, success, reason])
+
+    if report is not None:
+        report.close()
+    print('Added {added} of {count} companies'.format(added=added, count=len(results)))
 
 
 if __name__ == '__main__':
@@ -28,9 +84,46 @@ if __name__ == '__main__':
             '--password', '-p',
             help='Although strongly discouraged to use on commandline, the password for the new company username'
         )
+        parser.add_argument(
+            '--batch', '-b',
+            metavar='companies.csv',
+            help=' '.join([
+                'Add many companies at once from a CSV file with a companyName,companyID,password header or a',
+                'JSONL file (.jsonl) with one object per line containing the same keys'
+            ])
+        )
+        parser.add_argument(
+            '--workers', '-w',
+            type=int,
+            help='Number of processes used to hash passwords in batch mode, defaults to the number of CPUs'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=100,
+            help='Number of rows inserted per transaction in batch mode'
+        )
+        parser.add_argument(
+            '--report', '-r',
+            metavar='report.csv',
+            help='Also write the per-row results of batch mode to this CSV file'
+        )
+        parser.add_argument(
+            '--yes', '-y',
+            action='store_true',
+            help='Do not ask for confirmation in batch mode'
+        )
 
         args = parser.parse_args()
 
+        # Bind the database to an app, the tool does not serve any routes
+        create_app(blueprints=[])
+
+        if args.batch:
+            run_batch(args)
+            exit(0)
+
         # If we don't have a company or username in the arguments, ask for it
         company = input('Enter company name: ').strip() if not args.company else args.company
         username = input('Enter company username: ').strip() if not args.username else args.username
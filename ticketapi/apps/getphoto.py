@@ -1,13 +1,21 @@
 import os
 import argparse
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from os.path import basename
 from sqlalchemy import desc
 from ticketapi.datalayer import *
 from ticketapi.data.logger import logger
 from ticketapi.data import LOG_FILE
 from ticketapi.data import TICKET_API_ROOT
+from ticketapi.data.photostore import photo_store
+from ticketapi.data.photostore import sniff_content_type
 from io import BytesIO
 from PIL import Image
+from ticketapi.apps import create_app
 
 
 # This is where we will store all photos called with --save
@@ -26,6 +34,156 @@ def get_image(data):
     return Image.open(stream)
 
 
+def get_photo_data(session, ticket, variant=None):
+    """
+    Get the photo bytes of a ticket, reading through the photo store. Tickets submitted before
+    the photo store existed still keep their photo in the Ticket table
+
+    :param session: database session
+    :param ticket: ticket row with at least ticketID and photoDigest loaded
+    :param variant: variant of the photo to prefer (normalized or thumbnail), None for the original
+    :return: bytes of the photo, None if the ticket has no photo
+    """
+    if ticket.photoDigest:
+        with photo_store.open_best(ticket.photoDigest, variant) as photo_file:
+            return photo_file.read()
+
+    legacy = session.query(Ticket.photo).filter(Ticket.ticketID == ticket.ticketID).first()
+    return legacy.photo if legacy is not None else None
+
+
+# File extensions used for exported photos by content type
+EXTENSIONS = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/gif': 'gif'
+}
+
+
+class ExportStats(object):
+    """
+    Thread safe counters of an export
+    """
+    def __init__(self):
+        self.exported = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, exported=0, skipped=0, failed=0, size=0):
+        with self._lock:
+            self.exported += exported
+            self.skipped += skipped
+            self.failed += failed
+            self.bytes += size
+
+    def report(self):
+        """
+        :return: a line describing the progress and throughput of the export
+        """
+        elapsed = max(time.time() - self.started, 0.001)
+        return 'exported={exported} skipped={skipped} failed={failed} {mb:.1f}MB in {elapsed:.1f}s ' \
+               '({rate:.1f} photos/s, {mbps:.2f} MB/s)'.format(
+                   exported=self.exported,
+                   skipped=self.skipped,
+                   failed=self.failed,
+                   mb=self.bytes / 1048576.0,
+                   elapsed=elapsed,
+                   rate=self.exported / elapsed,
+                   mbps=self.bytes / 1048576.0 / elapsed
+               )
+
+
+def export_photo(directory, ticket_id, digest, content_type, data, stats):
+    """
+    Write one ticket's photo to the export directory as <ticketID>.<extension>. Photos that were already
+    exported are skipped, partially written files never take the final name so an export may be resumed
+
+    :param directory: directory to export to
+    :param ticket_id: id of the ticket
+    :param digest: digest of the photo in the photo store, None for photos kept in the Ticket table
+    :param content_type: content type of the photo, may be None
+    :param data: photo bytes of tickets that keep their photo in the Ticket table
+    :param stats: ExportStats to update
+    """
+    try:
+        if digest and photo_store.best_variant(digest) is not None:
+            # The original was dropped after it was re-encoded, its normalized variant is exported instead
+            content_type = 'image/jpeg'
+        if not content_type:
+            content_type = sniff_content_type(data[:16] if data else b'')
+        path = os.path.join(directory, '{id}.{ext}'.format(id=ticket_id, ext=EXTENSIONS.get(content_type, 'bin')))
+        if os.path.exists(path):
+            stats.add(skipped=1)
+            return
+
+        partial = path + '.part'
+        with open(partial, 'wb') as export_file:
+            if digest:
+                with photo_store.open_best(digest) as photo_file:
+                    shutil.copyfileobj(photo_file, export_file)
+            else:
+                export_file.write(data)
+            size = export_file.tell()
+        os.replace(partial, path)
+        stats.add(exported=1, size=size)
+    except Exception as e:
+        logger.exception(e)
+        stats.add(failed=1)
+
+
+def run_export(args):
+    """
+    Export the photos of every ticket in the selected id and date range. Rows are streamed from the database
+    in batches with only the id, digest and (for old tickets) photo bytes loaded, files are written by a pool
+    of threads and at most a few batches are in flight at any time
+
+    :param args: parsed command line arguments
+    """
+    os.makedirs(args.export, exist_ok=True)
+    stats = ExportStats()
+    in_flight = threading.BoundedSemaphore(args.workers * 4)
+
+    def done(future):
+        in_flight.release()
+
+    with DB() as s:
+        query = s.query(Ticket.ticketID, Ticket.photoDigest, Ticket.photoContentType, Ticket.photo)\
+            .filter((Ticket.photoDigest != None) | (Ticket.photo != None))
+        if args.from_id is not None:
+            query = query.filter(Ticket.ticketID >= args.from_id)
+        if args.to_id is not None:
+            query = query.filter(Ticket.ticketID <= args.to_id)
+        if args.since is not None:
+            query = query.filter(Ticket.creationTime >= args.since)
+        if args.until is not None:
+            query = query.filter(Ticket.creationTime < args.until)
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for count, row in enumerate(query.order_by(Ticket.ticketID).yield_per(args.batch_size), 1):
+                in_flight.acquire()
+                future = executor.submit(
+                    export_photo, args.export, row.ticketID, row.photoDigest, row.photoContentType, row.photo, stats
+                )
+                future.add_done_callback(done)
+
+                if count % 1000 == 0:
+                    print(stats.report())
+
+    print(stats.report())
+    logger.info('Photo export to {directory}: {report}'.format(directory=args.export, report=stats.report()))
+
+
+def parse_date(value):
+    """
+    :param value: date in the format YYYY-MM-DD
+    :return: the date as a datetime
+    """
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
 if __name__ == '__main__':
     # Create our arguement parser
     parser = argparse.ArgumentParser(
@@ -54,27 +212,98 @@ if __name__ == '__main__':
             '{location}. If the directory does not exist, it will be created.'.format(location=PHOTO_LOCATION)
         ])
     )
+    parser.add_argument(
+        '--variant', '-v',
+        choices=['normalized', 'thumbnail'],
+        help='Use this variant of the photo instead of the original, if it has been made'
+    )
     parser.add_argument(
         '--display', '-d',
         action='store_true',
         help='Display the photo via ImageMagick, requires a display of some sort whether it be SSH X forwarding, etc.'
     )
 
+    parser.add_argument(
+        '--export', '-e',
+        metavar='directory',
+        help=' '.join([
+            'Export the photos of many tickets into a directory as <ticketID>.<extension> instead of handling a',
+            'single ticket. Photos already in the directory are skipped so an interrupted export may be resumed.'
+        ])
+    )
+    parser.add_argument(
+        '--from-id',
+        dest='from_id',
+        metavar='1',
+        type=int,
+        help='with --export, the first ticket id to export'
+    )
+    parser.add_argument(
+        '--to-id',
+        dest='to_id',
+        metavar='888',
+        type=int,
+        help='with --export, the last ticket id to export'
+    )
+    parser.add_argument(
+        '--since',
+        metavar='YYYY-MM-DD',
+        type=parse_date,
+        help='with --export, only export tickets created on or after this date'
+    )
+    parser.add_argument(
+        '--until',
+        metavar='YYYY-MM-DD',
+        type=parse_date,
+        help='with --export, only export tickets created before this date'
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        metavar='8',
+        type=int,
+        default=8,
+        help='with --export, number of threads writing files'
+    )
+    parser.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        metavar='100',
+        type=int,
+        default=100,
+        help='with --export, number of rows fetched from the database at a time'
+    )
+
     # Parse the current command line arguments
     args = parser.parse_args()
 
+    # Bind the database to an app, the tool does not serve any routes
+    create_app(blueprints=[])
+
+    if args.export:
+        try:
+            run_export(args)
+        except KeyboardInterrupt as e:
+            print('Exiting on user command')
+        except Exception as e:
+            logger.exception(e)
+            print('Something went wrong exporting photos, check logs: {logfile}'.format(logfile=LOG_FILE))
+            exit(1)
+        exit(0)
+
     try:
         with DB() as s:
+            # Only the id and digest are loaded, the photo itself is read through the photo store
+            query = s.query(Ticket.ticketID, Ticket.photoDigest)
             if args.ticket_id is None:
                 # If we don't have a ticket_id, grab the last one
-                ticket = s.query(Ticket).order_by(desc(Ticket.ticketID)).first()
+                ticket = query.order_by(desc(Ticket.ticketID)).first()
             else:
                 # Open a query for the selected ticket
-                ticket = s.query(Ticket).filter(Ticket.ticketID == args.ticket_id).first()
+                ticket = query.filter(Ticket.ticketID == args.ticket_id).first()
                 
             if ticket is not None:
                 # Here we take in the photo and get the PIL image associated with it
-                img_data = ticket.photo
+                img_data = get_photo_data(s, ticket, args.variant)
                 if not img_data:
                     print('image is empty')
                     logger.info('image is empty')
@@ -0,0 +1,105 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from ticketapi.datalayer import *
+from ticketapi.data.imaging import make_variants
+from ticketapi.data.logger import logger
+from ticketapi.data import LOG_FILE
+from ticketapi.apps import create_app
+
+
+def photo_digests(batch_size):
+    """
+    Walk the distinct photo digests of every ticket in order, one small query per batch
+
+    :param batch_size: number of digests read per query
+    :return: generator of lists of photo digests
+    """
+    last = ''
+    while True:
+        with DB() as s:
+            digests = [row.photoDigest for row in s.query(Ticket.photoDigest)
+                       .filter(Ticket.photoDigest > last)
+                       .distinct()
+                       .order_by(Ticket.photoDigest)
+                       .limit(batch_size)]
+        if not digests:
+            return
+        yield digests
+        last = digests[-1]
+
+
+def backfill(digest):
+    """
+    :param digest: digest of the photo
+    :return: tuple (digest, list of the variants made or None if the photo could not be processed)
+    """
+    try:
+        return digest, make_variants(digest)
+    except Exception as e:
+        logger.error('Unable to make variants for photo {digest}'.format(digest=digest))
+        logger.exception(e)
+        return digest, None
+
+
+if __name__ == '__main__':
+    # Create our argument parser
+    parser = argparse.ArgumentParser(
+        description=' '.join([
+            'Tool to make the variants of every ticket photo that does not have them yet, such as photos whose',
+            'image worker died or that were submitted while image_workers was 0. Originals are dropped once',
+            'their normalized variant exists if keep_original_photos is turned off. Photos that already have',
+            'their variants are skipped, so this may be ran again at any time.'
+        ])
+    )
+
+    # Add arguments to be parsed
+    parser.add_argument(
+        '--batch-size', '-b',
+        dest='batch_size',
+        metavar='500',
+        type=int,
+        default=500,
+        help='number of photo digests read from the database per query'
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        metavar='1',
+        type=int,
+        default=1,
+        help='number of processes re-encoding photos'
+    )
+
+    args = parser.parse_args()
+
+    # Bind the database to an app, the tool does not serve any routes
+    create_app(blueprints=[])
+
+    started = time.time()
+    made = skipped = failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            # One batch is in flight at a time so the digests are never all held in memory
+            for digests in photo_digests(args.batch_size):
+                for digest, variants in executor.map(backfill, digests, chunksize=16):
+                    if variants is None:
+                        failed += 1
+                    elif variants:
+                        made += 1
+                    else:
+                        skipped += 1
+    except KeyboardInterrupt as e:
+        print('Exiting on user command')
+    except Exception as e:
+        logger.exception(e)
+        print('Something went wrong making variants, check logs: {logfile}'.format(logfile=LOG_FILE))
+        exit(1)
+
+    print('made={made} skipped={skipped} failed={failed} in {elapsed:.1f}s'.format(
+        made=made,
+        skipped=skipped,
+        failed=failed,
+        elapsed=time.time() - started
+    ))
+    if failed:
+        exit(1)
@@ -1,8 +1,13 @@
-from ticketapi.apps import app
+from flask import Blueprint
 
+__all__ = ['nossl_api']
 
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>/', strict_slashes=False)
+# Routes of the nossl application, registered on it by create_app
+nossl_api = Blueprint('nossl', __name__)
+
+
+@nossl_api.route('/', defaults={'path': ''})
+@nossl_api.route('/<path:path>/', strict_slashes=False)
 def nossl(path):
     """
     Return a message stating that we are unable to serve the client because they are not secured via SSL
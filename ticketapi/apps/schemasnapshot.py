@@ -0,0 +1,81 @@
+import argparse
+from sqlalchemy import create_engine
+from ticketapi.datalayer.snapshot import *
+from ticketapi.data.logger import logger
+from ticketapi.data import LOG_FILE
+from ticketapi.apps import create_app
+
+
+if __name__ == '__main__':
+    # Create our argument parser
+    parser = argparse.ArgumentParser(
+        description=' '.join([
+            'Tool to manage the schema snapshot the models are built from. The API loads the snapshot at',
+            'startup instead of reflecting the schema from the database, it must be regenerated after every',
+            'migration. "generate" reflects the live schema into the snapshot, "verify" compares the snapshot',
+            'with the live schema and exits with status 1 if they differ.'
+        ])
+    )
+
+    # Add arguments to be parsed
+    parser.add_argument(
+        'command',
+        choices=['generate', 'verify'],
+        help='generate the snapshot or verify it against the live schema'
+    )
+    parser.add_argument(
+        '--file', '-f',
+        dest='path',
+        metavar=snapshot_file(),
+        default=snapshot_file(),
+        help='snapshot file to write or verify'
+    )
+
+    args = parser.parse_args()
+
+    # The tool does not serve any routes, and does not map the models so that it still runs on the schema they
+    # refuse to start on. The live schema is reflected with an engine of its own
+    create_app(blueprints=[], database=False)
+
+    try:
+        from ticketapi.datalayer.models import database_uri
+        engine = create_engine(database_uri())
+        try:
+            live = reflect_metadata(engine)
+        finally:
+            engine.dispose()
+
+        missing = missing_columns(live)
+        for column in missing:
+            print('column {column} is required but missing from the database'.format(column=column))
+
+        if args.command == 'generate':
+            if missing:
+                print('The database is missing required columns, apply the migrations first')
+                exit(1)
+            save_snapshot(live, args.path)
+            print('Saved {count} tables to {path}'.format(count=len(live.tables), path=args.path))
+        else:
+            snapshot = load_snapshot(args.path)
+            if snapshot is None:
+                print('There is no usable snapshot at {path}, run "generate"'.format(path=args.path))
+                exit(1)
+
+            differences = diff_metadata(snapshot[0], live)
+            for difference in differences:
+                print(difference)
+
+            if differences:
+                print('The snapshot from {created} does not match the database, run "generate"'.format(
+                    created=snapshot[1]
+                ))
+                exit(1)
+            if missing:
+                print('The snapshot from {created} matches the database, but the database is missing columns, '
+                      'apply the migrations and run "generate"'.format(created=snapshot[1]))
+                exit(1)
+            print('The snapshot from {created} matches the database'.format(created=snapshot[1]))
+    except Exception as e:
+        logger.exception(e)
+        print('Something went wrong with the schema snapshot, check logs: {logfile}'.format(logfile=LOG_FILE))
+        exit(1)
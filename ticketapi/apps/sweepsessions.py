@@ -0,0 +1,80 @@
+import argparse
+import time
+from ticketapi.datalayer.procedures import sweep_sessions
+from ticketapi.datalayer.procedures import purge_spool
+from ticketapi.datalayer.procedures import sweep_orphan_photos
+from ticketapi.data import SETTINGS
+from ticketapi.data.staging import chunked_uploads
+from ticketapi.data.logger import logger
+from ticketapi.data import LOG_FILE
+from ticketapi.apps import create_app
+
+
+if __name__ == '__main__':
+    # Create our argument parser
+    parser = argparse.ArgumentParser(
+        description=' '.join([
+            'Tool to delete expired sessions from the Session table. Sessions are deleted in small batches that',
+            'are each committed on their own so the live table is never locked for long. This may be ran once',
+            'from cron or left running in the background with --interval. Chunked photo uploads that expired',
+            'without being finalized are removed from the staging directory as well, and tickets that were',
+            'written from the ingest spool longer ago than ingest_retention are purged from it. Photos that no',
+            'ticket refers to (such as the photo of a ticket whose insert failed) are deleted from the photo store',
+            'once they are older than orphan_photo_grace.'
+        ])
+    )
+
+    # Add arguments to be parsed
+    parser.add_argument(
+        '--batch-size', '-b',
+        dest='batch_size',
+        metavar='500',
+        type=int,
+        default=500,
+        help='number of sessions to delete per transaction'
+    )
+    parser.add_argument(
+        '--pause', '-p',
+        metavar='0.5',
+        type=float,
+        default=0.5,
+        help='number of seconds to sleep between batches to give other queries room'
+    )
+    parser.add_argument(
+        '--interval', '-i',
+        metavar='3600',
+        type=int,
+        help='keep running and sweep again every this many seconds'
+    )
+
+    args = parser.parse_args()
+
+    # Bind the database to an app, the tool does not serve any routes
+    create_app(blueprints=[])
+
+    try:
+        while True:
+            total = 0
+            while True:
+                deleted = sweep_sessions(batch_size=args.batch_size, max_batches=1)
+                total += deleted
+                if deleted < args.batch_size:
+                    break
+                time.sleep(args.pause)
+
+            print('Deleted {total} expired sessions'.format(total=total))
+            print('Deleted {total} expired uploads'.format(total=chunked_uploads.sweep()))
+            print('Purged {total} finished spooled tickets'.format(total=purge_spool()))
+            print('Deleted {total} orphaned photos'.format(
+                total=sweep_orphan_photos(grace=SETTINGS.get('orphan_photo_grace', 86400))
+            ))
+
+            if args.interval is None:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt as e:
+        print('Exiting on user command')
+    except Exception as e:
+        logger.exception(e)
+        print('Something went wrong sweeping sessions, check logs: {logfile}'.format(logfile=LOG_FILE))
+        exit(1)
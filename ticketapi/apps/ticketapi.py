@@ -1,14 +1,63 @@
+from flask import Blueprint
 from flask import request
 from flask import jsonify
-from ticketapi.apps import app
+from ticketapi.apps import create_app
 from ticketapi.data.decorators import *
+from ticketapi.data.context import request_context
 from ticketapi.data.validators import *
+from ticketapi.data.fields import ValidationError
 from ticketapi.datalayer.procedures import *
 from ticketapi.data.response import FailureResponse
+from ticketapi.data.response import FAILURES
+from ticketapi.data.crypto import CryptoBusyError
+from ticketapi.data.ratelimit import login_company_limiter
+from ticketapi.data.ratelimit import login_ip_limiter
+from ticketapi.data.uploads import UploadTooLarge
+from ticketapi.data.uploads import is_binary_upload
+from ticketapi.data.uploads import store_photo
+from ticketapi.data.uploads import max_photo_bytes
+from ticketapi.data.limits import *
+from ticketapi.data.downloads import send_stream
+from ticketapi.data.staging import *
+from ticketapi.data.photostore import photo_store
 from ticketapi.data.logger import logger
+from ticketapi.data.stats import StatsLogger
+from ticketapi.data.fields import validation_cache_stats
+from ticketapi.data import SETTINGS
 
+# Routes of the API, registered on the application by create_app
+api = Blueprint('ticketapi', __name__)
 
-@app.route('/', methods=['GET', 'POST'])
+
+@api.record_once
+def start_ingest(state):
+    """
+    Start writing spooled tickets to the database as soon as the API is registered on an app, tickets left in the
+    spool by a restart do not wait for the next one to arrive
+
+    :param state: flask's BlueprintSetupState
+    """
+    start_spool_writer()
+
+
+@api.record_once
+def start_stats_log(state):
+    """
+    Log this process's rejection counters and cache hit rates every stats_log_interval seconds, 0 turns it off
+
+    :param state: flask's BlueprintSetupState
+    """
+    interval = SETTINGS.get('stats_log_interval', 300)
+    if interval > 0:
+        StatsLogger({
+            'rejections': rejections.stats,
+            'validationCaches': validation_cache_stats,
+            'authCache': auth_cache.stats,
+            'credentialCache': credential_cache.stats
+        }, interval=interval).start()
+
+
+@api.route('/', methods=['GET', 'POST'])
 def home():
     """
     Home page
@@ -18,8 +67,32 @@ def home():
     return 'Welcome to Ticket-API!'
 
 
-@app.route('/login/', methods=['POST'], strict_slashes=False)
+@api.app_errorhandler(UploadTooLarge)
+def body_too_large(e):
+    """
+    Body Too Large answers requests whose body was cut off while being read because it went past the limit of its
+    route (see limits_body), such as a chunked body without a Content-Length
+
+    :param e: the UploadTooLarge that was raised
+    :return: a 413 failure response
+    """
+    rejections.increment(request.endpoint, 'too_large')
+    return FailureResponse(
+        error_code=413,
+        nice_message='The request is too large',
+        debug_message='Request body rejected: {reason}'.format(reason=e)
+    ).response()
+
+
+@api.route('/login/', methods=['POST'], strict_slashes=False)
+@limits_body(max_json_body_bytes)
+@requires_rate_limit(login_ip_limiter, lambda r: r.remote_addr)
 @requires_validation(AuthInfoValidator)
+@requires_rate_limit(
+    login_company_limiter,
+    lambda r: request_context().data['companyID'].upper(),
+    failures_only=True
+)
 def login_route():
     """
     Login page will authorize a customer given a set of credentials. If there is success, an authKey will
@@ -28,31 +101,50 @@ def login_route():
 
     :return: a response object with the appropriate body and response code
     """
-    json_data = request.get_json(force=True)
-
     try:
-        result = authenticate(**json_data)
+        result = authenticate(**request_context().data)
+    except CryptoBusyError as e:
+        logger.warning(e)
+        return FAILURES['crypto_busy'].response()
     except Exception as e:
         logger.exception(e)
-        return FailureResponse(
-            error_code=520,
-            nice_message='An error occurred while authenticating you',
-            debug_message='An exception occurred while trying to query the database'
-        ).response()
+        return FAILURES['login_unavailable'].response()
 
     if result is False:
-        return FailureResponse(
-            error_code=401,
-            nice_message='The company ID or password was incorrect, please try again',
-            debug_message='Invalid company ID or password'
-        ).response()
+        return FAILURES['invalid_credentials'].response()
 
     return jsonify(authKey=result)
 
 
-@app.route('/update-employee/', methods=['POST'], strict_slashes=False)
+@api.route('/logout/', methods=['POST'], strict_slashes=False)
+@limits_body(max_json_body_bytes)
+@requires_validation(LogoutValidator)
 @requires_auth
+def logout_route():
+    """
+    Logout revokes the authKey (or signed token) sent with the request, it is put on the deny list and is no longer
+    accepted by any route.
+
+    :return: an empty json body response on success and standard failure response json on failure.
+    """
+    context = request_context()
+
+    try:
+        result = revoke_auth(session=context.session, **context.data)
+    except Exception as e:
+        logger.exception(e)
+        return FAILURES['logout_unavailable'].response()
+
+    if result is False:
+        return FAILURES['session_not_found'].response()
+
+    return jsonify({})
+
+
+@api.route('/update-employee/', methods=['POST'], strict_slashes=False)
+@limits_body(max_json_body_bytes)
 @requires_validation(EmployeeInfoValidator)
+@requires_auth
 def update_employee_route():
     """
     Update Employee will update employee information in the database with an associated session id (authKey). This
@@ -62,63 +154,405 @@ def update_employee_route():
     :return: an empty json body response on success and standard failure response json on failure.
     """
 
-    json_data = request.get_json(force=True)
+    context = request_context()
 
     try:
-        result = update_employee(**json_data)
+        result = update_employee(session=context.session, **context.data)
     except Exception as e:
         logger.exception(e)
-        return FailureResponse(
-            error_code=520,
-            nice_message='An error occurred while updating your information',
-            debug_message='The database server is not responding or is down.'
-        ).response()
+        return FAILURES['update_employee_unavailable'].response()
 
     if result is False:
-        return FailureResponse(
-            error_code=401,
-            nice_message='There was an error authenticating your request',
-            debug_message='Session ID not found.'
-        ).response()
+        return FAILURES['session_not_found'].response()
 
     else:
         return jsonify({})
 
 
-@app.route('/submit-ticket/', methods=['POST'], strict_slashes=False)
-@requires_auth
+@api.route('/submit-ticket/', methods=['POST'], strict_slashes=False)
+@limits_body(max_photo_body_bytes)
 @requires_validation(TicketInfoValidator)
+@requires_auth
 def submit_ticket_route():
     """
     Submit Ticket will submit a ticket to the database. This function requires authentication before being ran and
     must be passed an authKey in the json body in order to run. If all information is validated, this function will
     submit the ticket to the database using submit_ticket.
 
+    The photo may also be sent as raw bytes instead of base64 in the JSON body, either as the `photo` part of a
+    multipart/form-data body (the other fields being form fields) or as an application/octet-stream body (the
+    other fields being query string parameters).
+
+    When async_ingest is enabled the ticket is only written to the local spool, the response is then a 202 with a
+    `receipt` that may be passed to /ticket-status/ to follow the ticket into the database.
+
     :return: an empty json body response on success and standard failure response json on failure.
     """
 
-    ticket_data = request.get_json(force=True)
+    # the photo in the validated data has already been decoded
+    context = request_context()
+    ticket_data = dict(context.data, session=context.session)
 
     try:
-        result = submit_ticket(**ticket_data)
+        if is_binary_upload(request):
+            ticket_data['storedPhoto'] = store_photo(request, photo_store)
+    except UploadTooLarge as e:
+        rejections.increment(request.endpoint, 'too_large')
+        return FailureResponse(
+            error_code=413,
+            nice_message='The photo is too large',
+            debug_message='Photo upload rejected: {reason}'.format(reason=e)
+        ).response()
+
+    try:
+        if async_ingest():
+            result = spool_ticket(**ticket_data)
+        else:
+            result = submit_ticket(**ticket_data)
+    except Exception as e:
+        logger.exception(e)
+        return FAILURES['submit_ticket_unavailable'].response()
+
+    if result is False:
+        return FAILURES['invalid_ticket'].response()
+
+    if async_ingest():
+        response = jsonify(receipt=result)
+        response.status_code = 202
+        return response
+
+    return jsonify({})
+
+
+@api.route('/ticket-status/', methods=['POST'], strict_slashes=False)
+@limits_body(max_json_body_bytes)
+@requires_validation(ReceiptValidator)
+@requires_auth
+def ticket_status_route():
+    """
+    Ticket Status will look up the progress of a ticket that was accepted with a receipt (see async_ingest).
+    The ticket must have been submitted under the same session as the authKey passed in.
+
+    :return: a json body with the `status` (pending, claimed, submitted or failed) and `attempts` of the ticket on
+        success and standard failure response json on failure.
+    """
+
+    context = request_context()
+
+    try:
+        result = spooled_ticket_status(session=context.session, **context.data)
     except Exception as e:
         logger.exception(e)
+        return FAILURES['ticket_status_unavailable'].response()
+
+    if result is None:
+        return FAILURES['receipt_not_found'].response()
+
+    return jsonify(result)
+
+
+@api.route('/submit-tickets/', methods=['POST'], strict_slashes=False)
+@limits_body(max_batch_body_bytes)
+@requires_validation(BatchTicketValidator)
+@requires_auth
+def submit_tickets_route():
+    """
+    Submit Tickets will submit many tickets to the database at once, such as the tickets a client queued up while it
+    was offline. The tickets are passed as a `tickets` array under a single authKey. Each ticket is validated on its
+    own, every valid ticket is submitted in one transaction and invalid tickets are skipped.
+
+    :return: a json body with a `results` array holding a status for each ticket on success and standard failure
+        response json on failure.
+    """
+
+    context = request_context()
+    auth_key = context.data['authKey']
+    results = []
+    tickets = []
+
+    for index, item in enumerate(context.data['tickets']):
+        try:
+            tickets.append(BatchTicketValidator.ticket.check(item))
+            results.append({'status': 'submitted'})
+        except ValidationError as e:
+            results.append({
+                'status': 'invalid',
+                'debugMessage': 'Field {name} is invalid: {reason}'.format(
+                    name=e.name.replace('tickets', 'tickets[{index}]'.format(index=index), 1),
+                    reason=e.message
+                )
+            })
+
+    if tickets:
+        try:
+            result = submit_tickets(authKey=auth_key, session=context.session, tickets=tickets)
+        except Exception as e:
+            logger.exception(e)
+            return FAILURES['submit_tickets_unavailable'].response()
+
+        if result is False:
+            return FAILURES['session_not_found'].response()
+
+    return jsonify(results=results)
+
+
+@api.route('/tickets/', methods=['POST'], strict_slashes=False)
+@limits_body(max_json_body_bytes)
+@requires_validation(TicketListValidator)
+@requires_auth
+def list_tickets_route():
+    """
+    Tickets will list the tickets of the company the authKey belongs to, newest first. At most `limit` tickets are
+    returned per call, the `nextCursor` of a response may be passed as `cursor` to get the next page. Tickets may be
+    filtered by `since`, `until` and `location`, photos are only included if `includePhoto` is true.
+
+    :return: a json body with the `tickets` and the `nextCursor` on success and standard failure response json on
+        failure.
+    """
+
+    context = request_context()
+
+    try:
+        result = list_tickets(session=context.session, **context.data)
+    except ValueError as e:
         return FailureResponse(
-            error_code=520,
-            nice_message='There was trouble submitting your ticket to the database',
-            debug_message='Unable to reach the database.'
+            error_code=400,
+            nice_message='Field cursor is invalid',
+            debug_message=str(e)
         ).response()
+    except Exception as e:
+        logger.exception(e)
+        return FAILURES['list_tickets_unavailable'].response()
 
-    if result is False:
+    if result is None:
+        return FAILURES['session_not_found'].response()
+
+    return jsonify(result)
+
+
+@api.route('/tickets/<int:ticket_id>/photo', methods=['GET'], strict_slashes=False)
+@limits_body(max_json_body_bytes)
+@requires_validation(PhotoRequestValidator)
+@requires_auth
+def ticket_photo_route(ticket_id):
+    """
+    Ticket Photo will send the photo of a ticket as raw bytes. The authKey must be passed as an
+    `Authorization: Bearer <authKey>` header, it is not accepted in the query string where it would end up in
+    access logs. `?variant=thumbnail` selects the thumbnail instead of the original photo. The ticket must belong
+    to the same company as the authKey.
+
+    The response carries a strong ETag derived from the photo's digest, a request whose If-None-Match holds it gets
+    a 304 without a body and without the photo being opened. A single byte range may be requested with a Range
+    header to resume a download.
+
+    :param ticket_id: ID of the ticket whose photo is sent
+    :return: the photo on success and standard failure response json on failure.
+    """
+
+    context = request_context()
+
+    try:
+        result = open_ticket_photo(ticketID=ticket_id, session=context.session, **context.data)
+    except ValueError as e:
         return FailureResponse(
             error_code=400,
-            nice_message='There was trouble submitting your ticket to the database. The data may be invalid.',
-            debug_message='Malformed/Invalid data request sent to database'
+            nice_message='Field variant is invalid',
+            debug_message=str(e)
+        ).response()
+    except Exception as e:
+        logger.exception(e)
+        return FAILURES['photo_unavailable'].response()
+
+    if result is None:
+        return FailureResponse(
+            error_code=404,
+            nice_message='The photo could not be found',
+            debug_message='No photo for ticket {id} in this company'.format(id=ticket_id)
+        ).response()
+
+    return send_stream(request, result['open'], result['etag'], result['contentType'])
+
+
+def upload_failure(e):
+    """
+    Create the failure response of a chunked upload error
+
+    :param e: the UploadError or UploadTooLarge that was raised
+    :return: a response object with the appropriate body and response code
+    """
+    if isinstance(e, UploadTooLarge):
+        rejections.increment(request.endpoint, 'too_large')
+        return FailureResponse(
+            error_code=413,
+            nice_message='The photo is too large',
+            debug_message='Upload rejected: {reason}'.format(reason=e)
         ).response()
+    if isinstance(e, UploadOffsetError):
+        return FailureResponse(
+            error_code=409,
+            nice_message='Part of the photo is missing, please resume from the returned offset',
+            debug_message=str(e)
+        ).response(headers={'Upload-Offset': str(e.offset)})
+    if isinstance(e, UploadIncomplete):
+        return FailureResponse(
+            error_code=409,
+            nice_message='The photo has not been completely uploaded',
+            debug_message=str(e)
+        ).response()
+    if isinstance(e, ChecksumMismatch):
+        return FailureResponse(
+            error_code=422,
+            nice_message='The photo was damaged while uploading, please upload it again',
+            debug_message='Checksum mismatch: {reason}'.format(reason=e)
+        ).response()
+    return FailureResponse(
+        error_code=404,
+        nice_message='The upload could not be found',
+        debug_message='Upload {id} not found or expired'.format(id=e)
+    ).response()
+
+
+@api.route('/uploads/', methods=['POST'], strict_slashes=False)
+@limits_body(max_json_body_bytes)
+@requires_validation(UploadCreateValidator)
+@requires_auth
+def create_upload_route():
+    """
+    Uploads starts a chunked upload of a ticket's photo, meant for large photos sent over unreliable links. The
+    body holds the `size` of the photo in bytes, its hex `sha256` digest and the ticket's `description` and
+    `location`. The photo is then sent with PUT /uploads/<uploadID> and the ticket is submitted by
+    POST /uploads/<uploadID>/finalize.
+
+    :return: a json body with the `uploadID` on success and standard failure response json on failure.
+    """
+
+    context = request_context()
+
+    try:
+        result = create_upload(session=context.session, **context.data)
+    except (UploadError, UploadTooLarge) as e:
+        return upload_failure(e)
+    except Exception as e:
+        logger.exception(e)
+        return FAILURES['create_upload_unavailable'].response()
+
+    if result is None:
+        return FAILURES['session_not_found'].response()
+
+    response = jsonify(uploadID=result, offset=0)
+    response.status_code = 201
+    return response
+
+
+@api.route('/uploads/<upload_id>', methods=['GET'], strict_slashes=False)
+@limits_body(max_json_body_bytes)
+@requires_validation(UploadValidator)
+@requires_auth
+def upload_status_route(upload_id):
+    """
+    Upload Status tells how much of a photo has been received, a client that lost its connection resumes its upload
+    from the returned `offset`.
+
+    :param upload_id: id of the upload
+    :return: a json body with the `offset` and `size` of the upload on success and standard failure response json
+        on failure.
+    """
+
+    context = request_context()
+
+    try:
+        result = upload_status(uploadID=upload_id, session=context.session, **context.data)
+    except (UploadError, UploadTooLarge) as e:
+        return upload_failure(e)
+    except Exception as e:
+        logger.exception(e)
+        return FAILURES['upload_status_unavailable'].response()
+
+    if result is None:
+        return FAILURES['session_not_found'].response()
+
+    return jsonify(result)
+
+
+@api.route('/uploads/<upload_id>', methods=['PUT'], strict_slashes=False)
+@limits_body(max_photo_bytes)
+@requires_validation(UploadValidator)
+@requires_auth
+def upload_chunk_route(upload_id):
+    """
+    Upload Chunk writes a piece of a photo. The body is the raw bytes (application/octet-stream) and the
+    `Upload-Offset` header the position of its first byte in the photo, the authKey is passed as an
+    `Authorization: Bearer <authKey>` header or in the query string. A chunk may start anywhere up to the number of
+    bytes received so far, sending a chunk again simply overwrites it.
+
+    :param upload_id: id of the upload
+    :return: a json body with the new `offset` on success and standard failure response json on failure.
+    """
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return FAILURES['invalid_upload_offset'].response()
+
+    context = request_context()
+
+    try:
+        result = write_upload_chunk(
+            uploadID=upload_id,
+            offset=offset,
+            stream=request.stream,
+            session=context.session,
+            **context.data
+        )
+    except (UploadError, UploadTooLarge) as e:
+        return upload_failure(e)
+    except Exception as e:
+        logger.exception(e)
+        return FAILURES['upload_chunk_unavailable'].response()
+
+    if result is None:
+        return FAILURES['session_not_found'].response()
+
+    response = jsonify(offset=result)
+    response.headers['Upload-Offset'] = str(result)
+    return response
+
+
+@api.route('/uploads/<upload_id>/finalize', methods=['POST'], strict_slashes=False)
+@limits_body(max_json_body_bytes)
+@requires_validation(UploadValidator)
+@requires_auth
+def finalize_upload_route(upload_id):
+    """
+    Finalize Upload checks a complete photo against the sha256 digest it was started with and submits its ticket,
+    just like /submit-ticket/. With async_ingest enabled the response is a 202 with a `receipt`.
+
+    :param upload_id: id of the upload
+    :return: an empty json body response on success and standard failure response json on failure.
+    """
+
+    context = request_context()
+
+    try:
+        result = finalize_upload(uploadID=upload_id, session=context.session, **context.data)
+    except (UploadError, UploadTooLarge) as e:
+        return upload_failure(e)
+    except Exception as e:
+        logger.exception(e)
+        return FAILURES['submit_ticket_unavailable'].response()
+
+    if result is None or result is False:
+        return FAILURES['session_not_found'].response()
+
+    if async_ingest():
+        response = jsonify(receipt=result)
+        response.status_code = 202
+        return response
 
     return jsonify({})
 
 
 if __name__ == '__main__':
+    app = create_app()
     app.debug = True
     app.run(port=50443)
@@ -1,15 +1,68 @@
 import os
 import json
+import threading
 
 __version__ = '0.1.0'
-__all__ = ['fields', 'response', 'logger', 'validators', 'decorators']
+__all__ = ['cache', 'fields', 'response', 'logger', 'validators', 'decorators']
 
 
-# Common variables for file locations
+# Common variables for file locations, the settings file may be moved with the TICKET_API_SETTINGS variable
 TICKET_API_ROOT = '/var/www/html/ticketapi'
-SETTINGS_FILE = os.path.join(TICKET_API_ROOT, 'settings.json')
+SETTINGS_FILE = os.environ.get('TICKET_API_SETTINGS', os.path.join(TICKET_API_ROOT, 'settings.json'))
 LOG_FILE = '/var/log/ticket-api/ticket-api.log'
 
-# Open the file and read it's json contents into SETTINGS
-with open(SETTINGS_FILE, 'r') as settings:
-    SETTINGS = json.loads(settings.read())
+
+class Settings(object):
+    """
+    The settings of the API. They are read from SETTINGS_FILE the first time one of them is used, unless they
+    were given to `configure` first, so importing a module does not require the settings file to exist.
+    Settings are read like a dictionary.
+    """
+
+    def __init__(self):
+        self._values = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        :return: the settings dictionary, read from SETTINGS_FILE if they were not configured
+        """
+        values = self._values
+        if values is None:
+            with self._lock:
+                if self._values is None:
+                    # Open the file and read it's json contents
+                    with open(SETTINGS_FILE, 'r') as settings:
+                        self._values = json.loads(settings.read())
+                values = self._values
+        return values
+
+    def configure(self, values):
+        """
+        Use a dictionary of settings instead of the settings file. This must be called before the app is created,
+        the datalayer's models are mapped from the schema snapshot named by the settings when it is
+
+        :param values: dictionary of settings
+        """
+        with self._lock:
+            self._values = dict(values)
+
+    @property
+    def loaded(self):
+        """
+        :return: True if the settings have been read or configured
+        """
+        return self._values is not None
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __contains__(self, key):
+        return key in self._load()
+
+
+# Settings of the API, read on first use
+SETTINGS = Settings()
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ['TTLCache']
+
+
+class TTLCache(object):
+    """
+    A small thread safe LRU cache whose entries also expire after a time to live. Once the cache holds
+    `maxsize` entries, the least recently used entry is dropped to make room for a new one.
+
+    :param maxsize: maximum number of entries held by the cache
+    :param ttl: default number of seconds an entry stays valid
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get a value from the cache, expired entries are treated as missing and removed
+
+        :param key: key to look up
+        :param default: value to return if the key is not cached
+        :return: the cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Add or replace a value in the cache
+
+        :param key: key to store the value under
+        :param value: value to store
+        :param ttl: number of seconds this entry stays valid, if not given the cache's ttl is used
+        """
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove a key from the cache if it is there
+
+        :param key: key to remove
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove every entry from the cache
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: dictionary of the hits, misses, hit rate and current size of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries)
+            }
@@ -0,0 +1,61 @@
+from flask import g
+from flask import request
+from ticketapi.data.uploads import request_fields
+
+__all__ = ['RequestContext', 'request_context']
+
+
+class RequestContext(object):
+    """
+    Everything learned about the current request while it makes its way to a view. The body is parsed only once,
+    however many decorators look at it, the validators store the validated (and converted) fields in `data` and
+    requires_auth stores the session the authKey resolved to in `session`. Views read both instead of going back to
+    the request.
+
+    :param current_request: the current flask request
+    """
+
+    def __init__(self, current_request):
+        self.request = current_request
+        self.data = {}
+        self.session = None
+        self._fields = None
+
+    @property
+    def fields(self):
+        """
+        :return: the raw fields of the request as parsed by request_fields, parsed on first use
+        :raises BadRequest: if a JSON body could not be parsed
+        """
+        if self._fields is None:
+            self._fields = request_fields(self.request)
+        return self._fields
+
+    @property
+    def auth_key(self):
+        """
+        :return: authKey of the session the request was authenticated as, the authKey sent with the request if it
+            has not been authenticated (yet)
+        """
+        if self.session is not None:
+            return self.session[0]
+        if 'authKey' in self.data:
+            return self.data['authKey']
+        return self.fields.get('authKey') if isinstance(self.fields, dict) else None
+
+    @property
+    def company_id(self):
+        """
+        :return: companyID of the session the request was authenticated as, None if it has not been authenticated
+        """
+        return self.session[1] if self.session is not None else None
+
+
+def request_context():
+    """
+    :return: the RequestContext of the current request, created on first use
+    """
+    context = getattr(g, 'request_context', None)
+    if context is None:
+        context = g.request_context = RequestContext(request)
+    return context
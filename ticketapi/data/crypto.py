@@ -1,15 +1,24 @@
 import os
 import scrypt
 import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from ticketapi.data import SETTINGS
+from ticketapi.data.lazy import Lazy
+from ticketapi.data.logger import logger
 
-__all__ = ['crypto']
+__all__ = ['crypto', 'crypto_pool', 'CryptoConsts', 'CryptoError', 'CryptoBusyError']
 
 
 class CryptoConsts:
     PEPPER_FILE = 'test-pepper.json'  # location of default JSON pepper file
     HASH_BYTES = 128  # number of bytes for hash
     SALT_BYTES = 128  # number of bytes for salt
+    DEFAULT_N = 1 << 14  # scrypt CPU/memory cost used by rows hashed before cost parameters were stored
+    DEFAULT_R = 8  # scrypt block size used by rows hashed before cost parameters were stored
+    DEFAULT_P = 1  # scrypt parallelization used by rows hashed before cost parameters were stored
 
 
 class CryptoError(Exception):
@@ -20,14 +29,23 @@ class CryptoError(Exception):
         return repr(self.msg)
 
 
+class CryptoBusyError(CryptoError):
+    """
+    Raised when the crypto worker pool has no free slot within the configured queue timeout, or when a
+    worker does not finish a job within the configured job timeout
+    """
+    pass
+
+
 class Crypto:
     """
     Provides wrappers for scrypt that help in hashing and checking passwords with salt and pepper
 
     :param pepper: if specified, use this pepper instead of checking CryptoConsts.PEPPER_FILE
+    :param params: tuple (N, r, p) of scrypt cost parameters used for new hashes
     """
 
-    def __init__(self, pepper=None):
+    def __init__(self, pepper=None, params=None):
         """
         Loads pepper from filesystem
         """
@@ -36,6 +54,11 @@ class Crypto:
         else:
             self.pepper = bytes(pepper, encoding='utf8')
 
+        if params:
+            self.params = tuple(params)
+        else:
+            self.params = (CryptoConsts.DEFAULT_N, CryptoConsts.DEFAULT_R, CryptoConsts.DEFAULT_P)
+
     @staticmethod
     def __get_salt():
         """
@@ -64,23 +87,26 @@ class Crypto:
         except Exception:
             raise CryptoError('Error initializing Crypt')
 
-    def check(self, test_pw, hashed_pw, salt):
+    def check(self, test_pw, hashed_pw, salt, params=None):
         """
         Checks test_pw against hashed_pw by hashing with salt and pepper
         :param test_pw: password to test
         :param hashed_pw: hashed password
         :param salt: salt
+        :param params: tuple (N, r, p) that hashed_pw was created with, defaults to self.params
         :return: whether test_pw matches hashed_pw when hashed with salt
         """
+        n, r, p = params or self.params
         try:
-            test_hashed = scrypt.hash(test_pw, salt + self.pepper, buflen=CryptoConsts.HASH_BYTES)
+            test_hashed = scrypt.hash(test_pw, salt + self.pepper, N=n, r=r, p=p, buflen=CryptoConsts.HASH_BYTES)
             return test_hashed == hashed_pw
         except scrypt.error:
             return False
 
     def hash(self, password):
         """
-        Hashes password with random salt and pepper and returns hashed password and salt
+        Hashes password with random salt and pepper and returns hashed password and salt.
+        The password is hashed with self.params
         :param password: password to hash
         :return: tuple of (hashed, salt) containing the hashed password and generated salt
         """
@@ -89,16 +115,170 @@ class Crypto:
         except NotImplementedError:
             raise CryptoError('Could not encrypt password')
 
-        hashed = scrypt.hash(password, salt + self.pepper, buflen=CryptoConsts.HASH_BYTES)
+        n, r, p = self.params
+        hashed = scrypt.hash(password, salt + self.pepper, N=n, r=r, p=p, buflen=CryptoConsts.HASH_BYTES)
 
         return hashed, salt
 
 
-# Create a package level crypto object that may be used elsewhere
-crypto = Crypto(pepper=SETTINGS['pepper'])
+class CryptoPool:
+    """
+    Runs Crypto.check and Crypto.hash in a dedicated process pool so that scrypt does not tie up the
+    threads serving requests. The number of outstanding jobs is bounded by workers + queue_size, when
+    no slot frees up within queue_timeout seconds a CryptoBusyError is raised instead of queueing forever.
+    A pool that broke because one of its workers died is replaced and the job is tried once more.
+
+    :param crypto: the Crypto object whose check and hash methods will be ran in the pool
+    :param workers: number of worker processes, if 0 the work is done inline on the calling thread
+    :param queue_size: number of jobs that may wait for a worker once all workers are busy
+    :param queue_timeout: number of seconds to wait for a free slot before giving up
+    :param job_timeout: number of seconds to wait for a job to finish before giving up, None to wait forever
+    """
+
+    def __init__(self, crypto, workers=2, queue_size=8, queue_timeout=2.0, job_timeout=30.0):
+        self.crypto = crypto
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.job_timeout = job_timeout
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """
+        Lazily create the process pool, this way processes are only forked once they are needed
+
+        :return: the process pool executor
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _replace_executor(self, executor):
+        """
+        Throw away a process pool that is broken, the next job starts a new one
+
+        :param executor: the broken process pool executor
+        """
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _submit(self, executor, func, *args):
+        """
+        Submit func to the pool once a slot is available, the slot is given back once the job is done
+
+        :param executor: process pool executor to submit to
+        :param func: picklable function to run
+        :param args: arguments to pass to func
+        :return: the future of the job
+        """
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise CryptoBusyError('No crypto worker available within {timeout}s'.format(timeout=self.queue_timeout))
+
+        try:
+            future = executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _run(self, func, *args):
+        """
+        Run func in the pool once a slot is available and wait for its result
+
+        :param func: picklable function to run
+        :param args: arguments to pass to func
+        :return: the return value of func
+        """
+        if self.workers <= 0:
+            return func(*args)
+
+        for retry in (False, True):
+            executor = self._get_executor()
+            try:
+                return self._submit(executor, func, *args).result(timeout=self.job_timeout)
+            except BrokenProcessPool as e:
+                # A worker died (such as being killed for running out of memory), every job sent to the pool
+                # would fail from now on
+                logger.error('A crypto worker died, replacing the crypto worker pool')
+                logger.exception(e)
+                self._replace_executor(executor)
+                if retry:
+                    raise
+            except FutureTimeoutError:
+                # The job keeps its slot until it finishes, a worker that hangs for good makes the pool busy
+                raise CryptoBusyError('Crypto worker did not finish within {timeout}s'.format(
+                    timeout=self.job_timeout
+                ))
+
+    def check(self, test_pw, hashed_pw, salt, params=None):
+        """
+        Pooled version of Crypto.check
+
+        :return: whether test_pw matches hashed_pw when hashed with salt
+        """
+        return self._run(self.crypto.check, test_pw, hashed_pw, salt, params)
+
+    def hash(self, password):
+        """
+        Pooled version of Crypto.hash
+
+        :return: tuple of (hashed, salt) containing the hashed password and generated salt
+        """
+        return self._run(self.crypto.hash, password)
+
+    def shutdown(self):
+        """
+        Stop the worker processes if they were started
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+def _crypto():
+    """
+    :return: the Crypto object configured by the pepper and scrypt_* settings
+    """
+    return Crypto(
+        pepper=SETTINGS['pepper'],
+        params=(
+            SETTINGS.get('scrypt_n', CryptoConsts.DEFAULT_N),
+            SETTINGS.get('scrypt_r', CryptoConsts.DEFAULT_R),
+            SETTINGS.get('scrypt_p', CryptoConsts.DEFAULT_P)
+        )
+    )
+
+
+def _crypto_pool():
+    """
+    :return: the CryptoPool configured by the crypto_* settings
+    """
+    return CryptoPool(
+        crypto.resolve(),
+        workers=SETTINGS.get('crypto_workers', 2),
+        queue_size=SETTINGS.get('crypto_queue_size', 8),
+        queue_timeout=SETTINGS.get('crypto_queue_timeout', 2.0),
+        job_timeout=SETTINGS.get('crypto_job_timeout', 30.0)
+    )
+
+
+# Create a package level crypto object that may be used elsewhere, it is created the first time it is used
+crypto = Lazy(_crypto)
+
+# Create a package level pool that runs the crypto object's work off of the request threads
+crypto_pool = Lazy(_crypto_pool)
+
 
 if __name__ == '__main__':
-    hashed_value, salt_value = crypto.hash('hereismypassword')
+    test_crypto = crypto.resolve()
+    hashed_value, salt_value = test_crypto.hash('hereismypassword')
     print(hashed_value)
     print(len(hashed_value))
     print(salt_value)
@@ -107,5 +287,5 @@ if __name__ == '__main__':
     import base64
     print(base64.b64encode(hashed_value).decode('ascii'))
 
-    is_correct = crypto.check('hereismypassword', hashed_value, salt_value)
+    is_correct = test_crypto.check('hereismypassword', hashed_value, salt_value)
     print(is_correct)
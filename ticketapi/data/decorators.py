@@ -1,11 +1,17 @@
+import math
 from flask import request
 from functools import wraps
 from ticketapi.data.logger import logger
 from ticketapi.data.response import FailureResponse
-from ticketapi.datalayer.procedures import check_auth
+from ticketapi.data.response import FAILURES
+from ticketapi.datalayer.procedures import resolve_auth
+from ticketapi.data.context import request_context
+from ticketapi.data.uploads import UploadTooLarge
+from ticketapi.data.limits import cap_request_body
+from ticketapi.data.limits import rejections
 from werkzeug.exceptions import BadRequest
 
-__all__ = ['requires_validation', 'requires_auth']
+__all__ = ['requires_validation', 'requires_auth', 'requires_rate_limit', 'limits_body']
 
 
 def requires_validation(validator):
@@ -13,22 +19,36 @@ def requires_validation(validator):
     Decorates a view to allow for request validation.  If validation fails,
     the view will not be called--instead the failure response returned by
     the validator will be returned as a flask response.
-    If validation is successful, the view will be called unaffected.
+    If validation is successful, the view will be called unaffected and the validated
+    values will be available to it as `request_context().data`.
+    Validation only looks at the request itself, it should run before requires_auth so that
+    malformed requests are rejected without a trip to the database.
     :param validator: a concrete Validator
     :return: the requires validation decorator
     """
     def decorator(view):
         @wraps(view)
         def view_wrapper(*args, **kwargs):
+            context = request_context()
+
+            # parse JSON (or the form fields of a binary upload), once for every decorator and the view
+            try:
+                fields = context.fields
+            except BadRequest:
+                rejections.increment(view.__name__, 'bad_body')
+                return FAILURES['invalid_json'].response()
+
             v = validator(request)
-            response = v.validate()
+            response = v.validate_data(fields)
 
             # if the validator didn't return anything,
             # the request was validated
             if response is None:
                 logger.info('Successfully validated request')
+                context.data = v.data
                 return view(*args, **kwargs)
             else:
+                rejections.increment(view.__name__, 'invalid')
                 return response.response()
         return view_wrapper
     return decorator
@@ -39,49 +59,110 @@ def requires_auth(view):
     Decorates a view to allow for authentication checking.  If authentication fails,
     the view will not be called--instead a failure response will be returned as
     a flask response.
-    If authentication is successful, the view will be called unaffected.
+    If authentication is successful, the view will be called unaffected and the session
+    the authKey belongs to will be available to it as `request_context().session`.
     :return: the requires authentication decorator
     """
     @wraps(view)
     def view_wrapper(*args, **kwargs):
-        nice_msg = 'There was an error authenticating you with the server'
+        context = request_context()
 
-        # parse JSON
+        # the authKey is taken from the validated data if the request was validated first
         try:
-            json_data = request.get_json(force=True)
+            auth_key = context.auth_key
         except BadRequest:
-            return FailureResponse(
-                error_code=400,
-                debug_message='Request body could not be parsed as JSON',
-                nice_message=nice_msg
-            ).response()
+            rejections.increment(view.__name__, 'bad_body')
+            return FAILURES['auth_bad_body'].response()
 
         # test whether auth key is in JSON
-        auth_key = json_data.get('authKey')
         if auth_key is None:
-            return FailureResponse(
-                error_code=401,
-                debug_message='JSON was missing authentication key',
-                nice_message=nice_msg
-            ).response()
+            rejections.increment(view.__name__, 'unauthorized')
+            return FAILURES['auth_missing_key'].response()
 
         try:
-            # check authentication
-            if check_auth(authKey=auth_key):
-                logger.info('Successfully authorized {auth}'.format(auth=auth_key))
-                return view(*args, **kwargs)
-            else:
-                return FailureResponse(
-                    error_code=401,
-                    debug_message='Authentication key is invalid',
-                    nice_message=nice_msg
-                ).response()
+            # check authentication and keep the session for the view
+            context.session = resolve_auth(authKey=auth_key)
         except Exception as e:
             logger.exception(e)
-            return FailureResponse(
-                error_code=520,
-                debug_message='Exception occurred when querying database. Maybe the db is down',
-                nice_message=nice_msg
-            ).response()
+            return FAILURES['auth_unavailable'].response()
+
+        if context.session is None:
+            rejections.increment(view.__name__, 'unauthorized')
+            return FAILURES['auth_invalid_key'].response()
+
+        logger.info('Successfully authorized {auth}'.format(auth=auth_key))
+        return view(*args, **kwargs)
 
     return view_wrapper
+
+
+def requires_rate_limit(limiter, key_func, failures_only=False):
+    """
+    Decorates a view to allow for rate limiting. A token is taken from the limiter for the key
+    returned by key_func, if there are none left the view will not be called--instead a 429
+    failure response with a Retry-After header will be returned as a flask response.
+    If key_func returns None, the request is not limited. If failures_only is set, a token is only
+    taken when the view answers 401, requests are still refused once the bucket is empty. The limiter
+    failing (such as its SQLite database being locked) is logged and the request is let through.
+    :param limiter: a RateLimiter
+    :param key_func: function taking the current request and returning the key to limit on
+    :param failures_only: only charge the limiter for requests the view rejected with a 401
+    :return: the requires rate limit decorator
+    """
+    def decorator(view):
+        @wraps(view)
+        def view_wrapper(*args, **kwargs):
+            key = key_func(request)
+            if key is None:
+                return view(*args, **kwargs)
+
+            try:
+                allowed, retry_after = limiter.peek(key) if failures_only else limiter.take(key)
+            except Exception as e:
+                logger.exception(e)
+                allowed = True
+
+            if not allowed:
+                rejections.increment(view.__name__, 'rate_limited')
+                return FailureResponse.rejection(
+                    error_code=429,
+                    debug_message='Rate limit exceeded for {key}'.format(key=limiter.prefix + key),
+                    nice_message='Too many attempts, please wait before trying again'
+                ).response(headers={'Retry-After': str(int(math.ceil(retry_after)))})
+
+            response = view(*args, **kwargs)
+            if failures_only and getattr(response, 'status_code', None) == 401:
+                try:
+                    limiter.take(key)
+                except Exception as e:
+                    logger.exception(e)
+            return response
+        return view_wrapper
+    return decorator
+
+
+def limits_body(max_bytes):
+    """
+    Decorates a view to cap the size of its request body. A request whose Content-Length is larger than max_bytes
+    is rejected with a 413 failure response before anything reads its body, a body sent without a Content-Length
+    is cut off as soon as more than max_bytes are read (UploadTooLarge is then raised from wherever it was read).
+    This must be the first decorator after the route so that it runs before the body is parsed.
+    :param max_bytes: maximum size of the request body in bytes, or a function returning it (such as
+        max_json_body_bytes) so that the limit is read from the settings on each request instead of at import
+    :return: the limits body decorator
+    """
+    def decorator(view):
+        @wraps(view)
+        def view_wrapper(*args, **kwargs):
+            try:
+                cap_request_body(request, max_bytes() if callable(max_bytes) else max_bytes)
+            except UploadTooLarge as e:
+                rejections.increment(view.__name__, 'too_large')
+                return FailureResponse.rejection(
+                    error_code=413,
+                    debug_message='Request body rejected: {reason}'.format(reason=e),
+                    nice_message='The request is too large'
+                ).response()
+            return view(*args, **kwargs)
+        return view_wrapper
+    return decorator
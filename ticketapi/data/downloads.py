@@ -0,0 +1,115 @@
+from flask import Response
+from ticketapi.data.response import FailureResponse
+
+__all__ = ['send_stream']
+
+# Size of the pieces files are sent in
+CHUNK_BYTES = 64 * 1024
+
+
+def _read_range(stream, start, length):
+    """
+    Generate the bytes of a range of a stream and close it once done
+
+    :param stream: binary file object to read
+    :param start: offset of the first byte to send
+    :param length: number of bytes to send
+    :return: generator of chunks
+    """
+    try:
+        stream.seek(start)
+        while length > 0:
+            chunk = stream.read(min(CHUNK_BYTES, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        stream.close()
+
+
+def _parse_range(header, size):
+    """
+    Parse a single byte range of a Range header
+
+    :param header: value of the Range header
+    :param size: size of the content in bytes
+    :return: tuple (start, end) with end exclusive, None if the header is not a single byte range
+        or False if the range can not be satisfied
+    """
+    unit, _, ranges = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+
+    first, _, last = ranges.strip().partition('-')
+    try:
+        if first == '':
+            # A suffix range, the last N bytes
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size
+
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+
+    if start >= size or end <= start:
+        return False
+    return start, min(end, size)
+
+
+def send_stream(request, open_stream, etag, content_type, max_age=31536000):
+    """
+    Create a flask response streaming a file. Conditional requests with If-None-Match are answered with
+    a 304 before the file is opened and single byte Range requests with a 206 holding only that range
+
+    :param request: the current flask request
+    :param open_stream: function taking no arguments and returning a tuple (binary file object to send, size of
+        the file in bytes), it is only called if the file is sent. The file object is closed once sent
+    :param etag: strong entity tag of the file, without quotes
+    :param content_type: mimetype of the file
+    :param max_age: number of seconds clients may cache the file
+    :return: Flask response
+    """
+    quoted = '"{etag}"'.format(etag=etag)
+    headers = {
+        'ETag': quoted,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age={max_age}'.format(max_age=max_age)
+    }
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None and (if_none_match.strip() == '*' or quoted in
+                                      [tag.strip() for tag in if_none_match.split(',')]):
+        return Response(status=304, headers=headers)
+
+    stream, size = open_stream()
+    start, end = 0, size
+    status = 200
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header is not None and (if_range is None or if_range.strip() == quoted):
+        byte_range = _parse_range(range_header, size)
+        if byte_range is False:
+            stream.close()
+            response = FailureResponse(
+                error_code=416,
+                nice_message='The requested range is not available',
+                debug_message='Range {range} not satisfiable for {size} bytes'.format(range=range_header, size=size)
+            ).response(headers={'Content-Range': 'bytes */{size}'.format(size=size)})
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            headers['Content-Range'] = 'bytes {start}-{last}/{size}'.format(start=start, last=end - 1, size=size)
+
+    headers['Content-Length'] = str(end - start)
+    return Response(
+        _read_range(stream, start, end - start),
+        status=status,
+        headers=headers,
+        mimetype=content_type,
+        direct_passthrough=True
+    )
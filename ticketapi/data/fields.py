@@ -1,15 +1,72 @@
+import re
 import sys
 import phonenumbers
 import base64
+from datetime import datetime
 from validate_email import validate_email
+from phonenumbers.phonemetadata import PhoneMetadata
+from ticketapi.data import SETTINGS
+from ticketapi.data.cache import TTLCache
+from ticketapi.data.lazy import Lazy
 
 
 __all__ = [
     'Field', 'StringField', 'NumberField',
     'EmailField', 'PhoneNumberField',
-    'ImageField'
+    'ImageField', 'ListField', 'BooleanField',
+    'DateTimeField', 'ObjectField', 'HexField',
+    'ValidationError', 'compile_schema',
+    'phone_number_cache', 'email_cache', 'validation_cache_stats', 'preload_phone_metadata'
 ]
 
+# Results of phone number and email address validation, employees send the same ones over and over.
+# Validation is a pure function of the value so entries may live for a long time. The caches are only
+# created when first used so that importing the fields does not read the settings
+phone_number_cache = Lazy(lambda: TTLCache(
+    maxsize=SETTINGS.get('phone_number_cache_size', 4096),
+    ttl=SETTINGS.get('phone_number_cache_ttl', 86400)
+))
+email_cache = Lazy(lambda: TTLCache(
+    maxsize=SETTINGS.get('email_cache_size', 4096),
+    ttl=SETTINGS.get('email_cache_ttl', 86400)
+))
+
+
+def validation_cache_stats():
+    """
+    :return: dictionary of the stats (hits, misses, hit rate and size) of the phone number and email caches
+    """
+    return {'phoneNumber': phone_number_cache.stats(), 'email': email_cache.stats()}
+
+
+def preload_phone_metadata():
+    """
+    Load the metadata of every region known to phonenumbers. phonenumbers otherwise loads the metadata of a
+    region the first time one of its numbers is parsed, which makes that request slower
+
+    :return: number of regions loaded
+    """
+    for region in phonenumbers.SUPPORTED_REGIONS:
+        PhoneMetadata.metadata_for_region(region)
+    for country_code in phonenumbers.COUNTRY_CODES_FOR_NON_GEO_REGIONS:
+        PhoneMetadata.metadata_for_nongeo_region(country_code)
+    return len(phonenumbers.SUPPORTED_REGIONS) + len(phonenumbers.COUNTRY_CODES_FOR_NON_GEO_REGIONS)
+
+
+class ValidationError(Exception):
+    """
+    Raised by a field when a value is invalid, the message is only formatted when it is displayed
+
+    :param name: name of the field, nested fields are named after their parents (tickets[2].description)
+    :param message: why the value is invalid
+    """
+    def __init__(self, name, message):
+        self.name = name
+        self.message = message
+
+    def __str__(self):
+        return "key={name} :: {msg}".format(name=self.name, msg=self.message)
+
 
 class Field(object):
     """
@@ -17,68 +74,70 @@ class Field(object):
     you should implement `_validate(value)` function and also add it to the list of validators
     `self.validators`. For example, StringField's init should call
     `self.validators.append(StringField._validate)` immediately after
-    `super().__init__(*args, **kwargs)`.
+    `super().__init__(*args, **kwargs)`. A `_validate` function returns the validated value, possibly
+    converted, and the next validator in the chain receives it. An invalid value is rejected by
+    raising `self.failure(message)`.
+
+    The validators of a field are compiled into a single function by `compile_schema` the first time
+    the field is used, the list is never walked while validating a request.
 
     :param name: name of the field located within validation data
     :param required: states whether or not the field is required in the validation data
     """
-    default_success_msg = 'Success'
-
     def __init__(self, name, required=True, **kwargs):
         self.name = name
         self.required = required
         self.validators = [Field._validate]
+        self._check = None
 
-    def success(self):
+    def failure(self, message):
         """
-        Helper function to return success message
+        Helper function to create the error raised for an invalid value
 
-        :return: tuple (True, default_success_msg)
+        :param message: why the value is invalid
+        :return: ValidationError for this field
         """
-        return True, self.default_success_msg
+        return ValidationError(self.name, message)
 
-    def failure(self, message):
+    def _validate(self, value):
         """
-        Helper function to return a failure message
+        Default validation function that accepts any value
 
-        :param message: message to return
-        :return: tuple (False, "data['{name}']: {message}")
+        :param value: value to validate
+        :return: the value
         """
-        return False, "key={name} :: {msg}".format(name=self.name, msg=message)
+        return value
 
-    def _validate(self, value):
+    def steps(self):
+        """
+        :return: the validators of this field bound to it, leaving out the default one that does nothing
+        """
+        return [validator.__get__(self) for validator in self.validators if validator is not Field._validate]
+
+    def check(self, value):
         """
-        Default validation function that always returns success
+        Validate a value with the compiled validators of this field
 
         :param value: value to validate
-        :return: success as a tuple (status, message)
+        :return: the validated value, None if the value is None and not required
+        :raises ValidationError: if the value is invalid
         """
-        return self.success()
+        if self._check is None:
+            self._check = compile_schema([self], single=True)
+        return self._check(value)
 
     def validate(self, value):
         """
-        Validation chain function that will look at the list of validate functions
-        in self.validators and call them successively until one returns failure or
-        all functions have been called
+        Validate a value, each validator is handed the value returned by the previous one so that
+        conversions (such as decoding) happen only once
 
         :param value: value to validate
-        :return: success or failure as a tuple (status, message)
+        :return: tuple (True, validated value) on success or (False, message) on failure
         """
-        # ensure the value exists if it is required
-        if self.required and value is None:
-            return self.failure('required but does not exist')
-
-        # if it is not required, but is None, then it is known success
-        if value is None:
-            return self.success()
-
-        # otherwise, go through our validators and attempt to validate the value
-        for validator in self.validators:
-            status, message = validator(self, value)
-            if not status:
-                return status, message
-        else:
-            return self.success()
+        try:
+            return True, self.check(value)
+        except ValidationError as e:
+            return False, str(e)
 
 
 class StringField(Field):
@@ -103,17 +162,18 @@ class StringField(Field):
         that the length fits within the min and max lengths specified by the field
 
         :param value: value to validate
-        :return: success or failure as a tuple (status, message)
+        :return: the validated value
+        :raises ValidationError: if the value is invalid
         """
         # check if the value is actually a string
         if not isinstance(value, str):
-            return self.failure('not an instance of a string')
+            raise self.failure('not an instance of a string')
 
         # check if the string fits within the length constraints
         if self.min_length <= len(value) <= self.max_length:
-            return self.success()
+            return value
 
-        return self.failure('not within size bounds {mi} <= len(string) <= {ma}'.format(
+        raise self.failure('not within size bounds {mi} <= len(string) <= {ma}'.format(
             mi=self.min_length,
             ma=self.max_length
         ))
@@ -140,17 +200,18 @@ class NumberField(Field):
         Checks if a value is a number and is within the value constraints
 
         :param value: value to validate
-        :return: success or failure as a tuple (status, message)
+        :return: the validated value
+        :raises ValidationError: if the value is invalid
         """
         # Is value actually a number
         if not isinstance(value, (int, float, complex)):
-            return self.failure('not a number')
+            raise self.failure('not a number')
 
         # Does value lie within the value constraints
         if self.min_value <= value <= self.max_value:
-            return self.success()
+            return value
 
-        return self.failure('not within value bounds {mi} <= value <= {ma}'.format(
+        raise self.failure('not within value bounds {mi} <= value <= {ma}'.format(
             mi=self.min_value,
             ma=self.max_value
         ))
@@ -171,22 +232,29 @@ class EmailField(StringField):
 
     def _validate(self, value):
         """
-        Validates an email address according to RFC 2822
+        Validates an email address according to RFC 2822, addresses that were already checked are
+        answered by the email cache
 
         :param value: value to validate
-        :return: success or failure as a tuple (status, message)
+        :return: the validated value
+        :raises ValidationError: if the value is invalid
         """
-        if not validate_email(value):
-            return self.failure('not a valid email address')
+        valid = email_cache.get(value)
+        if valid is None:
+            valid = validate_email(value)
+            email_cache.set(value, valid)
+
+        if not valid:
+            raise self.failure('not a valid email address')
 
-        return self.success()
+        return value
 
 
 class PhoneNumberField(StringField):
     """
     Validates phone numbers based on their country code, if a country code
     is not entered, then the country code specified by default_country_code
-    is utilized.
+    is utilized. The validated value is the number in E.164 format (+13379455244).
 
     :param name: name of the field located within validation data
     :param required: states whether or not the field is required in the validation data
@@ -200,12 +268,12 @@ class PhoneNumberField(StringField):
 
         self.default_country_code = kwargs.get('default_country_code', 1)
 
-    def _validate(self, value):
+    def _normalize(self, value):
         """
-        Validate a phone number based on its country code or the default country code.
+        Parse a phone number and format it in E.164
 
-        :param value: value to validate
-        :return: success or failure as a tuple (status, message)
+        :param value: phone number to normalize
+        :return: tuple (True, number in E.164 format) or (False, reason it is invalid)
         """
         # add the country code if one does not already exist
         value = value.strip()
@@ -215,53 +283,318 @@ class PhoneNumberField(StringField):
         try:
             # parse the number into a number object (this should hopefully never fail but its possible)
             number = phonenumbers.parse(value)
-
-            # if the phone number is not a valid number based on the country code, then fail
-            if not phonenumbers.is_possible_number(number):
-                return self.failure('phone number does not match valid pattern for country code {code}'.format(
-                    code=number.country_code
-                ))
         except Exception as e:
-            return self.failure(e)
+            return False, str(e)
 
-        return self.success()
+        # if the phone number is not a valid number based on the country code, then fail
+        if not phonenumbers.is_possible_number(number):
+            return False, 'phone number does not match valid pattern for country code {code}'.format(
+                code=number.country_code
+            )
+
+        return True, phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164)
+
+    def _validate(self, value):
+        """
+        Validate a phone number based on its country code or the default country code. Numbers that
+        were already checked are answered by the phone number cache
+
+        :param value: value to validate
+        :return: the phone number in E.164 format
+        :raises ValidationError: if the value is invalid
+        """
+        key = (self.default_country_code, value)
+        result = phone_number_cache.get(key)
+        if result is None:
+            result = self._normalize(value)
+            phone_number_cache.set(key, result)
+
+        valid, normalized = result
+        if not valid:
+            raise self.failure(normalized)
+
+        return normalized
 
 
 class ImageField(StringField):
     """
     Image field will validate the field to be a valid encoded string that may be configured.
     The encoded string currently only accepts base64 which will just ensure that the image is
-    of proper base64 string.
+    of proper base64 string. The validated value is the decoded image bytes (None for an empty
+    string) so that the image never has to be decoded again.
 
     :param name: name of the field located within validation data
     :param required: states whether or not the field is required in the validation data
     :param encoding: what type of encoding is the image in should this be
+    :param max_size: maximum size of the decoded image in bytes, or a function returning it so that it may be
+        read from the settings when a request is validated
     """
     def __init__(self, name, required=True, **kwargs):
         super().__init__(name, required=required, **kwargs)
         self.validators.append(ImageField._validate)
 
         self.encoding = kwargs.get('encoding', 'base64')
+        self.max_size = kwargs.get('max_size', sys.maxsize)
 
     def _validate(self, value):
         """
-        Validate the image itself.
+        Validate the image itself and decode it.
 
         :param value: value to validate
-        :return: success or failure as a tuple (status, message)
+        :return: the decoded bytes
+        :raises ValidationError: if the value is invalid
         """
         if self.encoding == 'base64':
+            max_size = self.max_size() if callable(self.max_size) else self.max_size
+
+            # Every 4 characters decode to at most 3 bytes, an image that is too large is rejected before decoding
+            encoded_length = len(value) - value.count('\n') - value.count('\r')
+            if encoded_length // 4 * 3 > max_size + 2:
+                raise self.failure('image larger than {size} bytes'.format(size=max_size))
+
             try:
-                if value is not None or value.strip() != '':
-                    # Here we attempt to base64 decode the image using the standard
-                    # base64 alphabet, this will throw an exception if it is not in
-                    # the correct base64 format (wrong padding, etc)
-                    base64.standard_b64decode(value.replace('\n', ''))
-                return self.success()
+                # Here we attempt to base64 decode the image using the standard
+                # base64 alphabet, this will throw an exception if it is not in
+                # the correct base64 format (wrong padding, etc). Characters outside
+                # of the alphabet such as newlines are skipped by the decoder itself
+                decoded = base64.standard_b64decode(value)
             except:
-                return self.failure('image not in valid base64 format')
+                raise self.failure('image not in valid base64 format')
+
+            if len(decoded) > max_size:
+                raise self.failure('image larger than {size} bytes'.format(size=max_size))
+            return decoded or None
         else:
-            return self.success()
+            return value
+
+
+class ListField(Field):
+    """
+    Validates that a field is a list with a bounded number of items. If an item field is given,
+    every item must be valid against it and the validated value is the list of validated items.
+
+    :param name: name of the field located within validation data
+    :param required: states whether or not the field is required in the validation data
+    :param min_length: minimum number of items in the list
+    :param max_length: maximum number of items in the list
+    :param item: field every item is validated with, items are not validated if it is None
+    """
+    def __init__(self, name, required=True, **kwargs):
+        super().__init__(name, required=required, **kwargs)
+        self.validators.append(ListField._validate)
+
+        self.min_length = kwargs.get('min_length', 0)
+        self.max_length = kwargs.get('max_length', sys.maxsize)
+        self.item = kwargs.get('item')
+
+    def _validate(self, value):
+        """
+        Validates a list by checking if the value is a list and that its length fits
+        within the min and max lengths specified by the field, then validates its items
+
+        :param value: value to validate
+        :return: the validated value
+        :raises ValidationError: if the value is invalid
+        """
+        if not isinstance(value, list):
+            raise self.failure('not a list')
+
+        if not self.min_length <= len(value) <= self.max_length:
+            raise self.failure('not within size bounds {mi} <= len(list) <= {ma}'.format(
+                mi=self.min_length,
+                ma=self.max_length
+            ))
+
+        if self.item is None:
+            return value
+
+        check = self.item.check
+        validated = []
+        for index, item in enumerate(value):
+            try:
+                validated.append(check(item))
+            except ValidationError as e:
+                # name the item after its position, tickets[2] or tickets[2].description
+                raise ValidationError('{name}[{index}]{inner}'.format(
+                    name=self.name,
+                    index=index,
+                    inner=e.name[len(self.item.name):]
+                ), e.message)
+        return validated
+
+
+class ObjectField(Field):
+    """
+    Validates that a field is a JSON object whose own fields are valid. The validated value is
+    the dictionary of validated values, just like the data of a validator.
+
+    :param name: name of the field located within validation data
+    :param required: states whether or not the field is required in the validation data
+    :param fields: list of fields the object is validated with
+    """
+    def __init__(self, name, required=True, **kwargs):
+        super().__init__(name, required=required, **kwargs)
+        self.validators.append(ObjectField._validate)
+
+        self.fields = kwargs.get('fields', [])
+        self.schema = compile_schema(self.fields)
+
+    def _validate(self, value):
+        """
+        Validates an object with the compiled schema of its fields
+
+        :param value: value to validate
+        :return: the dictionary of validated values
+        :raises ValidationError: if the value is invalid
+        """
+        if not isinstance(value, dict):
+            raise self.failure('not an object')
+
+        try:
+            return self.schema(value)
+        except ValidationError as e:
+            raise ValidationError('{name}.{inner}'.format(name=self.name, inner=e.name), e.message)
+
+
+class BooleanField(Field):
+    """
+    Validates that a field is a JSON boolean
+
+    :param name: name of the field located within validation data
+    :param required: states whether or not the field is required in the validation data
+    """
+    def __init__(self, name, required=True, **kwargs):
+        super().__init__(name, required=required, **kwargs)
+        self.validators.append(BooleanField._validate)
+
+    def _validate(self, value):
+        """
+        Checks if a value is a boolean
+
+        :param value: value to validate
+        :return: the validated value
+        :raises ValidationError: if the value is invalid
+        """
+        if not isinstance(value, bool):
+            raise self.failure('not a boolean')
+
+        return value
+
+
+class DateTimeField(StringField):
+    """
+    Validates a date and time in ISO 8601 format (2017-04-01T13:30:00 or 2017-04-01),
+    the validated value is a datetime
+
+    :param name: name of the field located within validation data
+    :param required: states whether or not the field is required in the validation data
+    """
+    formats = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+    def __init__(self, name, required=True, **kwargs):
+        kwargs.setdefault('max_length', 32)
+        super().__init__(name, required=required, **kwargs)
+        self.validators.append(DateTimeField._validate)
+
+    def _validate(self, value):
+        """
+        Parse the date and time
+
+        :param value: value to validate
+        :return: the datetime
+        :raises ValidationError: if the value is invalid
+        """
+        for date_format in self.formats:
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+
+        raise self.failure('not a date in ISO 8601 format')
+
+
+
+class HexField(StringField):
+    """
+    Validates that a field is a string of hexadecimal digits (such as a digest) at a particular length,
+    the validated value is lower case
+
+    :param name: name of the field located within validation data
+    :param required: states whether or not the field is required in the validation data
+    :param min_length: minimum length of the string
+    :param max_length: maximum length of the string
+    """
+    pattern = re.compile(r'[0-9a-fA-F]*')
+
+    def __init__(self, name, required=True, **kwargs):
+        super().__init__(name, required=required, **kwargs)
+        self.validators.append(HexField._validate)
+
+    def _validate(self, value):
+        """
+        Check that every character is a hexadecimal digit
+
+        :param value: value to validate
+        :return: the value in lower case
+        :raises ValidationError: if the value is invalid
+        """
+        if not self.pattern.fullmatch(value):
+            raise self.failure('not a hexadecimal string')
+        return value.lower()
+
+def compile_schema(fields, single=False):
+    """
+    Compile a list of fields into a single validation function. The source of the function is generated so that
+    the validators of every field are called one after the other, without looping over the fields or their
+    validators and without building a message unless a value is invalid. For example, a required StringField
+    named description compiles to
+
+        def schema(data):
+            result = {}
+            value = data.get(name0)
+            if value is not None:
+                value = step0_0(value)
+                result[name0] = value
+            else:
+                raise ValidationError(name0, 'required but does not exist')
+            return result
+
+    :param fields: list of fields to compile
+    :param single: if True, compile a function that validates a single value against the only field
+    :return: function taking a dictionary and returning the validated values of the fields present in it, or
+        taking a value and returning the validated value if single. It raises ValidationError if a value is invalid
+    """
+    namespace = {'ValidationError': ValidationError}
+    if single:
+        lines = ['def schema(value):']
+    else:
+        lines = ['def schema(data):', '    result = {}']
+
+    for index, field in enumerate(fields):
+        name = 'name{i}'.format(i=index)
+        namespace[name] = field.name
+
+        if not single:
+            lines.append('    value = data.get({name})'.format(name=name))
+        lines.append('    if value is not None:')
+        for step_index, step in enumerate(field.steps()):
+            step_name = 'step{i}_{s}'.format(i=index, s=step_index)
+            namespace[step_name] = step
+            lines.append('        value = {step}(value)'.format(step=step_name))
+        lines.append('        return value' if single else '        result[{name}] = value'.format(name=name))
+
+        if field.required:
+            lines.append('    else:')
+            lines.append("        raise ValidationError({name}, 'required but does not exist')".format(name=name))
+        elif not single:
+            # keep fields that were sent as null, the validator data always held them
+            lines.append('    elif {name} in data:'.format(name=name))
+            lines.append('        result[{name}] = None'.format(name=name))
+
+    lines.append('    return None' if single else '    return result')
+
+    exec('\n'.join(lines), namespace)
+    return namespace['schema']
 
 
 if __name__ == '__main__':
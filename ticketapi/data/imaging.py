@@ -0,0 +1,137 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from PIL import Image
+from PIL import ImageOps
+from ticketapi.data import SETTINGS
+from ticketapi.data.logger import logger
+from ticketapi.data.photostore import photo_store
+from ticketapi.data.photostore import ORIGINAL_REPLACEMENT
+
+__all__ = ['VARIANTS', 'make_variants', 'schedule_variants']
+
+# Variants made for every photo mapped to the setting holding the largest width/height they may have and its default
+VARIANT_DIMENSIONS = {
+    'normalized': ('photo_max_dimension', 2048),
+    'thumbnail': ('thumbnail_max_dimension', 256)
+}
+
+# Names of the variants made for every photo
+VARIANTS = tuple(sorted(VARIANT_DIMENSIONS))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def make_variants(digest):
+    """
+    Make every missing variant of a stored photo. Each variant is re-encoded as a JPEG no larger than its
+    maximum dimension, rotated according to its EXIF orientation and stripped of all metadata. Variants that
+    already exist are skipped so this may safely be ran more than once for the same photo. Once the normalized
+    variant exists the original photo (and the location and camera details in its EXIF data) is deleted if the
+    keep_original_photos setting is turned off, and the normalized variant is served in its place
+
+    :param digest: digest of the photo in the photo store
+    :return: list of the names of the variants that were made
+    """
+    missing = [variant for variant in VARIANTS if not photo_store.exists(digest, variant)]
+
+    if missing:
+        # The original may already be gone if only the thumbnail is missing, it is then made from the normalized one
+        with photo_store.open_best(digest) as photo_file:
+            original = Image.open(photo_file)
+            original.load()
+
+        # Apply the orientation before the EXIF data is thrown away, older versions of Pillow can not
+        if hasattr(ImageOps, 'exif_transpose'):
+            original = ImageOps.exif_transpose(original)
+        original = original.convert('RGB')
+
+        for variant in missing:
+            dimension = SETTINGS.get(*VARIANT_DIMENSIONS[variant])
+            image = original.copy()
+            image.thumbnail((dimension, dimension), Image.LANCZOS)
+
+            # Saving without passing exif drops all of the original's metadata
+            output = BytesIO()
+            image.save(output, format='JPEG', quality=SETTINGS.get('photo_jpeg_quality', 85), optimize=True)
+            photo_store.put_variant(digest, variant, output.getvalue())
+
+    if not SETTINGS.get('keep_original_photos', True) and photo_store.exists(digest, ORIGINAL_REPLACEMENT):
+        photo_store.remove(digest)
+
+    return missing
+
+
+def _get_executor():
+    """
+    Lazily create the image worker pool, this way processes are only forked once they are needed
+
+    :return: the process pool executor or None if image processing is disabled
+    """
+    global _executor
+    workers = SETTINGS.get('image_workers', 1)
+    if workers <= 0:
+        return None
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        return _executor
+
+
+def _discard_executor(executor):
+    """
+    Throw away a worker pool that is broken because one of its workers died (such as being killed for running
+    out of memory), the next photo that is scheduled starts a new pool
+
+    :param executor: the broken process pool executor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def _log_result(digest, executor):
+    """
+    :param digest: digest of the photo the future belongs to
+    :param executor: process pool executor the future was submitted to
+    :return: done callback that logs the outcome of make_variants
+    """
+    def callback(future):
+        try:
+            made = future.result()
+            logger.info('Made variants {made} for photo {digest}'.format(made=made, digest=digest))
+        except Exception as e:
+            logger.error('Unable to make variants for photo {digest}'.format(digest=digest))
+            logger.exception(e)
+            if isinstance(e, BrokenProcessPool):
+                _discard_executor(executor)
+    return callback
+
+
+def schedule_variants(digest):
+    """
+    Make the variants of a stored photo in the image worker pool, off of the request path
+
+    :param digest: digest of the photo in the photo store
+    """
+    executor = _get_executor()
+    if executor is None:
+        return
+
+    try:
+        future = executor.submit(make_variants, digest)
+    except Exception as e:
+        # Variants are best effort, the ticket is already saved and makevariants can make them later
+        logger.error('Unable to schedule variants for photo {digest}'.format(digest=digest))
+        logger.exception(e)
+
+        if isinstance(e, BrokenProcessPool):
+            _discard_executor(executor)
+        return
+
+    future.add_done_callback(_log_result(digest, executor))
@@ -0,0 +1,54 @@
+import threading
+
+__all__ = ['Lazy']
+
+
+class Lazy(object):
+    """
+    Stands in for a package level object that should only be created the first time it is used, such as one
+    built from the settings. Attribute access is forwarded to the object, which is created by factory on the
+    first access, so `crypto.hash(...)` works the same whether crypto is the object itself or a Lazy of it.
+    Pass `resolve()` wherever the object itself is needed, such as to another process.
+
+    :param factory: function taking no arguments that creates the object
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_instance', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def resolve(self):
+        """
+        :return: the object, created by the factory if this is the first time it is needed
+        """
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                instance = self._instance
+                if instance is None:
+                    instance = self._factory()
+                    object.__setattr__(self, '_instance', instance)
+        return instance
+
+    def reset(self):
+        """
+        Forget the object so that the next access creates a new one, used when the settings change
+        """
+        with self._lock:
+            object.__setattr__(self, '_instance', None)
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.resolve(), name, value)
+
+    def __contains__(self, item):
+        # Special methods are looked up on the class, `in` would not reach __getattr__
+        return item in self.resolve()
+
+    def __repr__(self):
+        if self._instance is None:
+            return '<Lazy {factory} (not created)>'.format(factory=getattr(self._factory, '__name__', self._factory))
+        return '<Lazy {instance!r}>'.format(instance=self._instance)
@@ -0,0 +1,123 @@
+import threading
+from collections import Counter
+from ticketapi.data import SETTINGS
+from ticketapi.data.uploads import UploadTooLarge
+from ticketapi.data.uploads import max_photo_bytes
+
+__all__ = [
+    'CappedStream', 'cap_request_body', 'RejectionCounter', 'rejections',
+    'max_json_body_bytes', 'max_photo_body_bytes', 'max_batch_body_bytes'
+]
+
+
+def max_json_body_bytes():
+    """
+    :return: largest body, in bytes, of a request that only carries a few small fields
+    """
+    return SETTINGS.get('max_json_body_bytes', 64 * 1024)
+
+
+def max_photo_body_bytes():
+    """
+    :return: largest body of a request that carries a photo, base64 makes a photo a third larger
+    """
+    return SETTINGS.get('max_photo_body_bytes', max_photo_bytes() * 4 // 3 + max_json_body_bytes())
+
+
+def max_batch_body_bytes():
+    """
+    :return: largest body of a batch of tickets
+    """
+    return SETTINGS.get('max_batch_body_bytes', 32 * 1024 * 1024)
+
+
+class CappedStream(object):
+    """
+    Wraps a request's input stream and raises as soon as more than a number of bytes have been read from it,
+    so a body sent without a Content-Length (chunked) is cut off without being buffered whole
+
+    :param stream: the input stream to wrap
+    :param limit: maximum number of bytes that may be read
+    """
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.position = 0
+
+    def _count(self, data):
+        """
+        :param data: bytes that were just read
+        :return: data
+        :raises UploadTooLarge: if more than limit bytes have been read
+        """
+        self.position += len(data)
+        if self.position > self.limit:
+            raise UploadTooLarge(self.limit)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # Never read more than one byte past the limit, that is enough to know it was exceeded
+            size = self.limit - self.position + 1
+        return self._count(self.stream.read(size))
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = self.limit - self.position + 1
+        return self._count(self.stream.readline(size))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+def cap_request_body(request, limit):
+    """
+    Enforce a maximum body size on a request before anything reads the body. A request whose Content-Length is
+    larger is rejected right away, any other body is cut off while it is read. This must be called before the
+    request's stream, data, form or JSON are first accessed
+
+    :param request: the current flask request
+    :param limit: maximum size of the body in bytes
+    :raises UploadTooLarge: if the Content-Length is larger than limit
+    """
+    if request.content_length is not None and request.content_length > limit:
+        raise UploadTooLarge(limit)
+    request.environ['wsgi.input'] = CappedStream(request.environ['wsgi.input'], limit)
+
+
+class RejectionCounter(object):
+    """
+    Thread safe count of the requests that were rejected, by route and reason
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def increment(self, route, reason):
+        """
+        :param route: name of the view that rejected the request
+        :param reason: why the request was rejected, such as too_large or unauthorized
+        """
+        with self._lock:
+            self._counts[(route, reason)] += 1
+
+    def stats(self):
+        """
+        :return: dictionary mapping route:reason to the number of requests rejected
+        """
+        with self._lock:
+            return {'{route}:{reason}'.format(route=route, reason=reason): count
+                    for (route, reason), count in self._counts.items()}
+
+    def clear(self):
+        """
+        Reset every count
+        """
+        with self._lock:
+            self._counts.clear()
+
+
+# Create a package level counter that may be used elsewhere
+rejections = RejectionCounter()
@@ -1,8 +1,9 @@
 from ticketapi.data import LOG_FILE
+import os
 import logging
 import logging.config
 
-__all__ = ['logger']
+__all__ = ['logger', 'set_log_file']
 
 log_settings = {
     'version': 1,
@@ -21,6 +22,8 @@ log_settings = {
             'mode': 'a',
             'maxBytes': 2621440,
             'backupCount': 9,
+            # the file is only opened when the first record is written
+            'delay': True,
         },
 
     },
@@ -38,6 +41,22 @@ logging.config.dictConfig(log_settings)
 logger = logging.getLogger('API-basic')
 
 
+def set_log_file(path):
+    """
+    Write the log to another file, the current file is closed and the new one is opened by the next record
+
+    :param path: path of the log file
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, logging.FileHandler):
+            handler.acquire()
+            try:
+                handler.close()
+                handler.baseFilename = os.path.abspath(path)
+            finally:
+                handler.release()
+
+
 if __name__ == '__main__':
     for i in range(50):
         logger.info('test' + str(i))
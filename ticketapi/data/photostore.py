@@ -0,0 +1,324 @@
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+from io import BytesIO
+from ticketapi.data import SETTINGS
+from ticketapi.data import TICKET_API_ROOT
+from ticketapi.data.uploads import UploadTooLarge
+from ticketapi.data.lazy import Lazy
+
+__all__ = ['StoredPhoto', 'PhotoStore', 'FilesystemPhotoStore', 'sniff_content_type', 'photo_store']
+
+# Size of the pieces photos are copied in
+CHUNK_BYTES = 64 * 1024
+
+# What is recorded on a Ticket row for its photo
+StoredPhoto = namedtuple('StoredPhoto', ['digest', 'size', 'content_type'])
+
+
+def sniff_content_type(head):
+    """
+    Guess the content type of an image from its first bytes
+
+    :param head: at least the first 8 bytes of the image
+    :return: the image's mimetype, application/octet-stream if it is not recognized
+    """
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    return 'application/octet-stream'
+
+
+# Variant served in place of an original photo that was dropped after it was re-encoded
+ORIGINAL_REPLACEMENT = 'normalized'
+
+
+class PhotoStore(object):
+    """
+    Base class for photo stores. Photos are content addressed, they are stored and looked up by the
+    hex SHA-256 digest of their bytes, so storing the same photo twice only keeps one copy.
+    """
+
+    def put_stream(self, stream, limit=None):
+        """
+        Store a photo read from a stream
+
+        :param stream: file like object to read the photo from
+        :param limit: maximum size of the photo in bytes, None for no limit
+        :return: StoredPhoto describing the stored photo
+        :raises UploadTooLarge: if the photo is larger than limit
+        """
+        raise NotImplementedError()
+
+    def put(self, data):
+        """
+        Store a photo held in memory
+
+        :param data: bytes of the photo
+        :return: StoredPhoto describing the stored photo
+        """
+        return self.put_stream(BytesIO(data))
+
+    def put_variant(self, digest, variant, data):
+        """
+        Store a variant (such as a thumbnail) derived from a stored photo, variants are stored
+        next to their photo under the photo's digest
+
+        :param digest: digest of the original photo
+        :param variant: name of the variant
+        :param data: bytes of the variant
+        """
+        raise NotImplementedError()
+
+    def open(self, digest, variant=None):
+        """
+        :param digest: digest of the photo to open
+        :param variant: name of the variant to open, None for the original photo
+        :return: binary file object of the photo
+        :raises FileNotFoundError: if the photo is not in the store
+        """
+        raise NotImplementedError()
+
+    def exists(self, digest, variant=None):
+        """
+        :param digest: digest of the photo
+        :param variant: name of the variant, None for the original photo
+        :return: True if the photo is in the store
+        """
+        raise NotImplementedError()
+
+    def remove(self, digest, variant=None):
+        """
+        Delete a photo or one of its variants, nothing happens if it is not in the store
+
+        :param digest: digest of the photo
+        :param variant: name of the variant, None for the original photo
+        """
+        raise NotImplementedError()
+
+    def digests(self, older_than):
+        """
+        List the photos in the store that were last written before a point in time
+
+        :param older_than: timestamp, photos written at or after it are left out
+        :return: generator of the digests of the photos, each digest is listed once whatever variants it has
+        """
+        raise NotImplementedError()
+
+    def purge(self, digest):
+        """
+        Delete a photo along with all of its variants
+
+        :param digest: digest of the photo
+        """
+        raise NotImplementedError()
+
+    def sweep_tmp(self, older_than):
+        """
+        Delete partial files left behind by writes that never finished
+
+        :param older_than: timestamp, files written at or after it may still be in use and are kept
+        :return: number of files deleted
+        """
+        raise NotImplementedError()
+
+    def best_variant(self, digest, variant=None):
+        """
+        Pick the copy of a photo to serve. A variant that has not been made yet falls back to the original photo,
+        and the original falls back to the normalized variant once it has been dropped (see keep_original_photos)
+
+        :param digest: digest of the photo
+        :param variant: name of the preferred variant, None for the original photo
+        :return: name of the variant to open, None for the original photo
+        """
+        if variant is not None and self.exists(digest, variant):
+            return variant
+        if self.exists(digest):
+            return None
+        return ORIGINAL_REPLACEMENT
+
+    def open_best(self, digest, variant=None):
+        """
+        Open a variant of a photo, falling back as described by best_variant
+
+        :param digest: digest of the photo to open
+        :param variant: name of the preferred variant, None for the original photo
+        :return: binary file object of the photo
+        """
+        best = self.best_variant(digest, variant)
+        try:
+            return self.open(digest, best)
+        except FileNotFoundError:
+            # The original may have been dropped between picking it and opening it
+            if best is not None:
+                raise
+            return self.open(digest, ORIGINAL_REPLACEMENT)
+
+
+class FilesystemPhotoStore(PhotoStore):
+    """
+    Stores photos as files on the local filesystem. Files are fanned out into two levels of directories
+    named after the start of their digest (root/ab/cd/abcd...) so that no directory grows too large.
+    Photos are written to a temporary file first and renamed into place, readers never see partial files.
+
+    :param root: directory that holds the photos
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp = os.path.join(root, 'tmp')
+
+    def path(self, digest, variant=None):
+        """
+        :param digest: digest of the photo
+        :param variant: name of the variant, None for the original photo
+        :return: path of the file holding the photo
+        """
+        name = digest if variant is None else '{digest}.{variant}'.format(digest=digest, variant=variant)
+        return os.path.join(self.root, digest[0:2], digest[2:4], name)
+
+    def put_stream(self, stream, limit=None):
+        os.makedirs(self.tmp, exist_ok=True)
+
+        sha256 = hashlib.sha256()
+        size = 0
+        head = b''
+        with tempfile.NamedTemporaryFile(dir=self.tmp, delete=False) as tmp_file:
+            try:
+                while True:
+                    chunk = stream.read(CHUNK_BYTES)
+                    if not chunk:
+                        break
+
+                    size += len(chunk)
+                    if limit is not None and size > limit:
+                        raise UploadTooLarge(limit)
+
+                    if len(head) < 16:
+                        head += chunk[:16]
+                    sha256.update(chunk)
+                    tmp_file.write(chunk)
+
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            except BaseException:
+                os.unlink(tmp_file.name)
+                raise
+
+        digest = sha256.hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            # We already have this photo, there is no need to keep a second copy. Touching it keeps
+            # sweep_orphans from deleting it before the ticket that just referenced it again is saved
+            os.unlink(tmp_file.name)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_file.name, path)
+
+        return StoredPhoto(digest=digest, size=size, content_type=sniff_content_type(head))
+
+    def put_variant(self, digest, variant, data):
+        os.makedirs(self.tmp, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=self.tmp, delete=False) as tmp_file:
+            try:
+                tmp_file.write(data)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            except BaseException:
+                os.unlink(tmp_file.name)
+                raise
+
+        path = self.path(digest, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_file.name, path)
+
+    def open(self, digest, variant=None):
+        return open(self.path(digest, variant), 'rb')
+
+    def exists(self, digest, variant=None):
+        return os.path.exists(self.path(digest, variant))
+
+    def remove(self, digest, variant=None):
+        try:
+            os.unlink(self.path(digest, variant))
+        except FileNotFoundError:
+            pass
+
+    def _listdir(self, directory):
+        """
+        :param directory: directory to list
+        :return: sorted names in the directory, empty if it does not exist
+        """
+        try:
+            return sorted(os.listdir(directory))
+        except FileNotFoundError:
+            return []
+
+    def digests(self, older_than):
+        for first in self._listdir(self.root):
+            if len(first) != 2:
+                # Skips the tmp directory
+                continue
+            for second in self._listdir(os.path.join(self.root, first)):
+                directory = os.path.join(self.root, first, second)
+
+                # A photo counts as written when its newest copy (original or variant) was
+                newest = {}
+                for name in self._listdir(directory):
+                    digest = name.partition('.')[0]
+                    try:
+                        written = os.path.getmtime(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        continue
+                    newest[digest] = max(newest.get(digest, 0), written)
+
+                for digest in sorted(newest):
+                    if newest[digest] < older_than:
+                        yield digest
+
+    def purge(self, digest):
+        directory = os.path.dirname(self.path(digest))
+        for name in self._listdir(directory):
+            if name.partition('.')[0] == digest:
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def sweep_tmp(self, older_than):
+        removed = 0
+        for name in self._listdir(self.tmp):
+            path = os.path.join(self.tmp, name)
+            try:
+                if os.path.getmtime(path) < older_than:
+                    os.unlink(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+# Photo store backends that may be selected by the photo_store setting
+PHOTO_STORE_BACKENDS = {
+    'filesystem': FilesystemPhotoStore
+}
+
+
+def _photo_store():
+    """
+    :return: the photo store configured by the photo_store setting
+    """
+    settings = dict(SETTINGS.get('photo_store', {}))
+    backend = settings.pop('backend', 'filesystem')
+    settings.setdefault('root', os.path.join(TICKET_API_ROOT, 'photos'))
+    return PHOTO_STORE_BACKENDS[backend](**settings)
+
+
+# Create a package level photo store that may be used elsewhere, it is created the first time it is used
+photo_store = Lazy(_photo_store)
@@ -0,0 +1,231 @@
+import sqlite3
+import threading
+import time
+from ticketapi.data import SETTINGS
+from ticketapi.data.lazy import Lazy
+from ticketapi.data.logger import logger
+
+__all__ = ['MemoryBackend', 'SqliteBackend', 'RateLimiter', 'login_company_limiter', 'login_ip_limiter']
+
+
+class MemoryBackend(object):
+    """
+    Keeps token buckets in a dictionary, limits only hold within a single process
+
+    :param max_keys: once this many buckets exist, buckets that have refilled completely are dropped
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """
+        Take a token out of the bucket for key
+
+        :param key: bucket to take a token from
+        :param rate: number of tokens added to a bucket per second
+        :param burst: maximum number of tokens a bucket holds
+        :return: tuple (allowed, retry_after) where retry_after is the number of seconds until a token is available
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+
+            if len(self._buckets) > self.max_keys:
+                self._prune(now, rate, burst)
+
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def peek(self, key, rate, burst):
+        """
+        Check if the bucket for key has a token left without taking it
+
+        :param key: bucket to check
+        :param rate: number of tokens added to a bucket per second
+        :param burst: maximum number of tokens a bucket holds
+        :return: tuple (allowed, retry_after) where retry_after is the number of seconds until a token is available
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+
+        allowed = tokens >= 1
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def _prune(self, now, rate, burst):
+        """
+        Drop buckets that would be full by now, they behave the same as a bucket that does not exist
+        """
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+
+
+class SqliteBackend(object):
+    """
+    Keeps token buckets in a SQLite database so that every mod_wsgi process on the node shares the same limits.
+    Keys are chosen by clients, so buckets that have refilled completely are deleted every prune_every takes
+
+    :param path: path of the SQLite database file, it is created if it does not exist
+    :param prune_every: number of takes (in each process) between two deletions of the full buckets
+    """
+
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._takes = 0
+        self._refill_seconds = 0
+
+    def _connection(self):
+        """
+        :return: a connection for the calling thread, SQLite connections may not be shared between threads
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        """
+        Take a token out of the bucket for key
+
+        :param key: bucket to take a token from
+        :param rate: number of tokens added to a bucket per second
+        :param burst: maximum number of tokens a bucket holds
+        :return: tuple (allowed, retry_after) where retry_after is the number of seconds until a token is available
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens = min(burst, tokens + max(0, now - updated) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            connection.execute(
+                'INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                (key, tokens, now)
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        # The longest an empty bucket of any limiter sharing this backend takes to refill
+        self._refill_seconds = max(self._refill_seconds, burst / rate)
+        self._takes += 1
+        if self._takes % self.prune_every == 0:
+            self.prune(now - self._refill_seconds)
+
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def prune(self, older_than):
+        """
+        Delete buckets that were last updated before a point in time, once a bucket is full again it behaves the
+        same as a bucket that does not exist
+
+        :param older_than: timestamp, buckets updated at or after it are kept
+        :return: number of buckets deleted
+        """
+        try:
+            return self._connection().execute('DELETE FROM bucket WHERE updated < ?', (older_than,)).rowcount
+        except sqlite3.Error as e:
+            # Another process holding the database only delays the pruning until the next time
+            logger.error('Unable to prune the rate limit buckets')
+            logger.exception(e)
+            return 0
+
+    def peek(self, key, rate, burst):
+        """
+        Check if the bucket for key has a token left without taking it
+
+        :param key: bucket to check
+        :param rate: number of tokens added to a bucket per second
+        :param burst: maximum number of tokens a bucket holds
+        :return: tuple (allowed, retry_after) where retry_after is the number of seconds until a token is available
+        """
+        now = time.time()
+        row = self._connection().execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+        tokens, updated = row if row is not None else (burst, now)
+        tokens = min(burst, tokens + max(0, now - updated) * rate)
+
+        allowed = tokens >= 1
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter. Each key gets a bucket of `burst` tokens that refills at `rate` tokens per second,
+    every call to take removes a token and is refused once the bucket is empty.
+
+    :param rate: number of tokens added to a bucket per second
+    :param burst: maximum number of tokens a bucket holds
+    :param backend: MemoryBackend or SqliteBackend holding the buckets
+    :param prefix: prefix added to every key so that limiters may share a backend
+    """
+
+    def __init__(self, rate, burst, backend, prefix=''):
+        self.rate = rate
+        self.burst = burst
+        self.backend = backend
+        self.prefix = prefix
+
+    def take(self, key):
+        """
+        Take a token for key
+
+        :param key: key to rate limit on
+        :return: tuple (allowed, retry_after) where retry_after is the number of seconds until a token is available
+        """
+        return self.backend.take(self.prefix + key, self.rate, self.burst)
+
+    def peek(self, key):
+        """
+        Check if a token is left for key without taking it
+
+        :param key: key to rate limit on
+        :return: tuple (allowed, retry_after) where retry_after is the number of seconds until a token is available
+        """
+        return self.backend.peek(self.prefix + key, self.rate, self.burst)
+
+
+def _backend():
+    """
+    :return: the backend configured by the rate_limit_db setting, a MemoryBackend if it is not set
+    """
+    path = SETTINGS.get('rate_limit_db')
+    return SqliteBackend(path) if path else MemoryBackend()
+
+
+_login_backend = Lazy(_backend)
+
+# Limit login attempts per companyID and per client address, rates are given in attempts per minute.
+# A companyID is shared by all of a company's staff, its bucket is only charged for failed logins.
+# The limiters are created the first time they are used
+login_company_limiter = Lazy(lambda: RateLimiter(
+    rate=SETTINGS.get('login_company_per_minute', 5) / 60.0,
+    burst=SETTINGS.get('login_company_burst', 5),
+    backend=_login_backend.resolve(),
+    prefix='company:'
+))
+login_ip_limiter = Lazy(lambda: RateLimiter(
+    rate=SETTINGS.get('login_ip_per_minute', 20) / 60.0,
+    burst=SETTINGS.get('login_ip_burst', 20),
+    backend=_login_backend.resolve(),
+    prefix='ip:'
+))
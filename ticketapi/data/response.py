@@ -2,24 +2,56 @@ import json
 from flask import Response
 from ticketapi.data.logger import logger
 
+__all__ = ['FailureResponse', 'FAILURES']
+
 
 class FailureResponse(object):
     """
     Failure response contains methods appropriate for creating a standard failure
-    response that may be returned when a failure is encountered.
+    response that may be returned when a failure is encountered. Failure responses are
+    immutable, their JSON body is serialized once, the first time it is needed, so a
+    single instance may be shared by every thread (see FAILURES).
 
     :param error_code: error code associated with this failure response
     :param nice_message: message that may be displayed to the user if necessary
     :param debug_message: message that should not be displayed to the user, but may be used for bug reports
+    :param log: if False, the debug message is not logged as an error. Rejections of bad requests that happen
+        all the time (such as an invalid field) are only logged at the debug level
     """
-    error_code = 200
-    payload = {}
+    __slots__ = ('error_code', 'nice_message', 'debug_message', '_body')
+
+    def __init__(self, error_code, nice_message, debug_message, log=True):
+        object.__setattr__(self, 'error_code', error_code)
+        object.__setattr__(self, 'nice_message', nice_message)
+        object.__setattr__(self, 'debug_message', debug_message)
+        object.__setattr__(self, '_body', None)
+        if log:
+            logger.error(debug_message)
+        else:
+            logger.debug(debug_message)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FailureResponse is immutable')
+
+    @classmethod
+    def rejection(cls, error_code, nice_message, debug_message):
+        """
+        Create a failure response for a bad request without logging it as an error, this is the cheap path
+        used by the validators for their per field messages
 
-    def __init__(self, error_code, nice_message, debug_message):
-        self.error_code = error_code
-        self.payload['niceMessage'] = nice_message
-        self.payload['debugMessage'] = debug_message
-        logger.error(debug_message)
+        :param error_code: error code associated with this failure response
+        :param nice_message: message that may be displayed to the user if necessary
+        :param debug_message: message that should not be displayed to the user, but may be used for bug reports
+        :return: FailureResponse
+        """
+        return cls(error_code, nice_message, debug_message, log=False)
+
+    @property
+    def payload(self):
+        """
+        :return: a new dictionary holding the niceMessage and debugMessage
+        """
+        return {'niceMessage': self.nice_message, 'debugMessage': self.debug_message}
 
     def as_json(self):
         """
@@ -27,14 +59,158 @@ class FailureResponse(object):
 
         :return: JSON string representation of the payload
         """
-        return json.dumps(self.payload)
+        if self._body is None:
+            # Two threads may both serialize the body, they produce the same string
+            object.__setattr__(self, '_body', json.dumps(self.payload))
+        return self._body
 
-    def response(self):
+    def response(self, headers=None):
         """
         Create a flask response object. This object can be returned by a flask routed function in order
         to respond to a request. This is the method that may be used to standardize failure responses from
         this API
 
+        :param headers: optional dictionary of extra headers to send with the response
         :return: Flask response
         """
-        return Response(response=self.as_json(), status=self.error_code, mimetype='application/json')
+        return Response(response=self.as_json(), status=self.error_code, headers=headers, mimetype='application/json')
+
+
+def _fixed(error_code, nice_message, debug_message):
+    """
+    :return: a shared FailureResponse whose body is serialized right away
+    """
+    failure = FailureResponse(error_code, nice_message, debug_message, log=False)
+    failure.as_json()
+    return failure
+
+
+# Failure responses whose messages never change, they are created once and shared by every request.
+# Sending one does not log it, the rejection counters and the access log already record them
+FAILURES = {
+    # requires_auth
+    'auth_bad_body': _fixed(
+        400,
+        'There was an error authenticating you with the server',
+        'Request body could not be parsed as JSON'
+    ),
+    'auth_missing_key': _fixed(
+        401,
+        'There was an error authenticating you with the server',
+        'JSON was missing authentication key'
+    ),
+    'auth_invalid_key': _fixed(
+        401,
+        'There was an error authenticating you with the server',
+        'Authentication key is invalid'
+    ),
+    'auth_unavailable': _fixed(
+        520,
+        'There was an error authenticating you with the server',
+        'Exception occurred when querying database. Maybe the db is down'
+    ),
+
+    # requires_validation and the validators
+    'invalid_json': _fixed(
+        400,
+        'Something went wrong while performing the operation',
+        'Request body is not valid JSON'
+    ),
+    'not_an_object': _fixed(
+        400,
+        'Something went wrong while performing the operation',
+        'Request data is not a JSON object'
+    ),
+    'validation_error': _fixed(
+        520,
+        'Something went wrong while performing the operation',
+        'An exception occurred during validation, see traceback'
+    ),
+
+    # views
+    'session_not_found': _fixed(
+        401,
+        'There was an error authenticating your request',
+        'Session ID not found.'
+    ),
+    'invalid_credentials': _fixed(
+        401,
+        'The company ID or password was incorrect, please try again',
+        'Invalid company ID or password'
+    ),
+    'crypto_busy': _fixed(
+        503,
+        'The server is busy, please try again in a moment',
+        'Crypto worker pool is saturated'
+    ),
+    'login_unavailable': _fixed(
+        520,
+        'An error occurred while authenticating you',
+        'An exception occurred while trying to query the database'
+    ),
+    'logout_unavailable': _fixed(
+        520,
+        'An error occurred while logging you out',
+        'Unable to write to the deny list.'
+    ),
+    'update_employee_unavailable': _fixed(
+        520,
+        'An error occurred while updating your information',
+        'The database server is not responding or is down.'
+    ),
+    'submit_ticket_unavailable': _fixed(
+        520,
+        'There was trouble submitting your ticket to the database',
+        'Unable to reach the database.'
+    ),
+    'invalid_ticket': _fixed(
+        400,
+        'There was trouble submitting your ticket to the database. The data may be invalid.',
+        'Malformed/Invalid data request sent to database'
+    ),
+    'ticket_status_unavailable': _fixed(
+        520,
+        'There was trouble looking up your ticket',
+        'Unable to read the ticket spool.'
+    ),
+    'receipt_not_found': _fixed(
+        404,
+        'The ticket could not be found',
+        'Receipt not found for this session'
+    ),
+    'submit_tickets_unavailable': _fixed(
+        520,
+        'There was trouble submitting your tickets to the database',
+        'Unable to reach the database.'
+    ),
+    'list_tickets_unavailable': _fixed(
+        520,
+        'There was trouble listing your tickets',
+        'Unable to reach the database.'
+    ),
+    'photo_unavailable': _fixed(
+        520,
+        'There was trouble getting the photo',
+        'Unable to reach the database or the photo store.'
+    ),
+    'create_upload_unavailable': _fixed(
+        520,
+        'There was trouble starting your upload',
+        'Unable to write to the upload staging directory.'
+    ),
+    'upload_status_unavailable': _fixed(
+        520,
+        'There was trouble looking up your upload',
+        'Unable to read the upload staging directory.'
+    ),
+    'upload_chunk_unavailable': _fixed(
+        520,
+        'There was trouble saving part of your photo',
+        'Unable to write to the upload staging directory.'
+    ),
+    'invalid_upload_offset': _fixed(
+        400,
+        'The Upload-Offset header is missing or invalid',
+        'Upload-Offset must be an integer'
+    )
+}
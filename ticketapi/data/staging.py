@@ -0,0 +1,329 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+from ticketapi.data import SETTINGS
+from ticketapi.data import TICKET_API_ROOT
+from ticketapi.data.uploads import UploadTooLarge
+from ticketapi.data.uploads import max_photo_bytes
+from ticketapi.data.lazy import Lazy
+
+__all__ = ['UploadError', 'UploadNotFound', 'UploadOffsetError', 'UploadIncomplete', 'ChecksumMismatch',
+           'ChunkedUploads', 'chunked_uploads']
+
+# Size of the pieces chunks are copied in
+CHUNK_BYTES = 64 * 1024
+
+# Upload ids are uuid4 strings, anything else is never used as a file name
+UPLOAD_ID = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+# Checksums uploads are created with, hex SHA-256 digests
+SHA256 = re.compile(r'^[0-9a-fA-F]{64}\Z')
+
+
+class UploadError(Exception):
+    """
+    Base class of chunked upload errors
+    """
+    pass
+
+
+class UploadNotFound(UploadError):
+    """
+    Raised when an upload does not exist, has expired or belongs to another session
+    """
+    pass
+
+
+class UploadOffsetError(UploadError):
+    """
+    Raised when a chunk does not start at or before the end of what was received so far
+
+    :param offset: number of bytes received so far, where the next chunk should start
+    """
+    def __init__(self, offset):
+        self.offset = offset
+
+    def __str__(self):
+        return 'chunk must start at or before offset {offset}'.format(offset=self.offset)
+
+
+class UploadIncomplete(UploadError):
+    """
+    Raised when an upload is finalized before all of its bytes were received
+    """
+    pass
+
+
+class ChecksumMismatch(UploadError):
+    """
+    Raised when the assembled upload does not match the checksum it was created with
+    """
+    pass
+
+
+class ChunkedUploads(object):
+    """
+    Stages photos that are uploaded in chunks on the local disk until they are complete. Each upload is a file
+    holding the bytes received so far and a small JSON file describing it. Chunks may be sent again, a chunk
+    starting before the end of what was received overwrites it, so a client only has to re-send from the last
+    offset it knows was received. Uploads are locked while a chunk is written so that every process on the node
+    may share the staging directory.
+
+    :param root: directory that holds the uploads
+    :param lifetime: number of seconds an unfinished upload is kept after its last chunk
+    :param max_bytes: largest upload that may be created, defaults to max_photo_bytes()
+    """
+
+    def __init__(self, root, lifetime=86400, max_bytes=None):
+        self.root = root
+        self.lifetime = lifetime
+        self.max_bytes = max_bytes if max_bytes is not None else max_photo_bytes()
+
+    def _path(self, upload_id, extension):
+        """
+        :param upload_id: id of the upload
+        :param extension: extension of the file, part or json
+        :return: path of one of the upload's files
+        :raises UploadNotFound: if the id is malformed
+        """
+        if not UPLOAD_ID.match(upload_id or ''):
+            raise UploadNotFound(upload_id)
+        return os.path.join(self.root, '{id}.{ext}'.format(id=upload_id, ext=extension))
+
+    def _read_info(self, upload_id, auth_key):
+        """
+        :param upload_id: id of the upload
+        :param auth_key: session authKey the upload must belong to
+        :return: dictionary describing the upload
+        :raises UploadNotFound: if the upload does not exist, has expired or belongs to another session
+        """
+        try:
+            with open(self._path(upload_id, 'json'), 'r') as info_file:
+                info = json.load(info_file)
+        except FileNotFoundError:
+            raise UploadNotFound(upload_id)
+
+        if info['authKey'] != auth_key or info['updated'] + self.lifetime < time.time():
+            raise UploadNotFound(upload_id)
+        return info
+
+    def _write_info(self, upload_id, info):
+        """
+        Replace the JSON file describing an upload so that readers never see a partial file
+
+        :param upload_id: id of the upload
+        :param info: dictionary describing the upload
+        """
+        with tempfile.NamedTemporaryFile('w', dir=self.root, suffix='.tmp', delete=False) as tmp_file:
+            json.dump(info, tmp_file)
+        os.replace(tmp_file.name, self._path(upload_id, 'json'))
+
+    @contextmanager
+    def _locked(self, upload_id):
+        """
+        Hold an exclusive lock on an upload's data file
+
+        :param upload_id: id of the upload
+        :return: the data file opened for reading and writing
+        :raises UploadNotFound: if the upload does not exist
+        """
+        try:
+            part_file = open(self._path(upload_id, 'part'), 'r+b')
+        except FileNotFoundError:
+            raise UploadNotFound(upload_id)
+
+        with part_file:
+            fcntl.flock(part_file.fileno(), fcntl.LOCK_EX)
+            yield part_file
+
+    def create(self, auth_key, size, sha256, **fields):
+        """
+        Start an upload
+
+        :param auth_key: session authKey the upload belongs to
+        :param size: total size of the photo in bytes
+        :param sha256: hex SHA-256 digest of the whole photo, checked when the upload is finalized
+        :param fields: other fields to keep with the upload until it is finalized, such as the ticket's description
+        :return: id of the upload
+        :raises UploadTooLarge: if size is larger than max_bytes
+        :raises ValueError: if sha256 is not a hex SHA-256 digest
+        """
+        if not SHA256.match(sha256):
+            raise ValueError('sha256 must be 64 hexadecimal digits')
+        if size > self.max_bytes:
+            raise UploadTooLarge(self.max_bytes)
+
+        os.makedirs(self.root, exist_ok=True)
+        upload_id = str(uuid4())
+
+        open(self._path(upload_id, 'part'), 'xb').close()
+        self._write_info(upload_id, {
+            'authKey': auth_key,
+            'size': size,
+            'sha256': sha256.lower(),
+            'offset': 0,
+            'updated': time.time(),
+            'fields': fields
+        })
+        return upload_id
+
+    def status(self, upload_id, auth_key):
+        """
+        :param upload_id: id of the upload
+        :param auth_key: session authKey the upload must belong to
+        :return: dictionary with the number of bytes received so far (`offset`) and the total `size`
+        :raises UploadNotFound: if the upload does not exist, has expired or belongs to another session
+        """
+        info = self._read_info(upload_id, auth_key)
+        return {'offset': info['offset'], 'size': info['size']}
+
+    def write(self, upload_id, auth_key, offset, stream):
+        """
+        Write a chunk of an upload
+
+        :param upload_id: id of the upload
+        :param auth_key: session authKey the upload must belong to
+        :param offset: position of the chunk's first byte in the photo
+        :param stream: file like object to read the chunk from
+        :return: number of bytes received so far
+        :raises UploadNotFound: if the upload does not exist, has expired or belongs to another session
+        :raises UploadOffsetError: if the chunk starts past the bytes received so far
+        :raises UploadTooLarge: if the chunk goes past the size of the upload
+        """
+        with self._locked(upload_id) as part_file:
+            info = self._read_info(upload_id, auth_key)
+            if info.get('finalized'):
+                # The photo was already submitted, there is nothing left to receive
+                return info['offset']
+
+            if not 0 <= offset <= info['offset']:
+                raise UploadOffsetError(info['offset'])
+
+            part_file.seek(offset)
+            position = offset
+            while True:
+                chunk = stream.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+
+                position += len(chunk)
+                if position > info['size']:
+                    raise UploadTooLarge(info['size'])
+                part_file.write(chunk)
+
+            part_file.flush()
+            os.fsync(part_file.fileno())
+
+            # Only move forward once the chunk is on disk, a dropped connection keeps what was fully written
+            info['offset'] = max(info['offset'], position)
+            info['updated'] = time.time()
+            self._write_info(upload_id, info)
+            return info['offset']
+
+    def finalize(self, upload_id, auth_key, store, submit):
+        """
+        Check a complete upload against its checksum, copy it into a photo store and submit its ticket, all while
+        the upload is locked. A successful result is recorded with the upload and handed back by later calls, so a
+        finalize that is repeated (two at once, or a client retrying after losing the response) submits the ticket
+        only once. A finalize whose ticket could not be saved leaves the upload as it was, it may be retried
+        without sending the photo again (putting the same photo in the store twice is harmless, it is content
+        addressed). Finalized uploads are kept until they expire.
+
+        :param upload_id: id of the upload
+        :param auth_key: session authKey the upload must belong to
+        :param store: PhotoStore to move the photo to
+        :param submit: function taking the StoredPhoto and the fields the upload was created with that saves the
+            ticket, a falsy result means the ticket was not saved
+        :return: the result of submit, the recorded one if the upload was already finalized
+        :raises UploadNotFound: if the upload does not exist, has expired or belongs to another session
+        :raises UploadIncomplete: if not every byte was received
+        :raises ChecksumMismatch: if the photo does not match its checksum, the upload is discarded
+        """
+        with self._locked(upload_id) as part_file:
+            info = self._read_info(upload_id, auth_key)
+            if info.get('finalized'):
+                return info['result']
+
+            if info['offset'] != info['size']:
+                raise UploadIncomplete('received {offset} of {size} bytes'.format(**info))
+
+            # A chunk that was cut short for running past the end may have left bytes behind
+            part_file.truncate(info['size'])
+
+            sha256 = hashlib.sha256()
+            part_file.seek(0)
+            for chunk in iter(lambda: part_file.read(CHUNK_BYTES), b''):
+                sha256.update(chunk)
+
+            if sha256.hexdigest() != info['sha256']:
+                self._remove(upload_id)
+                raise ChecksumMismatch('expected {expected}, received {received}'.format(
+                    expected=info['sha256'],
+                    received=sha256.hexdigest()
+                ))
+
+            part_file.seek(0)
+            stored = store.put_stream(part_file)
+
+            result = submit(stored, info['fields'])
+            if result:
+                info['finalized'] = True
+                info['result'] = result
+                info['updated'] = time.time()
+                self._write_info(upload_id, info)
+
+                # The photo is in the store now, only the result has to be kept
+                part_file.truncate(0)
+
+            return result
+
+    def _remove(self, upload_id):
+        """
+        :param upload_id: id of the upload to delete
+        """
+        for extension in ('json', 'part'):
+            try:
+                os.unlink(self._path(upload_id, extension))
+            except FileNotFoundError:
+                pass
+
+    def sweep(self):
+        """
+        Delete uploads that expired without being finalized
+
+        :return: number of uploads deleted
+        """
+        removed = 0
+        deadline = time.time() - self.lifetime
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+
+        for name in names:
+            upload_id, _, extension = name.rpartition('.')
+            if extension != 'json' or not UPLOAD_ID.match(upload_id):
+                continue
+            try:
+                with open(os.path.join(self.root, name), 'r') as info_file:
+                    updated = json.load(info_file)['updated']
+            except (OSError, ValueError, KeyError):
+                continue
+            if updated < deadline:
+                self._remove(upload_id)
+                removed += 1
+
+        return removed
+
+
+# Create a package level staging area that may be used elsewhere, it is created the first time it is used
+chunked_uploads = Lazy(lambda: ChunkedUploads(
+    root=SETTINGS.get('upload_staging', os.path.join(TICKET_API_ROOT, 'staging')),
+    lifetime=SETTINGS.get('upload_lifetime', 86400)
+))
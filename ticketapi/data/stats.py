@@ -0,0 +1,45 @@
+import json
+import os
+import threading
+from ticketapi.data.logger import logger
+
+__all__ = ['StatsLogger']
+
+
+class StatsLogger(threading.Thread):
+    """
+    Background thread that writes the counters of this process (rejected requests, cache hit rates, ...) to the
+    log as one JSON line every `interval` seconds. Counters are kept per process, each line is tagged with the
+    process id so the lines of every mod_wsgi process can be added up.
+
+    :param sources: dictionary mapping a name to a function taking no arguments and returning that name's stats
+    :param interval: number of seconds between two lines
+    """
+
+    def __init__(self, sources, interval=300):
+        super().__init__(name='stats-logger', daemon=True)
+        self.sources = sources
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def snapshot(self):
+        """
+        :return: dictionary of the stats of every source, a source that fails is left out
+        """
+        stats = {'pid': os.getpid()}
+        for name, source in self.sources.items():
+            try:
+                stats[name] = source()
+            except Exception as e:
+                logger.exception(e)
+        return stats
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            logger.info('Stats {stats}'.format(stats=json.dumps(self.snapshot(), sort_keys=True)))
+
+    def stop(self):
+        """
+        Ask the thread to stop, it does not write another line
+        """
+        self._stopped.set()
@@ -0,0 +1,198 @@
+import base64
+import fcntl
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ['TokenSigner', 'DenyList']
+
+
+def _b64encode(data):
+    """
+    URL safe base64 encode without padding
+
+    :param data: bytes to encode
+    :return: encoded ascii string
+    """
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    """
+    URL safe base64 decode of a string that had its padding stripped
+
+    :param data: ascii string to decode
+    :return: decoded bytes
+    """
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class TokenSigner(object):
+    """
+    Creates and verifies stateless authorization tokens. A token is the base64 encoded JSON claims
+    followed by a '.' and the base64 encoded HMAC-SHA256 of those claims. The claims carry the
+    companyID (cid), the session's authKey (sid) and the expiration as a unix timestamp (exp).
+
+    :param secret: secret key used to sign tokens, every API node must share the same secret
+    """
+
+    def __init__(self, secret):
+        self.secret = bytes(secret, encoding='utf8')
+
+    def _signature(self, payload):
+        """
+        :param payload: encoded claims to sign
+        :return: encoded signature of the payload
+        """
+        return _b64encode(hmac.new(self.secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def sign(self, company_id, session_id, expires):
+        """
+        Create a signed token
+
+        :param company_id: companyID the session belongs to
+        :param session_id: authKey of the Session row backing this token
+        :param expires: unix timestamp at which the token stops being valid
+        :return: the token string
+        """
+        claims = json.dumps({'cid': company_id, 'sid': session_id, 'exp': int(expires)}, separators=(',', ':'))
+        payload = _b64encode(claims.encode('utf8'))
+        return '{payload}.{signature}'.format(payload=payload, signature=self._signature(payload))
+
+    def verify(self, token):
+        """
+        Verify a token's signature and expiration
+
+        :param token: token string to verify
+        :return: the token's claims as a dictionary or None if the token is invalid or expired
+        """
+        try:
+            payload, signature = token.split('.')
+            if not hmac.compare_digest(signature, self._signature(payload)):
+                return None
+            claims = json.loads(_b64decode(payload).decode('utf8'))
+        except (ValueError, TypeError, UnicodeError):
+            return None
+
+        if claims.get('exp', 0) <= time.time():
+            return None
+        return claims
+
+
+class DenyList(object):
+    """
+    A small list of revoked session ids. Entries are kept in memory and appended to a file so that every process
+    on the node sees revocations, the file is re-read whenever it changes. Entries are dropped once they expire
+    since the token they revoke would no longer be accepted anyway, and the file is rewritten with only the live
+    entries once expired ones make up most of it.
+
+    :param path: file used to share the deny list between processes, if None the list only lives in memory
+    :param reload_interval: minimum number of seconds between checks of the file for changes
+    :param compact_after: number of lines the file may hold before it is rewritten without its expired entries
+    """
+
+    def __init__(self, path=None, reload_interval=1.0, compact_after=1000):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.compact_after = compact_after
+        self._entries = {}
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _file_lock(self):
+        """
+        Hold an exclusive lock shared by every process on the node while the deny list file is written, so that
+        a revocation is never appended to a file that is being replaced
+        """
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _read(self):
+        """
+        :return: tuple (dictionary of the entries of the file that have not expired, number of lines in the file)
+        """
+        entries = {}
+        lines = 0
+        current = time.time()
+        with open(self.path, 'r') as deny_file:
+            for line in deny_file:
+                lines += 1
+                try:
+                    session_id, expires = line.split()
+                    expires = float(expires)
+                except ValueError:
+                    continue
+                if expires > current:
+                    entries[session_id] = expires
+        return entries, lines
+
+    def _reload(self):
+        """
+        Re-read the deny list file if it changed since the last time it was read
+        """
+        now = time.monotonic()
+        if self.path is None or now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+
+        self._entries, lines = self._read()
+        self._mtime = mtime
+
+        if lines > self.compact_after and lines > 2 * len(self._entries):
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrite the deny list file with only the entries that have not expired, the file is replaced atomically
+        """
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            with self._file_lock():
+                # Read again under the lock, another process may have appended since
+                entries, _ = self._read()
+                with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as tmp_file:
+                    try:
+                        for session_id, expires in entries.items():
+                            tmp_file.write('{sid} {exp}\n'.format(sid=session_id, exp=expires))
+                    except BaseException:
+                        os.unlink(tmp_file.name)
+                        raise
+                os.replace(tmp_file.name, self.path)
+        except OSError:
+            # The file is compacted by the next reload instead
+            pass
+
+    def add(self, session_id, expires):
+        """
+        Revoke a session id until it expires
+
+        :param session_id: session id to revoke
+        :param expires: unix timestamp after which the entry may be forgotten
+        """
+        with self._lock:
+            self._entries[session_id] = float(expires)
+            if self.path is not None:
+                with self._file_lock():
+                    with open(self.path, 'a') as deny_file:
+                        deny_file.write('{sid} {exp}\n'.format(sid=session_id, exp=float(expires)))
+
+    def __contains__(self, session_id):
+        with self._lock:
+            self._reload()
+            expires = self._entries.get(session_id)
+            return expires is not None and expires > time.time()
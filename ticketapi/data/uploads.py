@@ -0,0 +1,92 @@
+from ticketapi.data import SETTINGS
+
+__all__ = ['UploadTooLarge', 'is_binary_upload', 'request_fields', 'store_photo', 'max_photo_bytes']
+
+# Content types that carry the photo as raw bytes instead of base64 inside of the JSON body
+BINARY_MIMETYPES = ('multipart/form-data', 'application/octet-stream')
+
+
+def max_photo_bytes():
+    """
+    :return: largest photo, in bytes, that may be uploaded (the max_photo_bytes setting)
+    """
+    return SETTINGS.get('max_photo_bytes', 10 * 1024 * 1024)
+
+
+class UploadTooLarge(Exception):
+    """
+    Raised when an uploaded photo is larger than the allowed size
+    """
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __str__(self):
+        return 'upload exceeds {limit} bytes'.format(limit=self.limit)
+
+
+def is_binary_upload(request):
+    """
+    :param request: the current flask request
+    :return: True if the photo is sent as raw bytes (multipart/form-data or application/octet-stream)
+    """
+    return request.mimetype in BINARY_MIMETYPES
+
+
+def request_fields(request):
+    """
+    Get the fields of a request as a dictionary regardless of how they were sent. JSON bodies are parsed as JSON,
+    multipart bodies use their form fields and raw application/octet-stream bodies and GET requests use the query
+    string since they have no fields in their body. If authKey is not among the fields, it is taken from an
+    `Authorization: Bearer <authKey>` header. GET requests must use the header, an authKey in their query string
+    is ignored since their URLs end up in access and proxy logs
+
+    :param request: the current flask request
+    :return: dictionary of fields
+    :raises BadRequest: if a JSON body could not be parsed
+    """
+    if request.mimetype == 'multipart/form-data':
+        fields = request.form.to_dict()
+    elif request.method in ('GET', 'HEAD'):
+        fields = request.args.to_dict()
+        fields.pop('authKey', None)
+    elif request.mimetype == 'application/octet-stream':
+        fields = request.args.to_dict()
+    else:
+        fields = request.get_json(force=True)
+
+    authorization = request.headers.get('Authorization', '')
+    if isinstance(fields, dict) and 'authKey' not in fields and authorization.startswith('Bearer '):
+        fields = dict(fields, authKey=authorization[len('Bearer '):].strip())
+    return fields
+
+
+def store_photo(request, store, limit=None):
+    """
+    Write the raw photo of a multipart/form-data (`photo` file part) or application/octet-stream request to a
+    photo store without holding it in memory. An application/octet-stream body is streamed straight into the
+    store. A multipart part is first spooled to a temporary file by werkzeug's form parser (bounded by the
+    route's body limit, see limits_body) and copied from there, clients sending large photos should prefer
+    application/octet-stream or a chunked upload
+
+    :param request: the current flask request
+    :param store: PhotoStore to write the photo to
+    :param limit: maximum size of the photo in bytes, defaults to max_photo_bytes()
+    :return: StoredPhoto describing the stored photo or None if no photo was sent
+    :raises UploadTooLarge: if the photo is larger than limit
+    """
+    if limit is None:
+        limit = max_photo_bytes()
+    if request.content_length is not None and request.mimetype == 'application/octet-stream' \
+            and request.content_length > limit:
+        raise UploadTooLarge(limit)
+
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('photo')
+        if upload is None:
+            return None
+        stream = upload.stream
+    else:
+        stream = request.stream
+
+    stored = store.put_stream(stream, limit)
+    return stored if stored.size else None
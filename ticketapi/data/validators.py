@@ -1,20 +1,42 @@
 from ticketapi.data.fields import *
 from ticketapi.data.response import *
+from ticketapi.data.logger import logger
+from ticketapi.data.uploads import request_fields
+from ticketapi.data.uploads import max_photo_bytes
 from werkzeug.exceptions import BadRequest
 
 __all__ = [
     'Validator',
     'EmployeeInfoValidator',
     'AuthInfoValidator',
-    'TicketInfoValidator'
+    'TicketInfoValidator',
+    'BatchTicketValidator',
+    'ReceiptValidator',
+    'TicketListValidator',
+    'PhotoRequestValidator',
+    'UploadCreateValidator',
+    'UploadValidator',
+    'LogoutValidator'
 ]
 
 
-class Validator(object):
+class ValidatorMeta(type):
+    """
+    Compiles the 'fields' of every validator class into a single validation function, 'schema', when the class
+    is defined so that no time is spent walking the fields while validating a request
+    """
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        cls.schema = staticmethod(compile_schema(cls.fields))
+
+
+class Validator(object, metaclass=ValidatorMeta):
     """
     Base validator class that validates the 'current_request' given. When inheriting this class
     each concrete validator should override the 'fields' attribute with a list of
-    concrete data to be validated.
+    concrete data to be validated. The fields are compiled into 'schema' when the class is defined.
+    Once validated, 'data' holds the validated (and converted) value of every field that was present
+    in the request.
 
     :param current_request: request that needs to be validated
     """
@@ -23,45 +45,47 @@ class Validator(object):
 
     def __init__(self, current_request):
         self.current_request = current_request
+        self.data = {}
 
     def validate(self):
         """
         Validate function that checks to make sure 'current_request' is in correct
         JSON syntax. If syntax is correct JSON, 'current_request' is checked to make sure that
-        each required field is present.
+        each required field is present. The validated values are stored in 'data'.
 
         :return: FailureResponse object containing data associated with it's failure.
         """
         try:
-            try:
-                # make Flask decode JSON regardless of content type header
-                data = self.current_request.get_json(force=True)
-            except BadRequest:
-                return FailureResponse(
-                    error_code=400,
-                    debug_message='Request body is not valid JSON',
-                    nice_message='Something went wrong while performing the operation',
-                )
-
-            # Attempt to validate the fields in our fields variable
-            for field in self.fields:
-                success, reason = field.validate(data.get(field.name))
-                if not success:
-                    return FailureResponse(
-                        error_code=400,
-                        debug_message='Field {name} is invalid: {reason}'.format(
-                            name=field.name,
-                            reason=reason
-                        ),
-                        nice_message='Field {name} is invalid'.format(name=field.name)
-                    )
+            # make Flask decode JSON regardless of content type header, binary uploads use their form fields
+            data = request_fields(self.current_request)
+        except BadRequest:
+            return FAILURES['invalid_json']
+
+        return self.validate_data(data)
+
+    def validate_data(self, data):
+        """
+        Validate an already parsed dictionary, checking that each field is valid. The validated
+        values are stored in 'data'. This may be used to validate items nested within a request.
+
+        :param data: dictionary to validate
+        :return: FailureResponse object containing data associated with it's failure.
+        """
+        if not isinstance(data, dict):
+            return FAILURES['not_an_object']
+
+        try:
+            # keep the validated values so that the view does not have to convert them again
+            self.data = self.schema(data)
+        except ValidationError as e:
+            return FailureResponse.rejection(
+                error_code=400,
+                debug_message='Field {name} is invalid: {reason}'.format(name=e.name, reason=e),
+                nice_message='Field {name} is invalid'.format(name=e.name)
+            )
         except Exception as e:
             logger.exception(e)
-            return FailureResponse(
-                error_code=520,
-                debug_message='An exception occurred during validation, see traceback',
-                nice_message='Something went wrong while performing the operation',
-            )
+            return FAILURES['validation_error']
 
 
 class AuthInfoValidator(Validator):
@@ -90,15 +114,109 @@ class EmployeeInfoValidator(Validator):
     ]
 
 
+# Fields of a ticket, shared by single and batch submissions
+TICKET_FIELDS = [
+    StringField('location', required=False, max_length=64),
+    StringField('description', required=True, max_length=1024),
+    ImageField('photo', required=False, encoding='base64', max_size=max_photo_bytes)
+]
+
+
 class TicketInfoValidator(Validator):
     """
     Overrides the 'fields' attribute with the concrete data to be validated.
     In this case, 'fields' is re-defined to have three 'StringField(s)' and
     and 'ImageField'.
     """
+    fields = TICKET_FIELDS + [
+        StringField('authKey', required=True)
+    ]
+
+
+class BatchTicketValidator(Validator):
+    """
+    Overrides the 'fields' attribute with the concrete data to be validated.
+    In this case, 'fields' is re-defined to have a 'ListField' of tickets and
+    a 'StringField'. The tickets are not validated with the request since an invalid
+    ticket only skips that ticket, each one is checked on its own against 'ticket'.
+    """
+    fields = [
+        ListField('tickets', required=True, min_length=1, max_length=100),
+        StringField('authKey', required=True)
+    ]
+
+    # Field every ticket of the batch is checked against
+    ticket = ObjectField('tickets', fields=TICKET_FIELDS)
+
+
+class ReceiptValidator(Validator):
+    """
+    Overrides the 'fields' attribute with the concrete data to be validated.
+    In this case, 'fields' is re-defined to have two 'StringField(s)'.
+    """
+    fields = [
+        StringField('receipt', required=True, max_length=36),
+        StringField('authKey', required=True)
+    ]
+
+
+class TicketListValidator(Validator):
+    """
+    Overrides the 'fields' attribute with the concrete data to be validated.
+    In this case, 'fields' is re-defined to have a 'NumberField', two 'DateTimeField(s)',
+    three 'StringField(s)' and a 'BooleanField'.
+    """
     fields = [
+        NumberField('limit', required=False, min_value=1, max_value=200),
+        StringField('cursor', required=False, max_length=128),
+        DateTimeField('since', required=False),
+        DateTimeField('until', required=False),
+        StringField('location', required=False, max_length=64),
+        BooleanField('includePhoto', required=False),
+        StringField('authKey', required=True)
+    ]
+
+
+class PhotoRequestValidator(Validator):
+    """
+    Overrides the 'fields' attribute with the concrete data to be validated.
+    In this case, 'fields' is re-defined to have two 'StringField(s)'.
+    """
+    fields = [
+        StringField('variant', required=False, max_length=16),
+        StringField('authKey', required=True)
+    ]
+
+
+class UploadCreateValidator(Validator):
+    """
+    Overrides the 'fields' attribute with the concrete data to be validated.
+    In this case, 'fields' is re-defined to have a 'NumberField', a 'HexField' and three 'StringField(s)'.
+    """
+    fields = [
+        NumberField('size', required=True, min_value=1),
+        HexField('sha256', required=True, min_length=64, max_length=64),
         StringField('location', required=False, max_length=64),
         StringField('description', required=True, max_length=1024),
-        ImageField('photo', required=False, encoding='base64'),
+        StringField('authKey', required=True)
+    ]
+
+
+class UploadValidator(Validator):
+    """
+    Overrides the 'fields' attribute with the concrete data to be validated.
+    In this case, 'fields' is re-defined to have one 'StringField'.
+    """
+    fields = [
+        StringField('authKey', required=True)
+    ]
+
+
+class LogoutValidator(Validator):
+    """
+    Overrides the 'fields' attribute with the concrete data to be validated.
+    In this case, 'fields' is re-defined to have one 'StringField'.
+    """
+    fields = [
         StringField('authKey', required=True)
     ]
@@ -1,6 +1,10 @@
 from ticketapi.datalayer.models import db
 from ticketapi.datalayer.models import Authentication
 from ticketapi.datalayer.wrapper import *
+from ticketapi.apps import create_app
+
+# Bind the database to an app
+create_app(blueprints=[])
 
 # Create the basic database layout
 db.create_all()
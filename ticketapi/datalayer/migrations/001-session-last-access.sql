@@ -0,0 +1,10 @@
+-- Track the last time a session was used so sessions may expire on a sliding window
+ALTER TABLE ticketapi.Session ADD lastAccessTime DATETIME NULL;
+GO
+
+UPDATE ticketapi.Session SET lastAccessTime = creationTime WHERE lastAccessTime IS NULL;
+GO
+
+-- The expired session sweeper scans by age, keep that scan off of the live table's clustered index
+CREATE INDEX IX_Session_creationTime ON ticketapi.Session (creationTime) INCLUDE (lastAccessTime);
+GO
@@ -0,0 +1,6 @@
+-- Store an upper cased copy of companyID so logins can seek an index instead of scanning UPPER(companyID)
+ALTER TABLE ticketapi.Authentication ADD companyIDNormalized AS UPPER(companyID) PERSISTED;
+GO
+
+CREATE UNIQUE INDEX UX_Authentication_companyIDNormalized ON ticketapi.Authentication (companyIDNormalized);
+GO
@@ -0,0 +1,3 @@
+-- Record the scrypt cost parameters each password was hashed with, NULL means the old defaults (N=16384, r=8, p=1)
+ALTER TABLE ticketapi.Authentication ADD scryptN INT NULL, scryptR INT NULL, scryptP INT NULL;
+GO
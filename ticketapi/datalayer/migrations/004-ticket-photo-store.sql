@@ -0,0 +1,3 @@
+-- Photos now live in the photo store, tickets only record which photo they have
+ALTER TABLE ticketapi.Ticket ADD photoDigest CHAR(64) NULL, photoSize INT NULL, photoContentType VARCHAR(64) NULL;
+GO
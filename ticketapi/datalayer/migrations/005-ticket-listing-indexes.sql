@@ -0,0 +1,7 @@
+-- Support listing a company's tickets newest first with keyset pagination
+CREATE INDEX IX_Session_companyID ON ticketapi.Session (companyID, authKey);
+GO
+
+CREATE INDEX IX_Ticket_authKey_creationTime ON ticketapi.Ticket (authKey, creationTime DESC, ticketID DESC)
+    INCLUDE (location);
+GO
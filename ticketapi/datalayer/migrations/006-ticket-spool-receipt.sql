@@ -0,0 +1,6 @@
+-- Tickets written from the spool record their receipt so that a batch written twice is only inserted once
+ALTER TABLE ticketapi.Ticket ADD receipt CHAR(36) NULL;
+GO
+
+CREATE UNIQUE INDEX UX_Ticket_receipt ON ticketapi.Ticket (receipt) WHERE receipt IS NOT NULL;
+GO
@@ -1,47 +1,160 @@
+import threading
 from flask.ext.sqlalchemy import SQLAlchemy
 from sqlalchemy.ext.automap import automap_base
+from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy import MetaData
+from sqlalchemy import Table
 from urllib import parse
-from ticketapi.apps import app
 from ticketapi.data import SETTINGS
+from ticketapi.data.logger import logger
+from ticketapi.datalayer.snapshot import SCHEMA
+from ticketapi.datalayer.snapshot import load_snapshot
+from ticketapi.datalayer.snapshot import reflect_metadata
+from ticketapi.datalayer.snapshot import missing_columns
 
 __all__ = ['Authentication', 'Session', 'Ticket']
 
-# Get our connection string
-connection_string = "DSN={dsn};UID={username};PWD={password}".format(
-    dsn=SETTINGS['db_dsn'],
-    username=SETTINGS['db_username'],
-    password=SETTINGS['db_password']
-)
-connection_string = parse.quote_plus(connection_string)
-connection_string = "mssql+pyodbc:///?odbc_connect=%s" % connection_string
 
+def database_uri():
+    """
+    :return: the connection string of the database built from the db_dsn, db_username and db_password settings
+    """
+    connection_string = "DSN={dsn};UID={username};PWD={password}".format(
+        dsn=SETTINGS['db_dsn'],
+        username=SETTINGS['db_username'],
+        password=SETTINGS['db_password']
+    )
+    connection_string = parse.quote_plus(connection_string)
+    return "mssql+pyodbc:///?odbc_connect=%s" % connection_string
 
-# Set the app's connection string
-app.config['SQLALCHEMY_DATABASE_URI'] = connection_string
 
-# Tell SQLAlchemy to track modification of objects and emit signals
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
+def enable_fast_executemany(conn, cursor, statement, parameters, context, executemany):
+    """
+    Let pyodbc send all the parameter sets of an executemany in a single round trip. Only statements marked with
+    the fast_executemany execution option (the bulk ticket inserts) are affected
+    """
+    if executemany and context is not None and context.execution_options.get('fast_executemany') \
+            and hasattr(cursor, 'fast_executemany'):
+        cursor.fast_executemany = True
 
-# The connection recycle timeout is now 30 minutes
-app.config['SQLALCHEMY_POOL_RECYCLE'] = 1800
 
+class LazySQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy that configures its engine when it is created, on the first query, instead of at import
+    """
 
-# Get the db object and set the legacy_schema_aliasing flag to False, this flag should
-# not be needed for the current database and will throw warnings by SQLAlchemy's dialect
-db = SQLAlchemy(app)
-db.engine.dialect.legacy_schema_aliasing = False
+    def get_engine(self, app=None, bind=None):
+        engine = super().get_engine(app, bind)
 
-metadata = MetaData()
+        # Set the legacy_schema_aliasing flag to False, this flag should not be needed for
+        # the current database and will throw warnings by SQLAlchemy's dialect
+        engine.dialect.legacy_schema_aliasing = False
+
+        if not event.contains(engine, 'before_cursor_execute', enable_fast_executemany):
+            event.listen(engine, 'before_cursor_execute', enable_fast_executemany)
+        return engine
+
+
+# Get the db object, it is bound to an app by configure_app
+db = LazySQLAlchemy()
 
-metadata.reflect(db.engine, schema='ticketapi')
 
-# Automagically map the database structure into Base
+# Tables of the schema, empty until load_models fills them in from the snapshot or the live database
+metadata = MetaData()
+
+# Automagically map the database structure into Base, the classes declared below are only mapped by load_models
 Base = automap_base(metadata=metadata)
-Base.prepare()
+
 
 # Declare the tables we'll need
-Authentication = Base.classes.Authentication
-Company = Base.classes.Company
-Session = Base.classes.Session
-Ticket = Base.classes.Ticket
+class Authentication(Base):
+    __tablename__ = 'Authentication'
+    __table_args__ = {'schema': SCHEMA}
+
+
+class Company(Base):
+    __tablename__ = 'Company'
+    __table_args__ = {'schema': SCHEMA}
+
+
+class Session(Base):
+    __tablename__ = 'Session'
+    __table_args__ = {'schema': SCHEMA}
+
+
+class Ticket(Base):
+    __tablename__ = 'Ticket'
+    __table_args__ = {'schema': SCHEMA}
+
+
+_models_loaded = False
+_models_lock = threading.Lock()
+
+
+def load_models():
+    """
+    Map the models onto the schema. The schema is read from the schema snapshot so that starting a process does
+    not query the database catalog, the tables are only reflected from the live database if there is no usable
+    snapshot. Only the first call does anything
+
+    :raises RuntimeError: if the schema is missing a column the procedures use
+    """
+    global _models_loaded
+    with _models_lock:
+        if _models_loaded:
+            return
+
+        snapshot = load_snapshot()
+        if snapshot is not None:
+            schema = snapshot[0]
+            logger.info('Loaded schema snapshot created at {created}'.format(created=snapshot[1]))
+        else:
+            logger.warning('Reflecting the schema from the database, run schemasnapshot.py to avoid this on startup')
+            reflect_engine = create_engine(database_uri())
+            schema = reflect_metadata(reflect_engine)
+            reflect_engine.dispose()
+
+        # Refuse to start on a schema that is missing a migration instead of failing at request time
+        missing = missing_columns(schema)
+        if missing:
+            logger.error('The database schema is missing columns {columns}'.format(columns=', '.join(missing)))
+            raise RuntimeError('The database schema is missing columns {columns}, apply the migrations in '
+                               'ticketapi/datalayer/migrations'.format(columns=', '.join(missing)))
+
+        # Fill in the tables of the declared classes (and add the others) the same way automap extends the
+        # tables it reflects, then map them
+        for table in schema.sorted_tables:
+            Table(
+                table.name,
+                metadata,
+                *[column.copy() for column in table.columns],
+                schema=table.schema,
+                extend_existing=True
+            )
+        Base.prepare()
+
+        _models_loaded = True
+
+
+def configure_app(app):
+    """
+    Set up an app to use the database and map the models. The engine is only created, and the database only
+    connected to, when the first query runs (or when there is no schema snapshot to map the models from)
+
+    :param app: the flask app
+    """
+    # Set the app's connection string
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+
+    # Tell SQLAlchemy to track modification of objects and emit signals
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
+
+    # The connection recycle timeout is now 30 minutes
+    app.config['SQLALCHEMY_POOL_RECYCLE'] = 1800
+
+    # The CLI apps and background threads query outside of a request, so the app is also bound directly
+    db.app = app
+    db.init_app(app)
+
+    load_models()
@@ -5,13 +5,174 @@ from ticketapi.datalayer.models import Session
 from ticketapi.datalayer.models import Ticket
 from ticketapi.data.logger import logger
 from ticketapi.data.crypto import crypto
+from ticketapi.data.crypto import crypto_pool
+from ticketapi.data.crypto import CryptoConsts
+from ticketapi.data.crypto import CryptoBusyError
+from ticketapi.data.cache import TTLCache
+from ticketapi.data.lazy import Lazy
+from ticketapi.data.tokens import TokenSigner
+from ticketapi.data.tokens import DenyList
+from ticketapi.data import SETTINGS
+from ticketapi.data.photostore import photo_store
+from ticketapi.data.photostore import ORIGINAL_REPLACEMENT
+from ticketapi.data.staging import chunked_uploads
+from ticketapi.data.imaging import schedule_variants
+from ticketapi.data.imaging import VARIANTS
+from ticketapi.datalayer.spool import TicketSpool
+from ticketapi.datalayer.spool import SpoolWriter
+from ticketapi.data import TICKET_API_ROOT
 from sqlalchemy import func
+from sqlalchemy import exists
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy import case
+from sqlalchemy.orm import load_only
 from uuid import uuid4
+from concurrent.futures import ProcessPoolExecutor
+import os
+import threading
 from datetime import datetime
+from datetime import timedelta
 import base64
+import hashlib
+import io
+import time
 
 
-__all__ = ['add_auth', 'authenticate', 'update_employee', 'submit_ticket', 'check_auth']
+__all__ = [
+    'add_auth', 'add_auths', 'authenticate', 'update_employee', 'submit_ticket', 'submit_tickets',
+    'spool_ticket', 'spooled_ticket_status', 'start_spool_writer', 'purge_spool',
+    'list_tickets', 'open_ticket_photo', 'async_ingest',
+    'create_upload', 'upload_status', 'write_upload_chunk', 'finalize_upload',
+    'check_auth', 'resolve_auth', 'forget_auth', 'revoke_auth', 'sweep_sessions', 'sweep_orphan_photos',
+    'auth_cache', 'credential_cache'
+]
+
+# The settings below are read when they are used, not when this module is imported
+
+
+def _session_lifetime():
+    """
+    :return: number of seconds a session stays valid, 0 means sessions never expire
+    """
+    return SETTINGS.get('session_lifetime', 0)
+
+
+def _session_sliding():
+    """
+    :return: True if the lifetime is counted from the last time the session was used instead of its creation
+    """
+    return SETTINGS.get('session_sliding', False)
+
+
+def _session_refresh_interval():
+    """
+    :return: minimum number of seconds between two writes of a sliding session's lastAccessTime
+    """
+    return SETTINGS.get('session_refresh_interval', 60)
+
+
+def _auth_tokens():
+    """
+    :return: True if /login hands out signed tokens that can be checked without going to the database
+    """
+    return SETTINGS.get('auth_tokens', False)
+
+
+def _token_lifetime():
+    """
+    A token never outlives its Session row, tickets submitted with it reference the row and sweep_sessions deletes
+    it once the session lifetime is over, so token_lifetime is capped at session_lifetime
+
+    :return: number of seconds a signed token stays valid, tokens always expire
+    """
+    session_lifetime = _session_lifetime()
+    token_lifetime = SETTINGS.get('token_lifetime', session_lifetime or 86400)
+    return min(token_lifetime, session_lifetime) if session_lifetime else token_lifetime
+
+
+def async_ingest():
+    """
+    :return: True if submitted tickets are written to a local spool and a background writer moves them to the
+        database
+    """
+    return SETTINGS.get('async_ingest', False)
+
+
+# Signer for stateless tokens and the list of revoked sessions
+token_signer = Lazy(lambda: TokenSigner(SETTINGS['token_secret']))
+deny_list = Lazy(lambda: DenyList(SETTINGS.get('deny_list_file')))
+
+# Spool of tickets accepted but not yet written to the database and the writer draining it
+ticket_spool = Lazy(lambda: TicketSpool(
+    SETTINGS.get('ingest_spool', os.path.join(TICKET_API_ROOT, 'spool', 'tickets.db'))
+))
+_spool_writer = None
+_spool_writer_lock = threading.Lock()
+
+
+# Cache of authorization keys that have already been found in the Session table mapped to their companyID
+auth_cache = Lazy(lambda: TTLCache(
+    maxsize=SETTINGS.get('auth_cache_size', 4096),
+    ttl=SETTINGS.get('auth_cache_ttl', 300)
+))
+
+# Cache of Authentication rows keyed by their normalized companyID
+credential_cache = Lazy(lambda: TTLCache(
+    maxsize=SETTINGS.get('credential_cache_size', 1024),
+    ttl=SETTINGS.get('credential_cache_ttl', 600)
+))
+
+
+def _normalize_company_id(company_id):
+    """
+    :param company_id: companyID as entered by a user
+    :return: the companyID as stored in Authentication.companyIDNormalized
+    """
+    return company_id.upper()
+
+
+def _get_credentials(company_id):
+    """
+    Get the stored credentials for a companyID, this is answered from the credential cache when possible
+    and otherwise by a seek on the normalized companyID index
+
+    :param company_id: companyID to look up, case insensitive
+    :return: dictionary with the companyID, hash, salt, techneauxTechCompanyID and scrypt params (N, r, p)
+        or None if it does not exist
+    """
+    normalized = _normalize_company_id(company_id)
+    credentials = credential_cache.get(normalized)
+    if credentials is not None:
+        return credentials
+
+    with DB() as s:
+        selected_auth = s.query(
+            Authentication.companyID,
+            Authentication.hash,
+            Authentication.salt,
+            Authentication.techneauxTechCompanyID,
+            Authentication.scryptN,
+            Authentication.scryptR,
+            Authentication.scryptP
+        ).filter(Authentication.companyIDNormalized == normalized).first()
+
+    if selected_auth is None:
+        return None
+
+    credentials = {
+        'companyID': selected_auth.companyID,
+        'hash': base64.standard_b64decode(selected_auth.hash),
+        'salt': base64.standard_b64decode(selected_auth.salt),
+        'techneauxTechCompanyID': selected_auth.techneauxTechCompanyID,
+        'params': (
+            selected_auth.scryptN or CryptoConsts.DEFAULT_N,
+            selected_auth.scryptR or CryptoConsts.DEFAULT_R,
+            selected_auth.scryptP or CryptoConsts.DEFAULT_P
+        )
+    }
+    credential_cache.set(normalized, credentials)
+    return credentials
 
 
 def add_auth(**kwargs):
@@ -36,8 +197,8 @@ def add_auth(**kwargs):
     if all([company_name, company_id, password]):
         try:
             with DB() as s:
-                selected_auth = s.query(Authentication)\
-                    .filter(func.upper(Authentication.companyID) == func.upper(kwargs['companyID']))\
+                selected_auth = s.query(Authentication.companyID)\
+                    .filter(Authentication.companyIDNormalized == _normalize_company_id(company_id))\
                     .first()
 
                 # Test if there is already a pre-existing companyID with the given value
@@ -57,7 +218,7 @@ def add_auth(**kwargs):
                     return False, reason
 
                 # Generate the hash and salt values
-                hashval, saltval = crypto.hash(password)
+                hashval, saltval = crypto_pool.hash(password)
 
                 # techneaux company identifier
                 tech_comp = selected_company.CompanyID
@@ -67,10 +228,16 @@ def add_auth(**kwargs):
                     techneauxTechCompanyID=tech_comp,
                     companyID=company_id,
                     hash=base64.standard_b64encode(hashval).decode('ascii'),
-                    salt=base64.standard_b64encode(saltval).decode('ascii')
+                    salt=base64.standard_b64encode(saltval).decode('ascii'),
+                    scryptN=crypto.params[0],
+                    scryptR=crypto.params[1],
+                    scryptP=crypto.params[2]
                 )
                 s.add(new_auth)
 
+                # Drop any credentials this process cached for the companyID
+                credential_cache.invalidate(_normalize_company_id(company_id))
+
                 logger.info('Added authentication for {tech_comp} as {comp}'.format(
                     tech_comp=tech_comp,
                     comp=company_id
@@ -86,6 +253,141 @@ def add_auth(**kwargs):
         return False, reason
 
 
+def _chunks(items, size):
+    """
+    Split a list into lists of at most size items
+
+    :param items: list to split
+    :param size: maximum size of each chunk
+    :return: generator of chunks
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def add_auths(rows, chunk_size=100, workers=None):
+    """
+    Add many companies to the database at once. All company names are resolved and all existing companyIDs
+    are found up front, passwords are hashed across a process pool and the new rows are inserted in chunks
+    that are each committed in their own transaction
+
+    :param rows: list of dictionaries each containing a companyName, companyID and password
+    :param chunk_size: number of rows to insert per transaction
+    :param workers: number of processes used to hash passwords, defaults to the number of CPUs
+    :return: list of tuples (companyID, success, reason) in the same order as rows
+    """
+    results = [None] * len(rows)
+    pending = []
+    seen = set()
+
+    # Reject incomplete rows and companyIDs that appear more than once in the batch
+    for index, row in enumerate(rows):
+        company_id = row.get('companyID')
+        if not all([row.get('companyName'), company_id, row.get('password')]):
+            results[index] = (company_id, False, 'companyID, password, and companyName must be provided')
+        elif len(row['password']) > 16:
+            results[index] = (company_id, False, 'password must be at most 16 characters')
+        elif _normalize_company_id(company_id) in seen:
+            results[index] = (company_id, False, 'companyID appears more than once in the batch')
+        else:
+            seen.add(_normalize_company_id(company_id))
+            pending.append(index)
+
+    # Resolve every company name and find every existing companyID, chunked to stay under the parameter limit
+    names = list({rows[index]['companyName'] for index in pending})
+    companies = {}
+    existing = set()
+    with DB() as s:
+        for chunk in _chunks(names, 1000):
+            for company in s.query(Company.CompanyName, Company.CompanyID).filter(Company.CompanyName.in_(chunk)):
+                companies[company.CompanyName] = company.CompanyID
+        for chunk in _chunks(list(seen), 1000):
+            for auth in s.query(Authentication.companyIDNormalized)\
+                    .filter(Authentication.companyIDNormalized.in_(chunk)):
+                existing.add(auth.companyIDNormalized)
+
+    to_insert = []
+    for index in pending:
+        row = rows[index]
+        if _normalize_company_id(row['companyID']) in existing:
+            results[index] = (row['companyID'], False, 'companyID already exists')
+        elif row['companyName'] not in companies:
+            results[index] = (row['companyID'], False, 'companyName "{name}" does not exist'.format(
+                name=row['companyName']
+            ))
+        else:
+            to_insert.append(index)
+
+    # Hash all the passwords at once, this is the expensive part
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(crypto.hash, [rows[index]['password'] for index in to_insert], chunksize=8))
+
+    for chunk in _chunks(list(zip(to_insert, hashes)), chunk_size):
+        mappings = [{
+            'techneauxTechCompanyID': companies[rows[index]['companyName']],
+            'companyID': rows[index]['companyID'],
+            'hash': base64.standard_b64encode(hashval).decode('ascii'),
+            'salt': base64.standard_b64encode(saltval).decode('ascii'),
+            'scryptN': crypto.params[0],
+            'scryptR': crypto.params[1],
+            'scryptP': crypto.params[2]
+        } for index, (hashval, saltval) in chunk]
+
+        try:
+            with DB() as s:
+                s.bulk_insert_mappings(Authentication, mappings)
+        except Exception as e:
+            logger.exception(e)
+            for index, _ in chunk:
+                results[index] = (rows[index]['companyID'], False, str(e))
+            continue
+
+        for index, _ in chunk:
+            credential_cache.invalidate(_normalize_company_id(rows[index]['companyID']))
+            results[index] = (rows[index]['companyID'], True, 'Success')
+        logger.info('Added authentication for {count} companies'.format(count=len(chunk)))
+
+    return results
+
+
+def _rehash(credentials, password):
+    """
+    Hash a verified password again with the current scrypt cost parameters and store it. This is best effort,
+    if the crypto pool is busy or the database write fails the row is left alone and will be upgraded on a
+    later login
+
+    :param credentials: credentials dictionary returned by _get_credentials
+    :param password: the verified plain text password
+    """
+    try:
+        hashval, saltval = crypto_pool.hash(password)
+    except CryptoBusyError:
+        logger.warning('Crypto pool busy, not rehashing {comp}'.format(comp=credentials['companyID']))
+        return
+
+    try:
+        with DB() as s:
+            s.query(Authentication)\
+                .filter(Authentication.companyIDNormalized == _normalize_company_id(credentials['companyID']))\
+                .update({
+                    Authentication.hash: base64.standard_b64encode(hashval).decode('ascii'),
+                    Authentication.salt: base64.standard_b64encode(saltval).decode('ascii'),
+                    Authentication.scryptN: crypto.params[0],
+                    Authentication.scryptR: crypto.params[1],
+                    Authentication.scryptP: crypto.params[2]
+                }, synchronize_session=False)
+    except Exception as e:
+        logger.exception(e)
+        logger.warning('Unable to store the rehash of {comp}'.format(comp=credentials['companyID']))
+        return
+
+    credential_cache.invalidate(_normalize_company_id(credentials['companyID']))
+    logger.info('Rehashed {comp} with scrypt params {params}'.format(
+        comp=credentials['companyID'],
+        params=crypto.params
+    ))
+
+
 def authenticate(**kwargs):
     """
     Authenticate a new session with some given credentials. This will provide the user with a
@@ -94,48 +396,60 @@ def authenticate(**kwargs):
     :param kwargs:
         companyID - the company identifier created and provided by Techneaux
         password - password to authenticate against, currently this must be the encrypted version of the password
-    :return: a new authorization key or False (if bad credentials were provided or the companyID/password was not found)
+    :return: a new authorization key (a signed token if auth_tokens is set) or False (if bad credentials were
+        provided or the companyID/password was not found)
+    :raises CryptoBusyError: if the password could not be checked because the crypto pool is saturated
     """
     if 'companyID' in kwargs and 'password' in kwargs:
-        with DB() as s:
-            # Query the database for a password and companyID combination
-            selected_auth = s.query(Authentication)\
-                .filter(func.upper(Authentication.companyID) == func.upper(kwargs['companyID']))\
-                .first()
-
-            password_verified = False
-            if selected_auth is not None:
-                password_verified = crypto.check(
-                    kwargs['password'],
-                    base64.standard_b64decode(selected_auth.hash),
-                    base64.standard_b64decode(selected_auth.salt)
-                )
+        # Get the stored credentials for this companyID, no database session is held while hashing
+        credentials = _get_credentials(kwargs['companyID'])
 
-            # If this combination exist, the user provided valid credentials
-            if password_verified:
-                uuid = str(uuid4())
-                company_id = selected_auth.companyID
+        # Verify the password in the crypto pool, this may raise CryptoBusyError when the pool is saturated
+        password_verified = False
+        if credentials is not None:
+            company_id = credentials['companyID']
+            password_verified = crypto_pool.check(
+                kwargs['password'],
+                credentials['hash'],
+                credentials['salt'],
+                credentials['params']
+            )
 
+        # If this combination exist, the user provided valid credentials
+        if password_verified:
+            uuid = str(uuid4())
+
+            with DB() as s:
                 # Create a new session row
+                now = datetime.now()
                 new_session = Session(
                     authKey=uuid,
-                    creationTime=datetime.now(),
+                    creationTime=now,
+                    lastAccessTime=now,
                     companyID=company_id
                 )
                 s.add(new_session)
 
-                logger.info('Authorized {comp} with new auth {auth}'.format(
-                    comp=company_id,
-                    auth=uuid
-                ))
+            # Upgrade the stored hash now that we know the password if the cost parameters have changed
+            if credentials['params'] != crypto.params:
+                _rehash(credentials, kwargs['password'])
 
-                # And return the authorization key
-                return new_session.authKey
-            else:
-                logger.error('Unable to authorize the company {company}, check credentials'.format(
-                    company=kwargs.get('companyID')
-                ))
-                return False
+            logger.info('Authorized {comp} with new auth {auth}'.format(
+                comp=company_id,
+                auth=uuid
+            ))
+
+            # In token mode the Session row is only kept for auditing, the client gets a signed token instead
+            if _auth_tokens():
+                return token_signer.sign(company_id, uuid, time.time() + _token_lifetime())
+
+            # And return the authorization key
+            return uuid
+        else:
+            logger.error('Unable to authorize the company {company}, check credentials'.format(
+                company=kwargs.get('companyID')
+            ))
+            return False
     else:
         logger.error('companyID and password must be provided to the authenticate method')
         return False
@@ -155,57 +469,283 @@ def update_employee(**kwargs):
     :return: True if the employee was updated, False if the employee was not updated
     """
     if 'authKey' in kwargs:
+        # Signed tokens have to be turned back into the authKey of their Session row
+        resolved = _resolve_session(kwargs)
+        if resolved is None:
+            logger.error('Unable to find an employee associated with the provided authentication key')
+            return False
+
         with DB() as s:
-            # Attempt to get an employee associated with the authorization key
-            employee = s.query(Session).filter(Session.authKey == kwargs['authKey']).first()
-
-            # If we have a valid employee, then update his/her information
-            if employee is not None:
-                employee.firstName = kwargs.get('firstName', '')
-                employee.lastName = kwargs.get('lastName', '')
-                employee.email = kwargs.get('email', '')
-                employee.phoneNumber = kwargs.get('phoneNumber', '')
-
-                logger.info('Updated info for {first} {last} as email={email} phone={phone}'.format(
-                    first=kwargs.get('firstName', ''),
-                    last=kwargs.get('lastName', ''),
-                    email=kwargs.get('email', ''),
-                    phone=kwargs.get('phoneNumber', '')
-                ))
+            # Update the session associated with the authorization key without loading it first
+            updated = s.query(Session)\
+                .filter(Session.authKey == resolved[0])\
+                .update({
+                    Session.firstName: kwargs.get('firstName', ''),
+                    Session.lastName: kwargs.get('lastName', ''),
+                    Session.email: kwargs.get('email', ''),
+                    Session.phoneNumber: kwargs.get('phoneNumber', '')
+                }, synchronize_session=False)
 
-                return True
-            else:
-                logger.error('Unable to find an employee associated with the provided authentication key')
-                return False
+        # If we updated a session, then the employee existed
+        if updated:
+            logger.info('Updated info for {first} {last} as email={email} phone={phone}'.format(
+                first=kwargs.get('firstName', ''),
+                last=kwargs.get('lastName', ''),
+                email=kwargs.get('email', ''),
+                phone=kwargs.get('phoneNumber', '')
+            ))
+
+            return True
+        else:
+            logger.error('Unable to find an employee associated with the provided authentication key')
+            return False
     else:
         logger.error('authKey must be provided for the update_employee method')
         return False
 
 
+def _session_expiry(creation_time, last_access_time):
+    """
+    Get the time at which a session expires based on the configured session lifetime
+
+    :param creation_time: creationTime of the session
+    :param last_access_time: lastAccessTime of the session, may be None
+    :return: the datetime the session expires at or None if sessions do not expire
+    """
+    if not _session_lifetime():
+        return None
+
+    start = creation_time
+    if _session_sliding() and last_access_time is not None:
+        start = last_access_time
+    return start + timedelta(seconds=_session_lifetime())
+
+
 def check_auth(**kwargs):
     """
-    Check if an authorization key has been created. If an authorization key has been generated
+    Check if an authorization key has been created and has not expired. If an authorization key has been generated
     then the provided `authKey` was successfully authorized as some point
 
     :param kwargs:
-        authKey - authorization key to test
-    :return: True if the the authKey was found in the database, False otherwise
+        authKey - authorization key or signed token to test
+    :return: True if the the authKey is valid, False otherwise
+    """
+    return resolve_auth(**kwargs) is not None
+
+
+def resolve_auth(**kwargs):
+    """
+    Resolve an authorization key to the session it belongs to. Signed tokens are verified without touching the
+    database, plain authorization keys are looked up in the auth cache and then the Session table. When sliding
+    sessions are enabled, a successful database lookup also pushes the session's expiration forward
+
+    :param kwargs:
+        authKey - authorization key or signed token to resolve
+    :return: tuple of (authKey, companyID) of the session or None if the key is invalid, expired or revoked
+    """
+    auth_key = kwargs.get('authKey')
+    if auth_key is None:
+        logger.error('authKey must be provided for the resolve_auth method')
+        return None
+
+    # Signed tokens carry everything we need, only the deny list has to be consulted
+    if _auth_tokens() and '.' in auth_key:
+        claims = token_signer.verify(auth_key)
+        if claims is None:
+            logger.error('Authorization token is invalid or expired')
+            return None
+        if claims['sid'] in deny_list:
+            logger.error('Authorization token for {auth} has been revoked'.format(auth=claims['sid']))
+            return None
+        return claims['sid'], claims['cid']
+
+    if auth_key in deny_list:
+        logger.error('Authorization key {auth} has been revoked'.format(auth=auth_key))
+        return None
+
+    # Keys we have already seen in the Session table do not need another round trip
+    company_id = auth_cache.get(auth_key)
+    if company_id is not None:
+        return auth_key, company_id
+
+    with DB() as s:
+        # Attempt to get an session associated with the auth key
+        the_session = s.query(Session.companyID, Session.creationTime, Session.lastAccessTime)\
+            .filter(Session.authKey == auth_key)\
+            .first()
+
+        # If we have a valid session, then they key has been authorized as long as it has not expired
+        if the_session is not None:
+            now = datetime.now()
+            expires = _session_expiry(the_session.creationTime, the_session.lastAccessTime)
+            if expires is not None and expires <= now:
+                forget_auth(authKey=auth_key)
+                logger.error('Authorization key {auth} expired at {expires}'.format(auth=auth_key, expires=expires))
+                return None
+
+            # Slide the session forward, but only write to the row every so often
+            last_access = the_session.lastAccessTime or the_session.creationTime
+            if _session_sliding() and now - last_access >= timedelta(seconds=_session_refresh_interval()):
+                s.query(Session)\
+                    .filter(Session.authKey == auth_key)\
+                    .update({Session.lastAccessTime: now}, synchronize_session=False)
+                expires = _session_expiry(the_session.creationTime, now)
+
+            # Never cache a key past its expiration, sliding sessions must come back to refresh the row
+            ttl = auth_cache.ttl
+            if expires is not None:
+                remaining = (expires - now).total_seconds()
+                ttl = min(ttl, remaining / 2 if _session_sliding() else remaining)
+            auth_cache.set(auth_key, the_session.companyID, ttl=ttl)
+
+            logger.info('Authorization key {auth} is valid'.format(auth=auth_key))
+            return auth_key, the_session.companyID
+
+    logger.error('Unable to find a session associated with the provided authentication key')
+    return None
+
+
+def _resolve_session(kwargs):
+    """
+    Resolve the session of a procedure's authKey. Views pass the session requires_auth already resolved the
+    authKey to as `session` so that it is not looked up a second time
+
+    :param kwargs: keyword arguments of the procedure, holding authKey and optionally session
+    :return: tuple of (authKey, companyID) of the session or None if the key is invalid, expired or revoked
+    """
+    session = kwargs.get('session')
+    if session is not None:
+        return session
+    return resolve_auth(authKey=kwargs.get('authKey'))
+
+
+def forget_auth(**kwargs):
+    """
+    Remove an authorization key from the authorization cache. This must be called whenever a session
+    is revoked or expires so that the key stops being accepted
+
+    :param kwargs:
+        authKey - authorization key to forget
     """
     auth_key = kwargs.get('authKey')
     if auth_key is not None:
-        with DB() as s:
-            # Attempt to get an session associated with the auth key
-            the_session = s.query(Session).filter(Session.authKey == auth_key).first()
+        auth_cache.invalidate(auth_key)
 
-            # If we have a valid session, then they key has been authorized
-            if the_session is not None:
-                logger.info('Authorization key {auth} is valid'.format(auth=auth_key))
-                return True
-            logger.error('Unable to find a session associated with the provided authentication key')
+
+def revoke_auth(**kwargs):
+    """
+    Revoke an authorization key or signed token so that it is no longer accepted. The session is added
+    to the deny list until it would have expired on its own
+
+    :param kwargs:
+        authKey - authorization key or signed token to revoke
+        session - optionally the session requires_auth already resolved the authKey to
+    :return: True if the key was revoked, False if it was not valid to begin with
+    """
+    resolved = _resolve_session(kwargs)
+    if resolved is None:
+        return False
+
+    session_id, company_id = resolved
+    lifetime = max(_token_lifetime() if _auth_tokens() else 0, _session_lifetime()) or 10 * 365 * 86400
+    deny_list.add(session_id, time.time() + lifetime)
+    forget_auth(authKey=session_id)
+
+    logger.info('Revoked authorization key {auth} for {comp}'.format(auth=session_id, comp=company_id))
+    return True
+
+
+def sweep_sessions(batch_size=500, max_batches=None):
+    """
+    Delete expired sessions in small batches, each batch is committed on its own so that locks on the
+    Session table are only ever held briefly. Sessions that tickets were submitted under are kept since
+    tickets reference them, this includes tickets still waiting in the spool. check_auth will still reject
+    them once they have expired
+
+    :param batch_size: number of sessions to delete per transaction
+    :param max_batches: stop after this many batches, None will sweep until no expired sessions are left
+    :return: the number of sessions that were deleted
+    """
+    if not _session_lifetime():
+        logger.info('Sessions do not expire, there is nothing to sweep')
+        return 0
+
+    cutoff = datetime.now() - timedelta(seconds=_session_lifetime())
+    if _session_sliding():
+        expired = func.coalesce(Session.lastAccessTime, Session.creationTime) < cutoff
     else:
-        logger.error('authKey must be provided for the check_auth method')
+        expired = Session.creationTime < cutoff
+    has_tickets = exists().where(Ticket.authKey == Session.authKey)
 
-    return False
+    deleted = 0
+    batches = 0
+    last_auth_key = ''
+    while max_batches is None or batches < max_batches:
+        with DB() as s:
+            # Walk the sessions in order, those kept for their spooled tickets would otherwise be found again
+            candidates = [row.authKey for row in s.query(Session.authKey)
+                          .filter(expired)
+                          .filter(~has_tickets)
+                          .filter(Session.authKey > last_auth_key)
+                          .order_by(Session.authKey)
+                          .limit(batch_size)]
+
+            spooled = ticket_spool.auth_keys(candidates)
+            auth_keys = [auth_key for auth_key in candidates if auth_key not in spooled]
+
+            if auth_keys:
+                s.query(Session)\
+                    .filter(Session.authKey.in_(auth_keys))\
+                    .delete(synchronize_session=False)
+
+        if not candidates:
+            break
+        last_auth_key = candidates[-1]
+
+        for auth_key in auth_keys:
+            forget_auth(authKey=auth_key)
+
+        deleted += len(auth_keys)
+        batches += 1
+        logger.info('Swept {count} expired sessions'.format(count=len(auth_keys)))
+
+    return deleted
+
+
+def sweep_orphan_photos(grace=86400, batch_size=500):
+    """
+    Delete photos that no ticket refers to, such as the photo of a ticket whose insert failed after the photo was
+    stored. Only photos written more than grace seconds ago are considered, so the photo of a ticket that is being
+    submitted right now is never deleted. Partial files left in the store by interrupted writes are removed too
+
+    :param grace: number of seconds a photo may go without a ticket referring to it
+    :param batch_size: number of photos checked against the Ticket table per query
+    :return: the number of photos that were deleted
+    """
+    older_than = time.time() - grace
+    photo_store.sweep_tmp(older_than)
+
+    deleted = 0
+    digests = photo_store.digests(older_than)
+    while True:
+        batch = [digest for _, digest in zip(range(batch_size), digests)]
+        if not batch:
+            break
+
+        with DB() as s:
+            referenced = {row.photoDigest for row in s.query(Ticket.photoDigest)
+                          .filter(Ticket.photoDigest.in_(batch))
+                          .distinct()}
+        referenced |= ticket_spool.photo_digests(batch)
+
+        for digest in batch:
+            if digest not in referenced:
+                photo_store.purge(digest)
+                deleted += 1
+
+    if deleted:
+        logger.info('Swept {count} photos no ticket refers to'.format(count=deleted))
+    return deleted
 
 
 def submit_ticket(**kwargs):
@@ -217,57 +757,500 @@ def submit_ticket(**kwargs):
         authKey - authorization key that has been previously provided by the the API
         description - description of the ticket that is being submitted
         location - physical location (such as a site or address) that the issue is being incurred
-        photo - photograph associated with the issue
+        photo - bytes of the photograph associated with the issue, already decoded by the validator
+        storedPhoto - StoredPhoto of a photograph that was already written to the photo store, used instead of photo
     :return: True if the ticket has successfully been submitted, False otherwise
     """
     if 'authKey' in kwargs and 'description' in kwargs:
-        with DB() as s:
-            # Get the session associated with this auth key if one exists
-            the_session = s.query(Session).filter(Session.authKey == kwargs['authKey']).first()
-
-            # If we found a session we will create a new ticket
-            if the_session is not None:
-
-                try:
-                    # get the photo passed to this call and ensure it is
-                    # not None or empty string, if it is, we will insert the
-                    # image as empty because we will technically support no image
-                    photo_enc = kwargs.get('photo', '')
-                    if photo_enc is not None or photo_enc.strip() != '':
-                        # Here we attempt to base64 decode the image using the standard
-                        # base64 alphabet, this will throw an exception if it is not in
-                        # the correct base64 format (wrong padding, etc)
-                        photo_data = base64.standard_b64decode(photo_enc.replace('\n', ''))
-                    else:
-                        photo_data = None
-                except Exception as e:
-                    logger.exception(e)
-                    return False
+        # Ensure the session associated with this auth key exists, this is usually answered by the auth cache
+        resolved = _resolve_session(kwargs)
+        if resolved is not None:
+            auth_key = resolved[0]
+
+            # The photo goes to the photo store, the ticket only records its digest
+            stored = kwargs.get('storedPhoto')
+            if stored is None and kwargs.get('photo'):
+                stored = photo_store.put(kwargs['photo'])
 
+            with DB() as s:
                 # Create the ticket and add it to the database
                 new_ticket = Ticket(
-                    authKey=kwargs['authKey'],
+                    authKey=auth_key,
                     description=kwargs['description'],
                     location=kwargs.get('location', ''),
-                    photo=photo_data,
-                    creationTime=datetime.now(),
-                    session=the_session
+                    photoDigest=stored.digest if stored else None,
+                    photoSize=stored.size if stored else None,
+                    photoContentType=stored.content_type if stored else None,
+                    creationTime=datetime.now()
                 )
                 s.add(new_ticket)
 
-                logger.info('Successfully submitted ticket for auth={auth}'.format(auth=kwargs['authKey']))
+            # Re-encode the photo and make its thumbnail in the background
+            if stored is not None:
+                schedule_variants(stored.digest)
+
+            logger.info('Successfully submitted ticket for auth={auth}'.format(auth=auth_key))
 
-                # We have successfully add a ticket to the database
-                return True
-            else:
-                logger.error('Unable to find a session associated with the provided authentication key')
-                return False
+            # We have successfully add a ticket to the database
+            return True
+        else:
+            logger.error('Unable to find a session associated with the provided authentication key')
+            return False
     else:
         logger.error('authKey and description must be provided for the submit_ticket method')
         return False
 
 
+def submit_tickets(**kwargs):
+    """
+    Submit many tickets to the database under one authorization key. The session is resolved once and
+    every ticket is inserted by a single executemany in one transaction
+
+    :param kwargs:
+        authKey - authorization key that has been previously provided by the the API
+        tickets - list of dictionaries each containing a description and optionally a location and photo
+            (bytes of the photograph, already decoded by the validator)
+    :return: the number of tickets submitted or False if the session could not be found
+    """
+    if 'authKey' in kwargs and 'tickets' in kwargs:
+        resolved = _resolve_session(kwargs)
+        if resolved is None:
+            logger.error('Unable to find a session associated with the provided authentication key')
+            return False
+        auth_key = resolved[0]
+
+        # Write the photos to the photo store first, the rows only record their digest
+        now = datetime.now()
+        rows = []
+        digests = []
+        for ticket in kwargs['tickets']:
+            stored = photo_store.put(ticket['photo']) if ticket.get('photo') else None
+            if stored is not None:
+                digests.append(stored.digest)
+            rows.append({
+                'authKey': auth_key,
+                'description': ticket['description'],
+                'location': ticket.get('location', ''),
+                'photoDigest': stored.digest if stored else None,
+                'photoSize': stored.size if stored else None,
+                'photoContentType': stored.content_type if stored else None,
+                'creationTime': now
+            })
+
+        with DB() as s:
+            s.execute(Ticket.__table__.insert().execution_options(fast_executemany=True), rows)
+
+        for digest in digests:
+            schedule_variants(digest)
+
+        logger.info('Successfully submitted {count} tickets for auth={auth}'.format(count=len(rows), auth=auth_key))
+        return len(rows)
+    else:
+        logger.error('authKey and tickets must be provided for the submit_tickets method')
+        return False
+
+
+def _ensure_spool_writer():
+    """
+    Start this process's spool writer thread if it is not running yet
+    """
+    global _spool_writer
+    with _spool_writer_lock:
+        if _spool_writer is None or not _spool_writer.is_alive():
+            _spool_writer = SpoolWriter(
+                ticket_spool.resolve(),
+                batch_size=SETTINGS.get('ingest_batch_size', 100),
+                interval=SETTINGS.get('ingest_interval', 1.0),
+                max_attempts=SETTINGS.get('ingest_max_attempts', 10),
+                retention=SETTINGS.get('ingest_retention', 604800)
+            )
+            _spool_writer.start()
+
+
+def start_spool_writer():
+    """
+    Start the spool writer when the API starts if tickets are, or may be, waiting in the spool. Tickets left behind
+    by a restart are written even if async_ingest has been turned off since
+
+    :return: True if the writer was started
+    """
+    if async_ingest() or ticket_spool.has_work():
+        _ensure_spool_writer()
+        return True
+    return False
+
+
+def spool_ticket(**kwargs):
+    """
+    Accept a ticket without waiting for the database. The ticket is written to the local spool and a background
+    writer moves it to the Ticket table later, the returned receipt may be used to look up its progress
+
+    :param kwargs:
+        authKey - authorization key that has been previously provided by the the API
+        description - description of the ticket that is being submitted
+        location - physical location (such as a site or address) that the issue is being incurred
+        photo - bytes of the photograph associated with the issue, already decoded by the validator
+        storedPhoto - StoredPhoto of a photograph that was already written to the photo store, used instead of photo
+    :return: the receipt id of the ticket or False if the ticket could not be accepted
+    """
+    if 'authKey' in kwargs and 'description' in kwargs:
+        resolved = _resolve_session(kwargs)
+        if resolved is None:
+            logger.error('Unable to find a session associated with the provided authentication key')
+            return False
+        auth_key = resolved[0]
+
+        # The photo store is durable on its own, the spool only records the digest
+        stored = kwargs.get('storedPhoto')
+        if stored is None and kwargs.get('photo'):
+            stored = photo_store.put(kwargs['photo'])
+
+        receipt = ticket_spool.enqueue(
+            authKey=auth_key,
+            description=kwargs['description'],
+            location=kwargs.get('location', ''),
+            photoDigest=stored.digest if stored else None,
+            photoSize=stored.size if stored else None,
+            photoContentType=stored.content_type if stored else None
+        )
+
+        if stored is not None:
+            schedule_variants(stored.digest)
+        _ensure_spool_writer()
+
+        logger.info('Spooled ticket {receipt} for auth={auth}'.format(receipt=receipt, auth=auth_key))
+        return receipt
+    else:
+        logger.error('authKey and description must be provided for the spool_ticket method')
+        return False
+
+
+def spooled_ticket_status(**kwargs):
+    """
+    Look up the progress of a spooled ticket
+
+    :param kwargs:
+        authKey - authorization key the ticket was submitted with
+        receipt - receipt id returned when the ticket was spooled
+    :return: dictionary with the status (pending, claimed, submitted or failed) and number of attempts of the
+        ticket or None if the receipt is unknown or belongs to another session
+    """
+    resolved = _resolve_session(kwargs)
+    if resolved is None or kwargs.get('receipt') is None:
+        return None
+
+    row = ticket_spool.status(kwargs['receipt'])
+    if row is None or row['authKey'] != resolved[0]:
+        return None
+
+    return {'status': row['status'], 'attempts': row['attempts']}
+
+
+def purge_spool():
+    """
+    Delete spooled tickets that finished longer ago than the ingest_retention setting
+
+    :return: number of tickets deleted
+    """
+    return ticket_spool.purge(SETTINGS.get('ingest_retention', 604800))
+
+
+# Columns loaded when listing tickets, the photo column is left out unless it is asked for
+LISTED_TICKET_COLUMNS = [
+    'ticketID', 'description', 'location', 'creationTime', 'photoDigest', 'photoSize', 'photoContentType'
+]
+
+
+def _encode_cursor(ticket):
+    """
+    :param ticket: last ticket of a page
+    :return: opaque cursor pointing just past the ticket
+    """
+    position = '{time}|{id}'.format(time=ticket.creationTime.strftime('%Y-%m-%dT%H:%M:%S.%f'), id=ticket.ticketID)
+    return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    """
+    :param cursor: cursor created by _encode_cursor
+    :return: tuple (creationTime, ticketID) of the last ticket of the previous page
+    :raises ValueError: if the cursor is malformed
+    """
+    try:
+        creation_time, ticket_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+        return datetime.strptime(creation_time, '%Y-%m-%dT%H:%M:%S.%f'), int(ticket_id)
+    except (TypeError, UnicodeError, base64.binascii.Error) as e:
+        raise ValueError('malformed cursor: {error}'.format(error=e))
+
+
+def list_tickets(**kwargs):
+    """
+    List the tickets of the company an authorization key belongs to, newest first. Pages are found by seeking
+    past the (creationTime, ticketID) of the previous page's last ticket so every page costs the same no matter
+    how deep it is. Photos are only loaded if they are asked for
+
+    :param kwargs:
+        authKey - authorization key that has been previously provided by the the API
+        limit - maximum number of tickets to return, defaults to 50
+        cursor - nextCursor returned with the previous page
+        since - only list tickets created at or after this datetime
+        until - only list tickets created before this datetime
+        location - only list tickets with this location
+        includePhoto - if True, include each ticket's photo (the thumbnail when available) as base64
+    :return: dictionary with a list of `tickets` and the `nextCursor` (None on the last page) or
+        None if the session could not be found
+    :raises ValueError: if the cursor is malformed
+    """
+    resolved = _resolve_session(kwargs)
+    if resolved is None:
+        logger.error('Unable to find a session associated with the provided authentication key')
+        return None
+    company_id = resolved[1]
+
+    limit = int(kwargs.get('limit') or 50)
+    include_photo = kwargs.get('includePhoto', False)
+
+    columns = list(LISTED_TICKET_COLUMNS)
+    if include_photo:
+        columns.append('photo')
+
+    # Legacy tickets keep their photo in the database, whether they have one is known without loading it
+    has_inline_photo = case([(Ticket.photo.isnot(None), 1)], else_=0).label('hasInlinePhoto')
+
+    with DB() as s:
+        query = s.query(Ticket, has_inline_photo)\
+            .options(load_only(*columns))\
+            .join(Session, Session.authKey == Ticket.authKey)\
+            .filter(Session.companyID == company_id)
+
+        if kwargs.get('since') is not None:
+            query = query.filter(Ticket.creationTime >= kwargs['since'])
+        if kwargs.get('until') is not None:
+            query = query.filter(Ticket.creationTime < kwargs['until'])
+        if kwargs.get('location') is not None:
+            query = query.filter(Ticket.location == kwargs['location'])
+        if kwargs.get('cursor'):
+            creation_time, ticket_id = _decode_cursor(kwargs['cursor'])
+            query = query.filter(or_(
+                Ticket.creationTime < creation_time,
+                and_(Ticket.creationTime == creation_time, Ticket.ticketID < ticket_id)
+            ))
+
+        # Fetch one extra ticket to know if there is another page
+        found = query.order_by(Ticket.creationTime.desc(), Ticket.ticketID.desc()).limit(limit + 1).all()
+
+        tickets = []
+        for ticket, inline_photo in found[:limit]:
+            listed = {
+                'ticketID': ticket.ticketID,
+                'description': ticket.description,
+                'location': ticket.location,
+                'creationTime': ticket.creationTime.isoformat(),
+                'hasPhoto': bool(ticket.photoDigest or inline_photo),
+                'photoSize': ticket.photoSize,
+                'photoContentType': ticket.photoContentType
+            }
+
+            if include_photo:
+                photo_data = ticket.photo
+                if ticket.photoDigest:
+                    with photo_store.open_best(ticket.photoDigest, 'thumbnail') as photo_file:
+                        photo_data = photo_file.read()
+                listed['photo'] = base64.standard_b64encode(photo_data).decode('ascii') if photo_data else None
+
+            tickets.append(listed)
+
+        next_cursor = _encode_cursor(found[limit - 1][0]) if len(found) > limit else None
+
+    return {'tickets': tickets, 'nextCursor': next_cursor}
+
+
+def open_ticket_photo(**kwargs):
+    """
+    Find the photo of a ticket that belongs to the company an authorization key belongs to. Photos in the photo
+    store are not opened until `open` is called, their entity tag is the content digest (and the variant's name)
+    so a conditional request is answered without touching the file. Photos still held in the legacy photo column
+    are hashed on the fly
+
+    :param kwargs:
+        authKey - authorization key that has been previously provided by the the API
+        ticketID - ID of the ticket whose photo is opened
+        variant - name of the variant to open (such as thumbnail), None for the original photo. The original
+            photo is opened if the variant has not been made yet, the normalized variant if the original was dropped
+    :return: dictionary with the photo's `etag`, `contentType` and `open`, a function returning a tuple (binary
+        file object, size in bytes), or None if the session, the ticket or its photo could not be found
+    :raises ValueError: if the variant is unknown
+    """
+    variant = kwargs.get('variant')
+    if variant is not None and variant not in VARIANTS:
+        raise ValueError('unknown variant {variant}, expected one of {variants}'.format(
+            variant=variant,
+            variants=', '.join(sorted(VARIANTS))
+        ))
+
+    resolved = _resolve_session(kwargs)
+    if resolved is None:
+        logger.error('Unable to find a session associated with the provided authentication key')
+        return None
+
+    with DB() as s:
+        ticket = s.query(Ticket)\
+            .options(load_only('ticketID', 'photoDigest', 'photoContentType'))\
+            .join(Session, Session.authKey == Ticket.authKey)\
+            .filter(Session.companyID == resolved[1], Ticket.ticketID == kwargs.get('ticketID'))\
+            .first()
+
+        if ticket is None:
+            return None
+
+        if ticket.photoDigest is None:
+            # Tickets submitted before the photo store keep their photo in the database
+            photo_data = ticket.photo
+            if not photo_data:
+                return None
+            return {
+                'open': lambda: (io.BytesIO(photo_data), len(photo_data)),
+                'etag': hashlib.sha256(photo_data).hexdigest(),
+                'contentType': 'application/octet-stream'
+            }
+
+        digest = ticket.photoDigest
+        content_type = ticket.photoContentType or 'application/octet-stream'
+
+    # The original is served while the variant is not made yet, and the normalized variant once the original is dropped
+    variant = photo_store.best_variant(digest, variant)
+    if variant is not None:
+        etag = '{digest}.{variant}'.format(digest=digest, variant=variant)
+        # Variants are always re-encoded as JPEG
+        content_type = 'image/jpeg'
+    else:
+        etag = digest
+
+    def open_photo():
+        try:
+            stream = photo_store.open(digest, variant)
+        except FileNotFoundError:
+            # The original may have been dropped after best_variant picked it
+            if variant is not None:
+                raise
+            stream = photo_store.open(digest, ORIGINAL_REPLACEMENT)
+        stream.seek(0, io.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        return stream, size
+
+    return {'open': open_photo, 'etag': etag, 'contentType': content_type}
+
+
+def create_upload(**kwargs):
+    """
+    Start a chunked upload of a ticket's photo. The ticket's fields are kept with the upload and the ticket is
+    submitted once the upload is finalized
+
+    :param kwargs:
+        authKey - authorization key that has been previously provided by the the API
+        size - total size of the photo in bytes
+        sha256 - hex SHA-256 digest of the whole photo
+        description - description of the ticket that is being submitted
+        location - physical location (such as a site or address) that the issue is being incurred
+    :return: id of the upload or None if the session could not be found
+    :raises UploadTooLarge: if the photo is larger than allowed
+    """
+    resolved = _resolve_session(kwargs)
+    if resolved is None:
+        logger.error('Unable to find a session associated with the provided authentication key')
+        return None
+
+    upload_id = chunked_uploads.create(
+        resolved[0],
+        int(kwargs['size']),
+        kwargs['sha256'],
+        description=kwargs['description'],
+        location=kwargs.get('location')
+    )
+    logger.info('Started upload {id} of {size} bytes for auth={auth}'.format(
+        id=upload_id,
+        size=kwargs['size'],
+        auth=resolved[0]
+    ))
+    return upload_id
+
+
+def upload_status(**kwargs):
+    """
+    :param kwargs:
+        authKey - authorization key the upload was started with
+        uploadID - id of the upload
+    :return: dictionary with the number of bytes received so far (`offset`) and the total `size` or
+        None if the session could not be found
+    :raises UploadNotFound: if the upload does not exist or has expired
+    """
+    resolved = _resolve_session(kwargs)
+    if resolved is None:
+        logger.error('Unable to find a session associated with the provided authentication key')
+        return None
+    return chunked_uploads.status(kwargs['uploadID'], resolved[0])
+
+
+def write_upload_chunk(**kwargs):
+    """
+    Write a chunk of a photo to its upload
+
+    :param kwargs:
+        authKey - authorization key the upload was started with
+        uploadID - id of the upload
+        offset - position of the chunk's first byte in the photo
+        stream - file like object to read the chunk from
+    :return: number of bytes received so far or None if the session could not be found
+    :raises UploadNotFound: if the upload does not exist or has expired
+    :raises UploadOffsetError: if the chunk starts past the bytes received so far
+    :raises UploadTooLarge: if the chunk goes past the size of the upload
+    """
+    resolved = _resolve_session(kwargs)
+    if resolved is None:
+        logger.error('Unable to find a session associated with the provided authentication key')
+        return None
+    return chunked_uploads.write(kwargs['uploadID'], resolved[0], kwargs['offset'], kwargs['stream'])
+
+
+def finalize_upload(**kwargs):
+    """
+    Check a complete upload against its checksum, move the photo to the photo store and submit the ticket it was
+    started with. The ticket goes to the spool instead of the database when async_ingest is enabled. Finalizing an
+    upload again returns the result of the first finalize instead of submitting the ticket twice, and a finalize
+    whose ticket could not be saved may be retried
+
+    :param kwargs:
+        authKey - authorization key the upload was started with
+        uploadID - id of the upload
+    :return: the result of submit_ticket or spool_ticket or None if the session could not be found
+    :raises UploadNotFound: if the upload does not exist or has expired
+    :raises UploadIncomplete: if not every byte was received
+    :raises ChecksumMismatch: if the photo does not match its checksum
+    """
+    resolved = _resolve_session(kwargs)
+    if resolved is None:
+        logger.error('Unable to find a session associated with the provided authentication key')
+        return None
+
+    def submit(stored, fields):
+        logger.info('Finalized upload {id} as photo {digest}'.format(id=kwargs['uploadID'], digest=stored.digest))
+
+        ticket_data = dict(fields, authKey=resolved[0], session=resolved, storedPhoto=stored)
+        if ticket_data.get('location') is None:
+            del ticket_data['location']
+
+        if async_ingest():
+            return spool_ticket(**ticket_data)
+        return submit_ticket(**ticket_data)
+
+    # The upload stays locked until the ticket is saved so that concurrent finalizes submit it once
+    return chunked_uploads.finalize(kwargs['uploadID'], resolved[0], photo_store, submit)
+
 if __name__ == '__main__':
+    from ticketapi.apps import create_app
+    create_app(blueprints=[])
+
     with DB() as session:
         hashed_val, salt_val = crypto.hash('hunter2')
         new_company = Authentication(
@@ -0,0 +1,225 @@
+import os
+import pickle
+import tempfile
+from datetime import datetime
+import sqlalchemy
+from sqlalchemy import MetaData
+from ticketapi.data import SETTINGS
+from ticketapi.data import TICKET_API_ROOT
+from ticketapi.data.logger import logger
+
+__all__ = [
+    'SCHEMA', 'snapshot_file', 'REQUIRED_COLUMNS', 'schema_revision', 'reflect_metadata', 'save_snapshot',
+    'load_snapshot', 'diff_metadata', 'missing_columns'
+]
+
+# Database schema the API's tables live in
+SCHEMA = 'ticketapi'
+
+# Bumped whenever the layout of the snapshot file changes
+SNAPSHOT_VERSION = 2
+
+# Directory of the numbered migration scripts, the newest one is the revision of the schema the code expects
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Columns the procedures use, mostly added by the migrations, the API refuses to start without them
+REQUIRED_COLUMNS = {
+    'Authentication': [
+        'companyID', 'companyIDNormalized', 'hash', 'salt', 'techneauxTechCompanyID', 'scryptN', 'scryptR', 'scryptP'
+    ],
+    'Company': ['CompanyID', 'CompanyName'],
+    'Session': [
+        'authKey', 'companyID', 'creationTime', 'lastAccessTime', 'firstName', 'lastName', 'email', 'phoneNumber'
+    ],
+    'Ticket': [
+        'ticketID', 'authKey', 'description', 'location', 'photo', 'photoDigest', 'photoSize', 'photoContentType',
+        'creationTime', 'receipt'
+    ]
+}
+
+
+def snapshot_file():
+    """
+    :return: path of the file holding the reflected schema, written by the schemasnapshot app
+    """
+    return SETTINGS.get('schema_snapshot', os.path.join(TICKET_API_ROOT, 'schema.pickle'))
+
+
+def schema_revision():
+    """
+    :return: name of the newest migration script without its extension, None if there are no migrations
+    """
+    try:
+        names = sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith('.sql'))
+    except FileNotFoundError:
+        return None
+    return os.path.splitext(names[-1])[0] if names else None
+
+
+def reflect_metadata(engine):
+    """
+    Reflect the API's tables from the live database
+
+    :param engine: engine connected to the database
+    :return: MetaData holding every table of the schema
+    """
+    metadata = MetaData()
+    metadata.reflect(engine, schema=SCHEMA)
+    return metadata
+
+
+def save_snapshot(metadata, path=None):
+    """
+    Write a snapshot of reflected metadata, the file is replaced atomically so that processes starting at the
+    same time never read a partial snapshot
+
+    :param metadata: MetaData to save
+    :param path: file to write the snapshot to, defaults to snapshot_file()
+    """
+    path = path or snapshot_file()
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'sqlalchemy': sqlalchemy.__version__,
+        'revision': schema_revision(),
+        'created': datetime.now().isoformat(),
+        'metadata': metadata
+    }
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as tmp_file:
+        try:
+            pickle.dump(snapshot, tmp_file, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        except BaseException:
+            os.unlink(tmp_file.name)
+            raise
+    os.replace(tmp_file.name, path)
+
+
+def load_snapshot(path=None):
+    """
+    Load a snapshot written by save_snapshot. Snapshots are pickles of SQLAlchemy objects, one written by another
+    version of SQLAlchemy is not trusted and ignored. A snapshot taken before the newest migration is stale and
+    ignored as well
+
+    :param path: file to read the snapshot from, defaults to snapshot_file()
+    :return: tuple (MetaData, time the snapshot was created as an ISO string) or None if there is no usable snapshot
+    """
+    path = path or snapshot_file()
+    try:
+        with open(path, 'rb') as pickle_file:
+            snapshot = pickle.load(pickle_file)
+    except FileNotFoundError:
+        logger.info('No schema snapshot at {path}'.format(path=path))
+        return None
+    except Exception as e:
+        logger.error('Unable to read the schema snapshot at {path}: {error}'.format(path=path, error=e))
+        return None
+
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('sqlalchemy') != sqlalchemy.__version__:
+        logger.warning('Ignoring schema snapshot {path} written by SQLAlchemy {version}, regenerate it'.format(
+            path=path,
+            version=snapshot.get('sqlalchemy')
+        ))
+        return None
+
+    if snapshot.get('revision') != schema_revision():
+        logger.warning('Ignoring schema snapshot {path} taken at migration {taken}, expected {expected}, '
+                       'regenerate it'.format(path=path, taken=snapshot.get('revision'), expected=schema_revision()))
+        return None
+
+    return snapshot['metadata'], snapshot['created']
+
+
+def _describe_column(column):
+    """
+    :param column: Column to describe
+    :return: tuple of the properties of a column that matter to the API
+    """
+    return repr(column.type), column.nullable, column.primary_key
+
+
+def _describe_table(table):
+    """
+    :param table: Table to describe
+    :return: tuple (dictionary of column descriptions by name, set of index descriptions,
+        set of foreign key descriptions)
+    """
+    columns = {column.name: _describe_column(column) for column in table.columns}
+    indexes = {
+        (index.name, tuple(column.name for column in index.columns), bool(index.unique))
+        for index in table.indexes
+    }
+    foreign_keys = {
+        (key.parent.name, key.target_fullname)
+        for key in table.foreign_keys
+    }
+    return columns, indexes, foreign_keys
+
+
+def diff_metadata(expected, actual):
+    """
+    Compare two sets of metadata, usually a snapshot against the live schema
+
+    :param expected: MetaData the API was built against (the snapshot)
+    :param actual: MetaData of the database (freshly reflected)
+    :return: list of the differences as human readable lines, empty if the schemas match
+    """
+    differences = []
+
+    for name in sorted(set(expected.tables) - set(actual.tables)):
+        differences.append('table {name} is missing from the database'.format(name=name))
+    for name in sorted(set(actual.tables) - set(expected.tables)):
+        differences.append('table {name} is not in the snapshot'.format(name=name))
+
+    for name in sorted(set(expected.tables) & set(actual.tables)):
+        expected_columns, expected_indexes, expected_keys = _describe_table(expected.tables[name])
+        actual_columns, actual_indexes, actual_keys = _describe_table(actual.tables[name])
+
+        for column in sorted(set(expected_columns) - set(actual_columns)):
+            differences.append('column {table}.{column} is missing from the database'.format(
+                table=name,
+                column=column
+            ))
+        for column in sorted(set(actual_columns) - set(expected_columns)):
+            differences.append('column {table}.{column} is not in the snapshot'.format(table=name, column=column))
+        for column in sorted(set(expected_columns) & set(actual_columns)):
+            if expected_columns[column] != actual_columns[column]:
+                differences.append(
+                    'column {table}.{column} is (type, nullable, primary key) {actual} in the database, '
+                    '{expected} in the snapshot'.format(
+                        table=name,
+                        column=column,
+                        actual=actual_columns[column],
+                        expected=expected_columns[column]
+                    )
+                )
+
+        for index in sorted(expected_indexes - actual_indexes, key=repr):
+            differences.append('index {index} of {table} is missing from the database'.format(index=index, table=name))
+        for index in sorted(actual_indexes - expected_indexes, key=repr):
+            differences.append('index {index} of {table} is not in the snapshot'.format(index=index, table=name))
+        for key in sorted(expected_keys - actual_keys):
+            differences.append('foreign key {key} of {table} is missing from the database'.format(key=key, table=name))
+        for key in sorted(actual_keys - expected_keys):
+            differences.append('foreign key {key} of {table} is not in the snapshot'.format(key=key, table=name))
+
+    return differences
+
+
+def missing_columns(metadata):
+    """
+    Check that every column the procedures use is in the schema
+
+    :param metadata: MetaData of the schema
+    :return: list of the missing columns as table.column, empty if none are missing
+    """
+    missing = []
+    for table_name, columns in sorted(REQUIRED_COLUMNS.items()):
+        table = metadata.tables.get('{schema}.{table}'.format(schema=SCHEMA, table=table_name))
+        for column in columns:
+            if table is None or column not in table.columns:
+                missing.append('{table}.{column}'.format(table=table_name, column=column))
+    return missing
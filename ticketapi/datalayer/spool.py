@@ -0,0 +1,334 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from uuid import uuid4
+from ticketapi.datalayer.wrapper import *
+from ticketapi.datalayer.models import Ticket
+from ticketapi.data.logger import logger
+
+__all__ = ['TicketSpool', 'SpoolWriter']
+
+# Columns of a spooled ticket that are copied into the Ticket table
+TICKET_COLUMNS = ['authKey', 'description', 'location', 'photoDigest', 'photoSize', 'photoContentType', 'creationTime']
+
+# Format creation times are stored in, it sorts the same as the times themselves
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class TicketSpool(object):
+    """
+    Durable local journal of tickets that were accepted but not yet written to the database. The journal is a
+    SQLite database so that it survives restarts and may be shared by every process on the node. Each ticket
+    is identified by a receipt id that the client may use to look up its status.
+
+    Delivery is at least once: a batch whose claim timed out, or that was committed to the database just before
+    the writer died, is written again. The Ticket table records the receipt under a unique index and the writer
+    skips receipts that are already there, so the ticket itself is only inserted once.
+
+    :param path: path of the SQLite database file, it is created if it does not exist
+    :param claim_timeout: number of seconds after which a batch claimed by a writer that never finished is retried
+    """
+
+    def __init__(self, path, claim_timeout=300):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        """
+        :return: a connection for the calling thread, SQLite connections may not be shared between threads
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS receipt (
+                    id TEXT PRIMARY KEY,
+                    authKey TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    location TEXT,
+                    photoDigest TEXT,
+                    photoSize INTEGER,
+                    photoContentType TEXT,
+                    creationTime TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    nextAttempt REAL NOT NULL DEFAULT 0,
+                    claimedAt REAL,
+                    error TEXT
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS receipt_status ON receipt (status, nextAttempt)')
+            self._local.connection = connection
+        return connection
+
+    def enqueue(self, **kwargs):
+        """
+        Add a ticket to the spool, once this returns the ticket is on disk
+
+        :param kwargs: the ticket's authKey, description, location, photoDigest, photoSize and photoContentType
+        :return: receipt id of the ticket
+        """
+        receipt = str(uuid4())
+        self._connection().execute(
+            'INSERT INTO receipt (id, authKey, description, location, photoDigest, photoSize, photoContentType, '
+            'creationTime, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                receipt,
+                kwargs['authKey'],
+                kwargs['description'],
+                kwargs.get('location', ''),
+                kwargs.get('photoDigest'),
+                kwargs.get('photoSize'),
+                kwargs.get('photoContentType'),
+                datetime.now().strftime(TIME_FORMAT),
+                'pending'
+            )
+        )
+        return receipt
+
+    def has_work(self):
+        """
+        :return: True if there are tickets waiting to be written, the spool file is not created to answer this
+        """
+        if not os.path.exists(self.path):
+            return False
+        row = self._connection().execute(
+            'SELECT 1 FROM receipt WHERE status IN (?, ?) LIMIT 1',
+            ('pending', 'claimed')
+        ).fetchone()
+        return row is not None
+
+    def claim(self, limit):
+        """
+        Claim a batch of tickets that are due to be written so that no other writer picks them up
+
+        :param limit: maximum number of tickets to claim
+        :return: list of claimed rows
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT * FROM receipt WHERE (status = ? AND nextAttempt <= ?) OR (status = ? AND claimedAt < ?) '
+                'ORDER BY creationTime LIMIT ?',
+                ('pending', now, 'claimed', now - self.claim_timeout, limit)
+            ).fetchall()
+            connection.executemany(
+                'UPDATE receipt SET status = ?, claimedAt = ? WHERE id = ?',
+                [('claimed', now, row['id']) for row in rows]
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return rows
+
+    def mark_submitted(self, receipts):
+        """
+        :param receipts: receipt ids of tickets that were written to the database
+        """
+        self._connection().executemany(
+            'UPDATE receipt SET status = ?, error = NULL WHERE id = ?',
+            [('submitted', receipt) for receipt in receipts]
+        )
+
+    def mark_failed(self, receipts, error, max_attempts, backoff):
+        """
+        Put tickets back in the spool to be retried later, tickets that ran out of attempts are marked as failed
+
+        :param receipts: receipt ids of tickets that could not be written
+        :param error: reason the tickets could not be written
+        :param max_attempts: number of attempts after which a ticket is given up on
+        :param backoff: base number of seconds to wait before retrying, doubled for each attempt
+        """
+        now = time.time()
+        connection = self._connection()
+        for receipt in receipts:
+            row = connection.execute('SELECT attempts FROM receipt WHERE id = ?', (receipt,)).fetchone()
+            attempts = row['attempts'] + 1
+            connection.execute(
+                'UPDATE receipt SET status = ?, attempts = ?, nextAttempt = ?, error = ? WHERE id = ?',
+                (
+                    'failed' if attempts >= max_attempts else 'pending',
+                    attempts,
+                    now + backoff * 2 ** (attempts - 1),
+                    error,
+                    receipt
+                )
+            )
+
+    def purge(self, retention):
+        """
+        Delete tickets that were written to the database or given up on more than retention seconds ago, their
+        receipts can no longer be looked up afterwards
+
+        :param retention: number of seconds finished tickets are kept for
+        :return: number of tickets deleted
+        """
+        if not os.path.exists(self.path):
+            return 0
+        cursor = self._connection().execute(
+            'DELETE FROM receipt WHERE status IN (?, ?) AND claimedAt < ?',
+            ('submitted', 'failed', time.time() - retention)
+        )
+        return cursor.rowcount
+
+    def photo_digests(self, digests):
+        """
+        :param digests: photo digests to look for
+        :return: set of the digests that a spooled ticket refers to
+        """
+        if not digests or not os.path.exists(self.path):
+            return set()
+        rows = self._connection().execute(
+            'SELECT DISTINCT photoDigest FROM receipt WHERE photoDigest IN ({marks})'.format(
+                marks=', '.join('?' * len(digests))
+            ),
+            list(digests)
+        )
+        return {row['photoDigest'] for row in rows}
+
+    def auth_keys(self, auth_keys):
+        """
+        :param auth_keys: session authKeys to look for
+        :return: set of the authKeys that tickets waiting to be written were submitted under
+        """
+        if not auth_keys or not os.path.exists(self.path):
+            return set()
+        rows = self._connection().execute(
+            'SELECT DISTINCT authKey FROM receipt WHERE status IN (?, ?) AND authKey IN ({marks})'.format(
+                marks=', '.join('?' * len(auth_keys))
+            ),
+            ['pending', 'claimed'] + list(auth_keys)
+        )
+        return {row['authKey'] for row in rows}
+
+    def status(self, receipt):
+        """
+        :param receipt: receipt id to look up
+        :return: the spooled row of the ticket or None if the receipt is unknown
+        """
+        return self._connection().execute('SELECT * FROM receipt WHERE id = ?', (receipt,)).fetchone()
+
+
+class SpoolWriter(threading.Thread):
+    """
+    Background thread that drains a TicketSpool into the Ticket table in batched transactions
+
+    :param spool: TicketSpool to drain
+    :param batch_size: maximum number of tickets written per transaction
+    :param interval: number of seconds to sleep when the spool is empty
+    :param max_attempts: number of attempts after which a ticket is given up on
+    :param backoff: base number of seconds to wait before retrying a batch that failed
+    :param retention: number of seconds finished tickets are kept in the spool, see TicketSpool.purge
+    :param purge_interval: number of seconds between two purges of the spool
+    """
+
+    def __init__(self, spool, batch_size=100, interval=1.0, max_attempts=10, backoff=5.0, retention=604800,
+                 purge_interval=3600):
+        super().__init__(name='ticket-spool-writer', daemon=True)
+        self.spool = spool
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self._stopped = threading.Event()
+
+    def _write(self, tickets):
+        """
+        Insert tickets into the Ticket table in a single transaction
+
+        :param tickets: list of ticket rows to insert, each with its receipt
+        """
+        with DB() as s:
+            # Skip tickets a previous attempt already wrote, the unique index on receipt catches a writer
+            # racing us for the same batch
+            receipts = [ticket['receipt'] for ticket in tickets]
+            written = {row.receipt for row in s.query(Ticket.receipt).filter(Ticket.receipt.in_(receipts))}
+            tickets = [ticket for ticket in tickets if ticket['receipt'] not in written]
+            if tickets:
+                s.execute(Ticket.__table__.insert().execution_options(fast_executemany=True), tickets)
+
+    def drain_once(self):
+        """
+        Write one batch of spooled tickets to the database. If the batch can not be written as a whole its tickets
+        are written one at a time, so that a single bad ticket does not hold back (and finally fail) the others
+
+        :return: the number of tickets that were claimed
+        """
+        rows = self.spool.claim(self.batch_size)
+        if not rows:
+            return 0
+
+        tickets = []
+        for row in rows:
+            ticket = {column: row[column] for column in TICKET_COLUMNS}
+            ticket['creationTime'] = datetime.strptime(row['creationTime'], TIME_FORMAT)
+            ticket['receipt'] = row['id']
+            tickets.append(ticket)
+
+        try:
+            self._write(tickets)
+        except Exception as e:
+            logger.error('Unable to write a batch of {count} spooled tickets, writing them one at a time'.format(
+                count=len(tickets)
+            ))
+            logger.exception(e)
+        else:
+            self.spool.mark_submitted([ticket['receipt'] for ticket in tickets])
+            logger.info('Wrote {count} spooled tickets'.format(count=len(tickets)))
+            return len(rows)
+
+        submitted = []
+        for ticket in tickets:
+            try:
+                self._write([ticket])
+            except Exception as e:
+                logger.error('Unable to write spooled ticket {receipt}'.format(receipt=ticket['receipt']))
+                logger.exception(e)
+                self.spool.mark_failed([ticket['receipt']], str(e), self.max_attempts, self.backoff)
+            else:
+                submitted.append(ticket['receipt'])
+
+        self.spool.mark_submitted(submitted)
+        logger.info('Wrote {count} of {total} spooled tickets'.format(count=len(submitted), total=len(tickets)))
+        return len(rows)
+
+    def run(self):
+        last_purge = 0
+        while not self._stopped.is_set():
+            try:
+                claimed = self.drain_once()
+            except Exception as e:
+                logger.exception(e)
+                claimed = 0
+
+            if time.time() - last_purge >= self.purge_interval:
+                last_purge = time.time()
+                try:
+                    purged = self.spool.purge(self.retention)
+                    if purged:
+                        logger.info('Purged {count} finished tickets from the spool'.format(count=purged))
+                except Exception as e:
+                    logger.exception(e)
+
+            if claimed < self.batch_size:
+                self._stopped.wait(self.interval)
+
+    def stop(self):
+        """
+        Ask the writer to stop after its current batch
+        """
+        self._stopped.set()